@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic Benchmark Suite
+#############################################################################################################
+# MirrorBench.py
+# Measures how fast the hot stages of a mirror sync run against synthetic Debian/Ubuntu data.
+#
+#   parse    -- PkgDBPuller stream parse of a Packages.bz2 / Packages.xz index (10k, 60k, 500k stanzas)
+#   diff     -- ChangeSetGenerator.compute_change_set on old/new index pairs with a controlled churn rate
+#   download -- Downloader.threaded_downloader (or the DownloadScheduler / AsyncDownloader backends,
+#               --downloaders) against a local HTTP stand-in serving .deb payloads.  The stand-in is
+#               a threaded http.server or an asyncio server (--server), the latter keeps up with
+#               hundreds of connections for the async backend
+#
+# Each stage runs in a child process of its own so the peak RSS reported belongs to that stage alone.
+# A stage that raises, dies or runs past --stage-timeout is reported with an "error" and the run goes on.
+# For each stage the report holds
+#       throughput   (stanzas/s, MB/s, jobs/s)
+#       peak RSS     (MB, ru_maxrss of the child process)
+#       latency      (p50 / p90 / p99 / max in ms)
+#           parse    -- gap between consecutive package records coming out of the streaming parser
+#           diff     -- one full compute_change_set run (over --repeat runs)
+#           download -- one fetcher() call (one job fetch for the async backend)
+#   download also reports connection pool reuse ( conn_opened / conn_reused )
+#
+# Generated indexes are kept in the work directory and reused by later runs with the same seed.
+#
+#   ex: python3 benchmarks/MirrorBench.py --sizes 10000,60000 --churn 0.01,0.10 --json bench.json
+#
+#############################################################################################################
+
+import os
+import sys
+import io
+import bz2
+import lzma
+import json
+import time
+import random
+import socket
+import hashlib
+import argparse
+import resource
+import threading
+import asyncio
+import contextlib
+import urllib.parse
+import multiprocessing
+import queue as queue_module
+import http.server
+
+# benchmark the modules from this source tree
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", "modules" ) )
+
+import PkgDBPuller
+import ChangeSetGenerator
+import Downloader
+import ConnectionPool
+import DownloadScheduler
+import AsyncDownloader
+
+BENCH_DIST = "bench"
+BENCH_SECTION = "main"
+BENCH_ARCH = "amd64"
+
+# default limit for one stage run, in seconds
+STAGE_TIMEOUT = 3600
+
+# how often run_isolated checks on the child while it waits for the result, in seconds
+STAGE_POLL_SECONDS = 1
+
+# package name prefixes, weighted roughly like the ubuntu universe archive
+NAME_PREFIXES = [ "lib", "lib", "lib", "lib", "python3-", "golang-", "r-cran-", "node-", "fonts-", "", "", "" ]
+NAME_WORDS = [ "foo", "bar", "gtk", "qt", "xml", "ssl", "mesa", "boost", "perl", "ruby", "zlib", "curl", "gnome", "kde" ]
+
+
+""" (Internal) deterministic attributes for package number i.
+    The same i always gives the same package, so old/new index pairs agree on everything but churn. """
+def synthetic_package(i, seed, version_bump=0):
+    rnd = random.Random( seed * 1000003 + i )
+    prefix = NAME_PREFIXES[ rnd.randrange( len(NAME_PREFIXES) ) ]
+    word = NAME_WORDS[ rnd.randrange( len(NAME_WORDS) ) ]
+    name = prefix + word + str(i)
+    source = word + str(i)
+    epoch = "1:" if rnd.random() < 0.05 else ""
+    upstream = str( rnd.randrange(0, 10) )+"."+str( rnd.randrange(0, 30) )+"."+str( rnd.randrange(0, 100) + version_bump )
+    version = epoch + upstream + "-" + str( rnd.randrange(1, 5) ) + "ubuntu" + str( rnd.randrange(0, 3) )
+    size = int( min( rnd.lognormvariate(11.5, 1.5), 400 * 1024 * 1024 ) )
+    return name, source, version, size
+
+
+""" (Internal) render one Packages stanza, laid out like a real Ubuntu index entry """
+def synthetic_stanza(i, seed, version_bump=0):
+    name, source, version, size = synthetic_package( i, seed, version_bump )
+    pool_dir = "pool/main/" + ( source[:4] if source.startswith("lib") else source[0] ) + "/" + source + "/"
+    filename = pool_dir + name + "_" + version.split(":")[-1] + "_" + BENCH_ARCH + ".deb"
+    digest = hashlib.sha256( filename.encode() ).hexdigest()
+    return ( "Package: " + name + "\n"
+             "Architecture: " + BENCH_ARCH + "\n"
+             "Version: " + version + "\n"
+             "Priority: optional\n"
+             "Section: libs\n"
+             "Source: " + source + "\n"
+             "Origin: Ubuntu\n"
+             "Maintainer: Ubuntu Developers <ubuntu-devel-discuss@lists.ubuntu.com>\n"
+             "Installed-Size: " + str( size // 1024 * 3 ) + "\n"
+             "Depends: libc6 (>= 2.14), libgcc1 (>= 1:4.1.1), zlib1g (>= 1:1.1.4)\n"
+             "Filename: " + filename + "\n"
+             "Size: " + str(size) + "\n"
+             "MD5sum: " + digest[:32] + "\n"
+             "SHA1: " + digest[:40] + "\n"
+             "SHA256: " + digest + "\n"
+             "Description: synthetic benchmark package " + name + "\n"
+             " Generated by the Mirror Magic benchmark suite to look and weigh like\n"
+             " a real archive entry, including a multi line description.\n"
+             " .\n"
+             " Continuation lines like this one must never be parsed as fields: value\n"
+             "\n" )
+
+
+""" (Internal) stanzas for an index of count packages.
+    churn > 0 gives the 'new' side of an old/new pair: churn/3 of the packages are upgraded,
+    churn/3 are removed and count*churn/3 new packages are appended at the end. """
+def synthetic_index(count, seed, churn=0.0):
+    rnd = random.Random( seed )
+    for i in range(count):
+        if churn > 0:
+            roll = rnd.random()
+            if roll < churn / 3:
+                continue # removed
+            if roll < churn * 2 / 3:
+                yield synthetic_stanza( i, seed, version_bump=1 ) # upgraded
+                continue
+        yield synthetic_stanza( i, seed )
+
+    if churn > 0:
+        for i in range( count, count + int( count * churn / 3 ) ):
+            yield synthetic_stanza( i, seed )
+
+
+""" (Internal) write an index to mirror_root/dists/bench/main/binary-amd64/Packages.(bz2|xz)
+    streaming through the compressor.  Existing files are reused. """
+def write_index(mirror_root, vendor, stanzas):
+    path = mirror_root + "/dists/" + BENCH_DIST + "/" + BENCH_SECTION + "/binary-" + BENCH_ARCH + "/"
+    path = path + ( "Packages.xz" if vendor == "debian" else "Packages.bz2" )
+    if os.path.exists( path ):
+        return path
+
+    os.makedirs( os.path.dirname(path), exist_ok=True )
+    opener = lzma.open if vendor == "debian" else bz2.open
+    with opener( path + ".part", "wt", encoding="UTF-8" ) as fh:
+        for stanza in stanzas:
+            fh.write( stanza )
+    os.replace( path + ".part", path )
+    return path
+
+
+""" (Internal) latency percentiles in milliseconds for a list of durations in seconds """
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted( samples )
+    def pick(p):
+        return round( ordered[ min( len(ordered) - 1, int( p * len(ordered) ) ) ] * 1000, 3 )
+    return { "p50_ms" : pick(0.50), "p90_ms" : pick(0.90), "p99_ms" : pick(0.99), "max_ms" : round( ordered[-1] * 1000, 3 ) }
+
+
+""" (Internal) peak resident set size of this process in MB """
+def peak_rss_mb():
+    # ru_maxrss is in kB on linux
+    return round( resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024, 1 )
+
+
+""" (Internal) run stage_fn(*args) in a fresh child process and return its result dict.
+    A child per stage keeps ru_maxrss from one stage leaking into the next.
+    When the stage raises, the child dies or it runs longer than timeout seconds the result is
+    { "error" : what happened } instead. """
+def run_isolated(stage_fn, *args, timeout=STAGE_TIMEOUT):
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    def child():
+        try:
+            with contextlib.redirect_stdout( io.StringIO() ):
+                result = stage_fn( *args )
+            result["peak_rss_mb"] = peak_rss_mb()
+        except Exception as e:
+            result = { "error" : stage_fn.__name__+" raised "+type(e).__name__+": "+str(e) }
+        queue.put( result )
+    proc = ctx.Process( target=child )
+    proc.start()
+    deadline = time.monotonic() + timeout
+    result = None
+    while result is None:
+        try:
+            result = queue.get( timeout=STAGE_POLL_SECONDS )
+        except queue_module.Empty:
+            if not proc.is_alive():
+                # the result may have been put just before the exit
+                try:
+                    result = queue.get( timeout=STAGE_POLL_SECONDS )
+                except queue_module.Empty:
+                    result = { "error" : stage_fn.__name__+" died, exit code "+str(proc.exitcode) }
+            elif time.monotonic() > deadline:
+                proc.terminate()
+                result = { "error" : stage_fn.__name__+" timed out after "+str(timeout)+"s" }
+    proc.join()
+    return result
+
+
+""" parse stage, stream parse the index under mirror_root """
+def bench_parse(mirror_root, vendor, compressed_path):
+    puller = PkgDBPuller.PkgDBPuller( "file://" + mirror_root, mirror_root )
+    gaps = []
+    count = 0
+    start = last = time.perf_counter()
+    for entry in puller.stream_parse_local( vendor, BENCH_DIST, BENCH_ARCH, BENCH_SECTION ):
+        now = time.perf_counter()
+        gaps.append( now - last )
+        last = now
+        count += 1
+    elapsed = time.perf_counter() - start
+    size_mb = os.path.getsize( compressed_path ) / ( 1024 * 1024 )
+    result = { "stanzas" : count,
+               "seconds" : round( elapsed, 3 ),
+               "stanzas_per_s" : round( count / elapsed ),
+               "compressed_mb_per_s" : round( size_mb / elapsed, 2 ) }
+    result.update( percentiles( gaps ) )
+    return result
+
+
+""" diff stage, compute_change_set on an old/new pair, repeated """
+def bench_diff(old_root, new_root, repeat):
+    with PkgDBPuller.PkgDBPuller( "file://" + old_root, old_root ) as puller_old, \
+         PkgDBPuller.PkgDBPuller( "file://" + new_root, new_root ) as puller_new:
+        pkg_list_old = puller_old.fetch_and_parse_local( "ubuntu", BENCH_DIST, BENCH_ARCH, BENCH_SECTION )
+        pkg_list_new = puller_new.fetch_and_parse_local( "ubuntu", BENCH_DIST, BENCH_ARCH, BENCH_SECTION )
+        return diff_runs( pkg_list_old, pkg_list_new, repeat )
+
+
+""" (Internal) time compute_change_set on a parsed old/new pair """
+def diff_runs(pkg_list_old, pkg_list_new, repeat):
+    rss_before = peak_rss_mb()
+    runs = []
+    changes = 0
+    for n in range(repeat):
+        csg = ChangeSetGenerator.ChangeSetGenerator( pkg_list_new, pkg_list_old )
+        start = time.perf_counter()
+        csg.compute_change_set()
+        runs.append( time.perf_counter() - start )
+        changes = len( csg.change_set )
+    best = min( runs )
+    result = { "old_stanzas" : len(pkg_list_old),
+               "new_stanzas" : len(pkg_list_new),
+               "changes" : changes,
+               "seconds" : round( best, 3 ),
+               "stanzas_per_s" : round( ( len(pkg_list_old) + len(pkg_list_new) ) / best ),
+               "rss_before_diff_mb" : rss_before }
+    result.update( percentiles( runs ) )
+    return result
+
+
+""" (Internal) quiet request handler for the HTTP stand-in, HTTP/1.1 so keep-alive works """
+class BenchHTTPHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    def setup(self):
+        super().setup()
+        # headers and body go out in separate writes, don't let nagle hold the body back
+        self.connection.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+    def log_message(self, format, *args):
+        pass
+
+
+""" (Internal) start an HTTP server serving root on a free local port in a daemon thread """
+def start_http_standin(root):
+    handler = lambda *args, **kwargs: BenchHTTPHandler( *args, directory=root, **kwargs )
+    server = http.server.ThreadingHTTPServer( ("127.0.0.1", 0), handler )
+    server.daemon_threads = True
+    thread = threading.Thread( target=server.serve_forever, daemon=True )
+    thread.start()
+    return server
+
+
+class AsyncHTTPStandin:
+    """ asyncio HTTP/1.1 stand-in serving the files under root, keep-alive and "Range: bytes=N-" aware.
+        Runs its own event loop in a daemon thread, server_address and shutdown() like the http.server one """
+    def __init__(self, root):
+        self.root = root
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.thread = threading.Thread( target=self.serve, args=( started, ), daemon=True )
+        self.thread.start()
+        started.wait()
+
+    """ (Internal) event loop thread """
+    def serve(self, started):
+        asyncio.set_event_loop( self.loop )
+        self.server = self.loop.run_until_complete( asyncio.start_server( self.handle, "127.0.0.1", 0, backlog=1024 ) )
+        self.server_address = self.server.sockets[0].getsockname()
+        started.set()
+        self.loop.run_forever()
+
+    """ (Internal) io thread: whole content of a payload file """
+    def read_file(self, path):
+        with open( path, "rb" ) as fh:
+            return fh.read()
+
+    """ (Internal) serve GET requests on one connection until the client goes away """
+    async def handle(self, reader, writer):
+        writer.get_extra_info( "socket" ).setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode( "latin-1" ).split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in ( b"\r\n", b"\n", b"" ):
+                        break
+                    name, sep, value = line.decode( "latin-1" ).partition( ":" )
+                    headers[ name.strip().lower() ] = value.strip()
+
+                path = os.path.join( self.root, urllib.parse.unquote( urllib.parse.urlsplit( path ).path.lstrip("/") ) )
+                try:
+                    data = await self.loop.run_in_executor( None, self.read_file, path )
+                except OSError:
+                    writer.write( b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n" )
+                    continue
+
+                status, extra, body = "200 OK", "", memoryview( data )
+                if headers.get( "range", "" ).startswith( "bytes=" ) and headers["range"].endswith( "-" ):
+                    start = int( headers["range"][6:-1] )
+                    if start >= len( data ):
+                        writer.write( ( "HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */"+str( len(data) )+
+                                        "\r\nContent-Length: 0\r\n\r\n" ).encode( "latin-1" ) )
+                        continue
+                    status = "206 Partial Content"
+                    extra = "Content-Range: bytes "+str(start)+"-"+str( len(data) - 1 )+"/"+str( len(data) )+"\r\n"
+                    body = body[ start: ]
+                writer.write( ( "HTTP/1.1 "+status+"\r\nContent-Type: application/octet-stream\r\nContent-Length: "+
+                                str( len(body) )+"\r\n"+extra+"\r\n" ).encode( "latin-1" ) )
+                writer.write( body )
+                await writer.drain()
+        except ( ConnectionError, ValueError ):
+            pass
+        finally:
+            writer.close()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe( self.loop.stop )
+        self.thread.join()
+
+# end AsyncHTTPStandin
+
+
+""" (Internal) write count .deb payloads with sizes drawn from the synthetic size distribution.
+    Returns a list of ( relative path, sha256 hex, size ). """
+def write_payloads(root, count, seed, max_size):
+    payloads = []
+    for i in range(count):
+        name, source, version, size = synthetic_package( i, seed )
+        size = max( 1024, min( size, max_size ) )
+        rel = "pool/main/" + source[0] + "/" + name + ".deb"
+        path = root + "/" + rel
+        if not os.path.exists( path ) or os.path.getsize( path ) != size:
+            os.makedirs( os.path.dirname(path), exist_ok=True )
+            with open( path, "wb" ) as fh:
+                fh.write( random.Random( i ).randbytes( size ) )
+        with open( path, "rb" ) as fh:
+            digest = hashlib.sha256( fh.read() ).hexdigest()
+        payloads.append( ( rel, digest, size ) )
+    return payloads
+
+
+""" download stage, downloader is "threaded" (threaded_downloader), "scheduled" (DownloadScheduler)
+    or "async" (AsyncDownloader, thread_count transfers in flight) against the local HTTP stand-in,
+    server is "threaded" (http.server) or "asyncio" (AsyncHTTPStandin) """
+def bench_download(serve_root, payloads, dst_root, thread_count, downloader="threaded", server="threaded"):
+    if server == "asyncio":
+        server = AsyncHTTPStandin( serve_root )
+    else:
+        server = start_http_standin( serve_root )
+    base = "http://127.0.0.1:" + str( server.server_address[1] ) + "/"
+    os.makedirs( dst_root, exist_ok=True )
+    job_list = [ { 'src' : base + rel, 'dst' : dst_root + "/" + str(n) + ".deb", 'hash' : digest, 'size' : size, 'complete' : False, 'trys' : 0 }
+                 for n, ( rel, digest, size ) in enumerate( payloads ) ]
+
+    # time each fetcher call, both downloaders look fetcher up at call time
+    latencies = []
+    real_fetcher = Downloader.fetcher
+    def timed_fetcher(job, *args):
+        start = time.perf_counter()
+        try:
+            return real_fetcher( job, *args )
+        finally:
+            latencies.append( time.perf_counter() - start )
+    Downloader.fetcher = timed_fetcher
+
+    # same for the async backend's per job coroutine
+    real_fetch = AsyncDownloader.AsyncDownloader.fetch
+    async def timed_fetch(self, job):
+        start = time.perf_counter()
+        try:
+            return await real_fetch( self, job )
+        finally:
+            latencies.append( time.perf_counter() - start )
+    AsyncDownloader.AsyncDownloader.fetch = timed_fetch
+
+    pool = ConnectionPool.ConnectionPool()
+    start = time.perf_counter()
+    if downloader == "scheduled":
+        failed = DownloadScheduler.scheduled_downloader( job_list, thread_count, pool )
+    elif downloader == "async":
+        async_downloader = AsyncDownloader.AsyncDownloader( thread_count )
+        failed = async_downloader.run( job_list )
+    else:
+        failed = Downloader.threaded_downloader( job_list, thread_count, pool )
+    elapsed = time.perf_counter() - start
+    pool.close_all()
+    server.shutdown()
+
+    total_mb = sum( size for rel, digest, size in payloads ) / ( 1024 * 1024 )
+    result = { "jobs" : len(job_list),
+               "failed" : len(failed),
+               "threads" : thread_count,
+               "seconds" : round( elapsed, 3 ),
+               "jobs_per_s" : round( len(job_list) / elapsed, 1 ),
+               "mb_per_s" : round( total_mb / elapsed, 2 ) }
+    result.update( percentiles( latencies ) )
+    stats = async_downloader.stats if downloader == "async" else pool.get_stats()
+    result.update( { "conn_opened" : stats["opened"], "conn_reused" : stats["reused"] } )
+    return result
+
+
+""" (Internal) print one report line """
+def report(stage, label, result):
+    print( "%-9s %-24s %s" % ( stage, label, "  ".join( k + "=" + str(v) for k, v in result.items() ) ) )
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser( description="Mirror Magic benchmark suite" )
+    parser.add_argument( "--workdir", default="/tmp/mirror_magic_bench", help="where generated indexes and payloads are kept" )
+    parser.add_argument( "--sizes", default="10000,60000,500000", help="comma separated index sizes in stanzas" )
+    parser.add_argument( "--churn", default="0.01,0.05,0.20", help="comma separated churn rates for old/new pairs" )
+    parser.add_argument( "--stages", default="parse,diff,download", help="comma separated stages to run" )
+    parser.add_argument( "--repeat", type=int, default=3, help="diff runs per pair" )
+    parser.add_argument( "--downloads", type=int, default=500, help="number of .deb payloads served" )
+    parser.add_argument( "--max-payload", type=int, default=4 * 1024 * 1024, help="largest .deb payload in bytes" )
+    parser.add_argument( "--threads", default="4,16", help="comma separated downloader thread counts (transfers in flight for async)" )
+    parser.add_argument( "--downloaders", default="threaded", help="comma separated downloaders to run: threaded,scheduled,async" )
+    parser.add_argument( "--server", default="threaded", choices=( "threaded", "asyncio" ), help="HTTP stand-in for the download stage" )
+    parser.add_argument( "--seed", type=int, default=1 )
+    parser.add_argument( "--stage-timeout", type=float, default=STAGE_TIMEOUT, help="seconds one stage run may take" )
+    parser.add_argument( "--json", help="also write the results to this file as JSON" )
+    args = parser.parse_args( argv )
+
+    sizes = [ int(s) for s in args.sizes.split(",") ]
+    churns = [ float(c) for c in args.churn.split(",") ]
+    stages = args.stages.split(",")
+    results = []
+
+    if "parse" in stages:
+        for size in sizes:
+            for vendor in ( "ubuntu", "debian" ):
+                root = args.workdir + "/index-" + str(size)
+                path = write_index( root, vendor, synthetic_index( size, args.seed ) )
+                result = run_isolated( bench_parse, root, vendor, path, timeout=args.stage_timeout )
+                label = str(size) + ( " xz" if vendor == "debian" else " bz2" )
+                report( "parse", label, result )
+                results.append( { "stage" : "parse", "label" : label, "result" : result } )
+
+    if "diff" in stages:
+        for size in sizes:
+            old_root = args.workdir + "/index-" + str(size)
+            write_index( old_root, "ubuntu", synthetic_index( size, args.seed ) )
+            for churn in churns:
+                new_root = args.workdir + "/pair-" + str(size) + "-" + str(churn)
+                write_index( new_root, "ubuntu", synthetic_index( size, args.seed, churn ) )
+                result = run_isolated( bench_diff, old_root, new_root, args.repeat, timeout=args.stage_timeout )
+                label = str(size) + " churn " + str(churn)
+                report( "diff", label, result )
+                results.append( { "stage" : "diff", "label" : label, "result" : result } )
+
+    if "download" in stages:
+        serve_root = args.workdir + "/payloads"
+        payloads = write_payloads( serve_root, args.downloads, args.seed, args.max_payload )
+        for downloader in args.downloaders.split(","):
+            for thread_count in [ int(t) for t in args.threads.split(",") ]:
+                dst_root = args.workdir + "/downloaded-" + downloader + "-" + str(thread_count)
+                result = run_isolated( bench_download, serve_root, payloads, dst_root, thread_count, downloader, args.server,
+                                       timeout=args.stage_timeout )
+                label = str(args.downloads) + " jobs " + str(thread_count) + " threads " + downloader
+                report( "download", label, result )
+                results.append( { "stage" : "download", "label" : label, "result" : result } )
+
+    if args.json:
+        with open( args.json, "w" ) as fh:
+            json.dump( results, fh, indent=2 )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+
+################################################################################################
+# Mirror_Magic asyncio Downloader
+################################################################################################
+# AsyncDownloader.py
+#
+# asyncio backend for the Downloader, for job lists big enough that a thread per download gets
+# expensive.  It takes the same job dicts as threaded_downloader ( "src", "dst", "hash",
+# "complete", "trys" ) and leaves them in the same state:
+#
+#   one event loop thread runs every transfer over non-blocking sockets, with a small
+#       HTTP/1.1 client (keep-alive, chunked bodies, redirects, Range resume) on asyncio streams.
+#   file writes and SHA256 updates run in a small thread pool (io_threads), the event loop only
+#       moves bytes from the sockets.
+#   idle keep-alive connections are pooled per (scheme, host) and handed to the next job for it.
+#   concurrency caps the number of transfers in flight, per_host caps them per host.
+#
+# Partial downloads, .part files and resuming work exactly like in the threaded Downloader
+# (the same partial_state is used, a job can go from one backend to the other between tries).
+# Each try is reported to the metrics registry like the threaded Downloader does it.
+#
+# usage:
+#   failed_jobs_list = async_downloader( job_list, 256 )
+#   or from inside a running event loop:
+#   failed_jobs_list = await AsyncDownloader( 256 ).run_async( job_list )
+#
+################################################################################################
+
+import os
+import ssl
+import time
+import asyncio
+import hashlib
+import http.client
+import urllib.error
+import concurrent.futures
+from urllib.parse import urlsplit, urljoin
+
+from Downloader import DOWNLOAD_CHUNK_SIZE, save_partial, resume_partial, remove_part, range_honored, record_download
+
+# seconds a connect or a single read may take
+ASYNC_TIMEOUT = 60
+
+# number of redirects followed before giving up on a request
+ASYNC_MAX_REDIRECTS = 5
+
+# error and redirect bodies up to this size are read off so the connection can be reused
+DRAIN_LIMIT = 64 * 1024
+
+# errors that mean a kept-alive connection was closed by the server between requests
+STALE_CONNECTION_ERRORS = ( asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError,
+                            ConnectionAbortedError, http.client.BadStatusLine )
+
+
+""" (Internal) io thread: append a chunk to the file and the hash """
+def write_and_hash(fh, sha_gen, chunk):
+    fh.write( chunk )
+    sha_gen.update( chunk )
+
+
+""" (Internal) io thread: make sure the data is on disk before it can be renamed into place """
+def sync_file(fh):
+    fh.flush()
+    os.fsync( fh.fileno() )
+
+
+class AsyncResponse:
+    """ body of one HTTP/1.1 response on a pooled connection.
+        status, reason and headers (http.client.HTTPMessage) like http.client.HTTPResponse,
+        length is the number of Content-Length bytes not read yet (None if not known) """
+    def __init__(self, client, key, conn, status, reason, headers, timeout):
+        self.client = client
+        self.key = key
+        self.reader, self.writer = conn
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.timeout = timeout
+        self.chunked = "chunked" in headers.get( "Transfer-Encoding", "" ).lower()
+        self.chunk_left = 0
+        self.length = None
+        if not self.chunked and headers.get( "Content-Length" ) is not None:
+            self.length = int( headers["Content-Length"] )
+        self.will_close = headers.get( "Connection", "" ).lower() == "close" or ( not self.chunked and self.length is None )
+        self.done = self.length == 0 or status in ( 204, 304 )
+
+    """ (Internal) read from the socket with the response timeout """
+    async def wait(self, coro):
+        return await asyncio.wait_for( coro, self.timeout )
+
+    """ read up to n bytes of body, returns b"" once the body is done """
+    async def read(self, n):
+        if self.done:
+            return b""
+        if self.chunked:
+            return await self.read_chunked( n )
+        if self.length is not None:
+            try:
+                data = await self.wait( self.reader.readexactly( min( n, self.length ) ) )
+            except asyncio.IncompleteReadError as e:
+                # connection closed early, self.length keeps what is missing
+                data = e.partial
+                self.will_close = True
+                self.done = True
+            self.length -= len( data )
+            if self.length == 0:
+                self.done = True
+            return data
+
+        # no length given, the body ends when the server closes the connection
+        data = bytearray()
+        while len( data ) < n:
+            block = await self.wait( self.reader.read( n - len( data ) ) )
+            if not block:
+                self.done = True
+                break
+            data += block
+        return bytes( data )
+
+    """ (Internal) read up to n bytes of a chunked body """
+    async def read_chunked(self, n):
+        data = bytearray()
+        while len( data ) < n and not self.done:
+            if self.chunk_left == 0:
+                line = await self.wait( self.reader.readline() )
+                if not line:
+                    raise http.client.IncompleteRead( bytes( data ) )
+                self.chunk_left = int( line.split( b";", 1 )[0].strip() or b"0", 16 )
+                if self.chunk_left == 0:
+                    # last chunk, skip the trailers
+                    while ( await self.wait( self.reader.readline() ) ).strip():
+                        pass
+                    self.done = True
+                    break
+            block = await self.wait( self.reader.readexactly( min( n - len( data ), self.chunk_left ) ) )
+            data += block
+            self.chunk_left -= len( block )
+            if self.chunk_left == 0:
+                await self.wait( self.reader.readexactly( 2 ) )
+        return bytes( data )
+
+    """ hand the connection back to the client's pool, or close it if the body was not read
+        to the end (small leftovers are read off first) """
+    async def release(self):
+        if not self.done and not self.will_close and self.length is not None and self.length <= DRAIN_LIMIT:
+            try:
+                while await self.read( DRAIN_LIMIT ):
+                    pass
+            except ( OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, http.client.HTTPException, ValueError ):
+                self.will_close = True
+        if self.done and not self.will_close:
+            self.client.put_connection( self.key, ( self.reader, self.writer ) )
+        else:
+            self.client.close_connection( ( self.reader, self.writer ) )
+
+# end AsyncResponse
+
+
+class AsyncDownloader:
+    """ concurrency is the number of transfers in flight at once,
+        per_host the most of those against one host (default: no limit besides concurrency),
+        io_threads the number of threads doing file writes and hashing,
+        on_job_done an optional callable, called on the event loop thread with each job as it finishes """
+    def __init__(self, concurrency=256, per_host=None, io_threads=4, timeout=ASYNC_TIMEOUT, on_job_done=None):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.io_threads = io_threads
+        self.timeout = timeout
+        self.on_job_done = on_job_done
+        self.idle = {}          # { (scheme, netloc) : [ ( reader, writer ) ] } kept-alive connections
+        self.stats = { "requests" : 0, "opened" : 0, "reused" : 0, "dropped" : 0, "stale_retry" : 0 }
+
+    """ (Internal) run a blocking call on the io threads """
+    async def in_io(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor( self.io_pool, fn, *args )
+
+    """ (Internal) an idle connection to scheme://netloc, or a new one.
+        returns ( ( reader, writer ), reused ) """
+    async def get_connection(self, scheme, netloc):
+        idle = self.idle.get( (scheme, netloc) )
+        while idle:
+            reader, writer = idle.pop()
+            if reader.at_eof() or writer.is_closing():
+                # the server timed the connection out while it sat in the pool
+                self.close_connection( ( reader, writer ) )
+                continue
+            return ( reader, writer ), True
+
+        parts = urlsplit( scheme+"://"+netloc )
+        port = parts.port or ( 443 if scheme == "https" else 80 )
+        ssl_context = ssl.create_default_context() if scheme == "https" else None
+        try:
+            conn = await asyncio.wait_for( asyncio.open_connection( parts.hostname, port, ssl=ssl_context ), self.timeout )
+        except ( OSError, asyncio.TimeoutError ) as e:
+            raise urllib.error.URLError( e )
+        self.stats["opened"] += 1
+        return conn, False
+
+    """ (Internal) return a connection with nothing left to read to the idle pool """
+    def put_connection(self, key, conn):
+        self.idle.setdefault( key, [] ).append( conn )
+
+    """ (Internal) close a connection for good """
+    def close_connection(self, conn):
+        conn[1].close()
+        self.stats["dropped"] += 1
+
+    """ (Internal) send a GET on a connection and read the status line and headers.
+        returns ( status, reason, http.client.HTTPMessage ) """
+    async def send_request(self, conn, parts, headers):
+        reader, writer = conn
+        path = parts.path or "/"
+        if parts.query:
+            path = path + "?" + parts.query
+        lines = [ "GET "+path+" HTTP/1.1", "Host: "+parts.netloc, "Accept-Encoding: identity" ]
+        lines += [ name+": "+str(value) for name, value in headers.items() ]
+        writer.write( ( "\r\n".join( lines )+"\r\n\r\n" ).encode( "latin-1" ) )
+        await writer.drain()
+
+        status_line = await asyncio.wait_for( reader.readline(), self.timeout )
+        if not status_line:
+            raise asyncio.IncompleteReadError( b"", None )
+        try:
+            version, status, reason = ( status_line.decode( "latin-1" ).rstrip( "\r\n" ).split( " ", 2 ) + [ "" ] )[:3]
+            status = int( status )
+        except ValueError:
+            raise http.client.BadStatusLine( status_line )
+
+        message = http.client.HTTPMessage()
+        while True:
+            line = await asyncio.wait_for( reader.readline(), self.timeout )
+            if line in ( b"\r\n", b"\n", b"" ):
+                break
+            name, sep, value = line.decode( "latin-1" ).partition( ":" )
+            if sep:
+                message[name.strip()] = value.strip()
+        return status, reason, message
+
+    """ (Internal) GET url on a pooled connection, following redirects.
+        returns an AsyncResponse, raises urllib.error.HTTPError for error codes
+        and urllib.error.URLError when the host can not be reached """
+    async def request(self, url, headers):
+        for redirect in range( ASYNC_MAX_REDIRECTS + 1 ):
+            parts = urlsplit( url )
+            if parts.scheme not in ( "http", "https" ):
+                raise urllib.error.URLError( "unsupported scheme for async downloader: "+str(parts.scheme) )
+            key = ( parts.scheme, parts.netloc )
+
+            conn, reused = await self.get_connection( *key )
+            self.stats["requests"] += 1
+            try:
+                status, reason, message = await self.send_request( conn, parts, headers )
+            except STALE_CONNECTION_ERRORS as e:
+                self.close_connection( conn )
+                if not reused:
+                    raise urllib.error.URLError( e )
+                # server closed an idle keep-alive connection, resend once on a fresh one
+                self.stats["stale_retry"] += 1
+                conn, reused = await self.get_connection( *key )
+                try:
+                    status, reason, message = await self.send_request( conn, parts, headers )
+                except ( OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, http.client.HTTPException ) as e:
+                    self.close_connection( conn )
+                    raise urllib.error.URLError( e )
+            except ( OSError, asyncio.TimeoutError, http.client.HTTPException ) as e:
+                self.close_connection( conn )
+                raise urllib.error.URLError( e )
+
+            if reused:
+                self.stats["reused"] += 1
+
+            response = AsyncResponse( self, key, conn, status, reason, message, self.timeout )
+            if status in ( 301, 302, 303, 307, 308 ) and message.get( "Location" ):
+                await response.release()
+                url = urljoin( url, message["Location"] )
+                continue
+
+            if status >= 400:
+                await response.release()
+                raise urllib.error.HTTPError( url, status, reason, message, None )
+
+            return response
+
+        raise urllib.error.URLError( "too many redirects for "+str(url) )
+
+    """ (Internal) stream a response into the file at path, like Downloader.stream_to_file.
+        Reads happen on the event loop, writes and hashing on the io threads.
+        on_chunk is an optional callable, called with the size of every chunk read """
+    async def stream_to_file(self, response, path, sha_gen, offset, on_chunk=None):
+        if sha_gen is None:
+            sha_gen = hashlib.sha256()
+        length = offset
+        fh = await self.in_io( open, path, "ab" if offset else "wb" )
+        try:
+            try:
+                while True:
+                    chunk = await response.read( DOWNLOAD_CHUNK_SIZE )
+                    if not chunk:
+                        break
+                    await self.in_io( write_and_hash, fh, sha_gen, chunk )
+                    length += len( chunk )
+                    if on_chunk is not None:
+                        on_chunk( len( chunk ) )
+                if response.length:
+                    # connection closed before Content-Length bytes arrived
+                    raise http.client.IncompleteRead( b"", response.length )
+            except BaseException:
+                fh.flush()
+                save_partial( path, sha_gen, length )
+                raise
+            await self.in_io( sync_file, fh )
+        finally:
+            fh.close()
+        return sha_gen
+
+    """ (Internal) fetch one job, same contract as Downloader.fetcher """
+    async def fetch(self, job):
+        job['trys'] += 1
+        print("Fetching: "+str(job['src']))
+        part_path = job['dst'] + ".part"
+        start = time.perf_counter()
+        ttfb = None
+        received = [ 0 ]
+        def counted(n):
+            received[0] += n
+        try:
+            dst_dir = os.path.dirname( job['dst'] )
+            if dst_dir:
+                await self.in_io( lambda: os.makedirs( dst_dir, exist_ok=True ) )
+
+            offset, sha_gen = 0, None
+            if job['trys'] > 1 and not job['complete']:
+                # retry, carry on from where the last try got to
+                offset, sha_gen = await self.in_io( resume_partial, part_path )
+
+            headers = {}
+            if offset:
+                print("Resuming: "+str(job['src'])+" from byte "+str(offset) )
+                headers['Range'] = "bytes="+str(offset)+"-"
+
+            response = await self.request( job['src'], headers )
+            ttfb = time.perf_counter() - start
+            try:
+                if offset and not range_honored( response, offset ):
+                    # server sent the whole file, start again from byte zero
+                    offset, sha_gen = 0, None
+                sha_gen = await self.stream_to_file( response, part_path, sha_gen, offset, counted )
+            finally:
+                await response.release()
+
+            if ( sha_gen.hexdigest() == job['hash'] ):
+                # we have good data, move it into place
+                await self.in_io( os.replace, part_path, job['dst'] )
+                job['complete'] = True
+                result = "ok"
+            else:
+                # bad SHA Hash, the partial data can't be trusted either
+                print("Download hash mismatch: "+str(job['src']) )
+                await self.in_io( remove_part, part_path )
+                job['complete'] = False
+                result = "hash_mismatch"
+
+        except urllib.error.HTTPError as e:
+            print("Download http error #"+str(e.code) )
+            if e.code == 416:
+                # range not satisfiable, the partial file does not match the remote one
+                await self.in_io( remove_part, part_path )
+            job['complete'] = False
+            result = "http_"+str(e.code)
+
+        except urllib.error.URLError as e:
+            print("Download error: "+str(e.reason) )
+            job['complete'] = False
+            result = "url_error"
+
+        except ( http.client.HTTPException, asyncio.IncompleteReadError, ValueError ) as e:
+            # connection dropped or garbled mid response, the partial file is kept
+            print("Download http protocol error: "+repr(e) )
+            job['complete'] = False
+            result = "protocol_error"
+
+        except asyncio.TimeoutError:
+            # a read stalled for longer than the timeout, the partial file is kept.
+            # not an OSError before python 3.11, so it needs its own clause.  Reported like
+            # the threaded Downloader's socket timeouts
+            print("Download IO Error: timed out reading "+str(job['src']) )
+            job['complete'] = False
+            result = "io_error"
+
+        except IOError as e:
+            print("Download IO Error: "+str(e) )
+            job['complete'] = False
+            result = "io_error"
+
+        record_download( job['src'], result, time.perf_counter() - start, ttfb, received[0], job['trys'] )
+        return job
+
+    """ (Internal) fetch a job once there is room for it, overall and on its host """
+    async def fetch_limited(self, job):
+        host_limit = self.host_limits.get( urlsplit( job['src'] ).netloc )
+        if host_limit is None and self.per_host:
+            host_limit = self.host_limits[ urlsplit( job['src'] ).netloc ] = asyncio.Semaphore( self.per_host )
+        async with self.limit:
+            if host_limit is None:
+                await self.fetch( job )
+            else:
+                async with host_limit:
+                    await self.fetch( job )
+        if self.on_job_done is not None:
+            self.on_job_done( job )
+        return job
+
+    """ download every job in job_list from inside a running event loop.
+        returns the list of failed jobs """
+    async def run_async(self, job_list):
+        self.limit = asyncio.Semaphore( self.concurrency )
+        self.host_limits = {}
+        with concurrent.futures.ThreadPoolExecutor( self.io_threads ) as self.io_pool:
+            try:
+                jobs = await asyncio.gather( *( self.fetch_limited( job ) for job in job_list ) )
+            finally:
+                for idle in self.idle.values():
+                    for conn in idle:
+                        conn[1].close()
+                self.idle = {}
+        print("Async downloader connection stats: "+str( self.stats ) )
+        return [ job for job in jobs if not job['complete'] ]
+
+    """ download every job in job_list on a new event loop.  returns the list of failed jobs """
+    def run(self, job_list):
+        return asyncio.run( self.run_async( job_list ) )
+
+# end AsyncDownloader
+
+
+""" async counterpart of threaded_downloader, extra keyword arguments go to AsyncDownloader.
+    The threaded backends' pool and mirrors are not supported, the event loop keeps its own
+    connections and fetches every job from its "src".  Passing them raises ValueError. """
+def async_downloader( job_list, concurrency, pool=None, mirrors=None, **options ):
+    unsupported = [ name for name, value in ( ( "pool", pool ), ( "mirrors", mirrors ) ) if value is not None ]
+    if unsupported:
+        raise ValueError( "the async download backend does not take "+" or ".join( unsupported ) )
+    return AsyncDownloader( concurrency, **options ).run( job_list )
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
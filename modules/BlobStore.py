@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic BlobStore
+#############################################################################################################
+# BlobStore
+# Content addressed store of every package file the mirror has had, keyed by SHA256.
+#
+#       ${store_dir}/${sha256[0:2]}/${sha256}
+#
+# A blob is a hardlink to the pool file it was filed from, so the store costs no disk space while the
+# pool file is around, and keeps the content when the pool file goes away (a removed or rolled back
+# version, a pool reorganisation, another vendor tree on the same filesystem).
+#
+# Before the JobPlanner queues a download it asks the store for the hash, a hit is put in place with
+#       a hardlink          same inode, no extra disk at all
+#       a reflink           (FICLONE) copy on write clone on btrfs/xfs, when hardlinks are not possible
+#       a plain copy        last resort, still no bandwidth spent
+# Files only end up in the store once their SHA256 has been checked (a finished download, or a file
+# the planner found on disk with the right hash), the store trusts its contents.
+#
+# A hardlinked blob is in use while its link count is above 1.  A reflinked or copied blob always has
+# one link, so the paths it was filed from or put at are listed next to it, one per line, in
+#       ${store_dir}/${sha256[0:2]}/${sha256}.refs
+# and it is in use while one of them is still there.  prune() only removes blobs that are in neither.
+#
+# usage:
+#   store = BlobStore( local_mirror_root_path+"/.blobs" )
+#   store.import_tree( local_mirror_root_path+"/pool" )     # once, to file an existing mirror
+#   planner = JobPlanner( remote_mirror_root_url, local_mirror_root_path, blob_store=store )
+#
+#############################################################################################################
+
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import concurrent.futures
+
+from Metrics import metrics
+
+# ioctl request to clone a whole file (linux/fs.h FICLONE = _IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+# bytes read per step when hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+""" SHA256 hex digest of the file at path, None if it can't be read.
+    Every module that hashes whole files on disk goes through here ( JobPlanner, IntegrityScanner,
+    PkgIndexCache ), so the time and bytes all go to the hash_seconds / hash_bytes_total metrics. """
+def hash_file(path):
+    start = time.perf_counter()
+    sha_gen = hashlib.sha256()
+    hashed = 0
+    try:
+        with open( path, "rb" ) as fh:
+            while True:
+                chunk = fh.read( HASH_CHUNK_SIZE )
+                if not chunk:
+                    break
+                sha_gen.update( chunk )
+                hashed += len( chunk )
+    except IOError:
+        metrics.inc( "hash_errors_total" )
+        return None
+    metrics.observe( "hash_seconds", time.perf_counter() - start )
+    metrics.inc( "hash_bytes_total", hashed )
+    return sha_gen.hexdigest()
+
+
+""" (Internal) clone src to dst with the FICLONE ioctl, True when the filesystem did it """
+def reflink(src, dst):
+    try:
+        with open( src, "rb" ) as src_fh, open( dst, "wb" ) as dst_fh:
+            fcntl.ioctl( dst_fh.fileno(), FICLONE, src_fh.fileno() )
+        return True
+    except OSError:
+        try:
+            os.remove( dst )
+        except OSError:
+            pass
+        return False
+
+
+class BlobStore:
+    """ store_dir is where the blobs are kept, it has to be on the same filesystem as the mirror
+        for hardlinks, ex: /opt/mirror_magic/ubuntu/.blobs """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.stats = { "filed" : 0, "hits" : 0, "misses" : 0, "hardlinks" : 0, "reflinks" : 0, "copies" : 0 }
+
+    """ path of the blob for a SHA256 hex digest """
+    def blob_path(self, sha):
+        sha = sha.lower()
+        return os.path.join( self.store_dir, sha[:2], sha )
+
+    """ True when the store has a blob for sha """
+    def has(self, sha):
+        return os.path.exists( self.blob_path( sha ) )
+
+    """ (Internal) path of the reference list of a blob ( see add_ref ) """
+    def refs_path(self, blob):
+        return blob+".refs"
+
+    """ (Internal) remember that path uses blob, for a blob that is not hardlinked to it """
+    def add_ref(self, blob, path):
+        try:
+            with open( self.refs_path( blob ), "a" ) as fh:
+                fh.write( os.path.abspath( path )+"\n" )
+        except IOError as e:
+            print("(Warn) could not save blob store reference for "+str(path)+" : "+str(e) )
+
+    """ (Internal) True when a path in the reference list of blob is still there.
+        Paths that are gone are dropped from the list, a list that ends up empty is kept (empty)
+        so its mtime says since when the blob has not been used. """
+    def refs_in_use(self, blob):
+        refs_path = self.refs_path( blob )
+        try:
+            with open( refs_path, "r" ) as fh:
+                refs = [ line.rstrip("\n") for line in fh if line.strip() ]
+        except IOError:
+            return False
+        in_use = [ ref for ref in refs if os.path.lexists( ref ) ]
+        if len( in_use ) < len( refs ):
+            try:
+                with open( refs_path+".part", "w" ) as fh:
+                    fh.writelines( ref+"\n" for ref in in_use )
+                os.replace( refs_path+".part", refs_path )
+            except IOError as e:
+                print("(Warn) could not update blob store references "+str(refs_path)+" : "+str(e) )
+        return bool( in_use )
+
+    """ (Internal) give dst the content of src, hardlink first, then reflink, then a copy.
+        dst is written next to itself and renamed into place.  returns "hardlink", "reflink" or "copy" """
+    def link_file(self, src, dst):
+        tmp = dst+".blob"
+        os.makedirs( os.path.dirname( dst ) or ".", exist_ok=True )
+        try:
+            os.remove( tmp )
+        except FileNotFoundError:
+            pass
+        try:
+            os.link( src, tmp )
+            how = "hardlink"
+        except OSError:
+            # cross device or no hardlink support
+            if reflink( src, tmp ):
+                how = "reflink"
+            else:
+                shutil.copy2( src, tmp )
+                how = "copy"
+        os.replace( tmp, dst )
+        return how
+
+    """ file the (already hash checked) file at path under sha.
+        returns True when the store has the blob afterwards """
+    def add(self, path, sha):
+        blob = self.blob_path( sha )
+        if os.path.exists( blob ):
+            return True
+        try:
+            how = self.link_file( path, blob )
+        except IOError as e:
+            print("(Warn) could not file "+str(path)+" in the blob store : "+str(e) )
+            return False
+        if how != "hardlink":
+            self.add_ref( blob, path )
+        self.stats["filed"] += 1
+        return True
+
+    """ put the blob for sha at dst.  returns True on a hit, False when the store does not have it
+        (or it could not be linked) """
+    def materialize(self, sha, dst):
+        blob = self.blob_path( sha )
+        if not os.path.exists( blob ):
+            self.stats["misses"] += 1
+            return False
+        try:
+            how = self.link_file( blob, dst )
+        except IOError as e:
+            print("(Warn) could not link "+str(dst)+" from the blob store : "+str(e) )
+            self.stats["misses"] += 1
+            return False
+        if how != "hardlink":
+            self.add_ref( blob, dst )
+        self.stats["hits"] += 1
+        self.stats[ how+"s" ] += 1
+        return True
+
+    """ (Internal) inode numbers of every blob in the store """
+    def blob_inodes(self):
+        inodes = set()
+        try:
+            for prefix in os.listdir( self.store_dir ):
+                with os.scandir( os.path.join( self.store_dir, prefix ) ) as entries:
+                    inodes.update( entry.inode() for entry in entries )
+        except OSError:
+            pass
+        return inodes
+
+    """ hash and file every file under root whose name ends with suffix, threads at a time.
+        Files that already are a hardlink of a blob are skipped without hashing.
+        returns the number of files filed """
+    def import_tree(self, root, suffix=".deb", threads=4):
+        inodes = self.blob_inodes()
+        paths = []
+        for dirpath, dirnames, filenames in os.walk( root ):
+            # never import the store into itself
+            dirnames[:] = [ d for d in dirnames if os.path.abspath( os.path.join( dirpath, d ) ) != os.path.abspath( self.store_dir ) ]
+            for name in filenames:
+                if not name.endswith( suffix ):
+                    continue
+                path = os.path.join( dirpath, name )
+                try:
+                    if os.stat( path ).st_ino not in inodes:
+                        paths.append( path )
+                except OSError as e:
+                    # dangling symlink, or the file went away while we walked
+                    print("(Warn) not importing "+str(path)+" : "+str(e) )
+
+        filed = 0
+        with concurrent.futures.ThreadPoolExecutor( threads ) as tpe:
+            for path, sha in zip( paths, tpe.map( hash_file, paths ) ):
+                if sha is not None and not self.has( sha ) and self.add( path, sha ):
+                    filed += 1
+        return filed
+
+    """ remove blobs nothing uses any more for more than max_age_days, the store would otherwise keep
+        every version ever mirrored.  A hardlinked blob is unused at link count 1 (the inode ctime moves
+        when its last other link goes), a reflinked or copied one when no path in its reference list is
+        left (the list's mtime moves when its last path is dropped).
+        returns the number of blobs removed """
+    def prune(self, max_age_days=30):
+        cutoff = time.time() - max_age_days * 86400
+        removed = 0
+        try:
+            for prefix in os.listdir( self.store_dir ):
+                prefix_dir = os.path.join( self.store_dir, prefix )
+                for name in os.listdir( prefix_dir ):
+                    if "." in name:
+                        # reference lists and half linked blobs
+                        continue
+                    path = os.path.join( prefix_dir, name )
+                    st = os.stat( path )
+                    if st.st_nlink > 1:
+                        continue
+                    refs_path = self.refs_path( path )
+                    if os.path.exists( refs_path ):
+                        if self.refs_in_use( path ) or os.stat( refs_path ).st_mtime >= cutoff:
+                            continue
+                        os.remove( refs_path )
+                    elif st.st_ctime >= cutoff:
+                        continue
+                    os.remove( path )
+                    removed += 1
+        except OSError as e:
+            print("(Warn) blob store prune stopped : "+str(e) )
+        return removed
+
+# end BlobStore
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
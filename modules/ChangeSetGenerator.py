@@ -11,11 +11,29 @@
 #
 # Produces a change_set which has is a list of dicts of the following keys:
 #
-#   'change'    :   new, update, remove
+#   'change'    :   new, upgrade, downgrade, remove
 #   'pkgInfoNew':   package info for the new package comming in.  'None' for a remove package action..
 #   'pkgInfoOld':   package info for the old package getting removed. 'None' for a new package action.
+#   'state'     :   queued
 #
-#   pkginfo is a dict with the following keys ( see: PkgDBPuller.py )
+# Packages are matched between the two lists on (pkgName, pkgArch) using a hash index,
+# the lists do not need to be sorted and may carry several versions of one package.
+#
+# Versions are ordered like dpkg does it ( see DebVersion.py ), a version change is an "upgrade"
+# when the new version sorts after the old one and a "downgrade" when the remote went back.
+# The sort keys of the versions that need ordering (changed pairs, pruned packages) are built in
+# one batch, the pairs are then compared as plain tuples.
+#
+# keep_versions=N only mirrors the N highest versions of each (pkgName, pkgArch) of the new list,
+# older versions are not fetched, and come out as "remove" entries when the local index has them.
+# Nothing deletes pool files, a "remove" only says the mirror no longer carries the version.
+# The published index has to leave the pruned versions out as well ( SyncJournal.publish with
+# the same keep_versions ), otherwise it lists files the mirror does not have.
+#
+# Each change_set entry is a ChangeSetEntry, a slotted mapping with just those four keys,
+# it reads and updates like the dict it replaces ( entry['state'] = "done" ).
+#
+#   pkginfo is a PkgRecord or dict with the following keys ( see: PkgDBPuller.py, PkgRecord.py )
 #       pkgName = the name of the package
 #       pkgArch = Architecture the package support (amd64 multi-arch arm etc..)
 #       pkgVer  = Version number for this package
@@ -24,130 +42,227 @@
 #
 ########################################################################################
 
+from collections.abc import Mapping, Sequence
+
+from DebVersion import version_keys
+
+CHANGE_SET_KEYS = ( 'change', 'pkgInfoNew', 'pkgInfoOld', 'state' )
+
+""" raise ValueError unless keep_versions is None (keep every version) or at least 1 """
+def check_keep_versions(keep_versions):
+    if keep_versions is not None and keep_versions < 1:
+        raise ValueError( "keep_versions must be at least 1, got "+str(keep_versions) )
+
+
+""" ( pkgName, pkgArch, pkgVer ) of every record of pkg_list, in order.
+    A PkgIndexView reads them straight from its mapping without building the PkgRecords. """
+def record_keys(pkg_list):
+    if hasattr( pkg_list, "record_keys" ):
+        return pkg_list.record_keys()
+    return ( ( entry['pkgName'], entry.get('pkgArch'), entry['pkgVer'] ) for entry in pkg_list )
+
+
+""" ( pkgName, pkgArch, pkgVer ) of every version in keys ( see record_keys ) that is not one of the
+    keep_versions highest versions of its (pkgName, pkgArch), what keep_versions pruning leaves out.
+    keys is walked once, the sort keys of the crowded packages are built in one batch. """
+def pruned_versions(keys, keep_versions):
+    check_keep_versions( keep_versions )
+    versions = {}
+    for name, arch, ver in keys:
+        entries = versions.get( ( name, arch ) )
+        if entries is None:
+            versions[ ( name, arch ) ] = { ver }
+        else:
+            entries.add( ver )
+
+    crowded = [ ( key, list( entries ) ) for key, entries in versions.items() if len( entries ) > keep_versions ]
+    batch = list( { ver for key, entries in crowded for ver in entries if ver is not None } )
+    keys = dict( zip( batch, version_keys( batch ) ) )
+    pruned = set()
+    for ( name, arch ), entries in crowded:
+        # entries without a version sort first
+        entries.sort( key=lambda ver: keys.get( ver, () ), reverse=True )
+        pruned.update( ( name, arch, ver ) for ver in entries[keep_versions:] )
+    return pruned
+
+
+class ChangeSetEntry(Mapping):
+    """ one change set entry, a mapping with the keys in CHANGE_SET_KEYS """
+    __slots__ = CHANGE_SET_KEYS
+    def __init__(self, change, pkg_info_new, pkg_info_old, state="queued"):
+        self.change = change
+        self.pkgInfoNew = pkg_info_new
+        self.pkgInfoOld = pkg_info_old
+        self.state = state
+
+    def __getitem__(self, key):
+        if key not in CHANGE_SET_KEYS:
+            raise KeyError( key )
+        return getattr( self, key )
+
+    """ entries are updated as they are worked through ( entry['state'] ) """
+    def __setitem__(self, key, value):
+        if key not in CHANGE_SET_KEYS:
+            raise KeyError( key )
+        setattr( self, key, value )
+
+    def __iter__(self):
+        return iter( CHANGE_SET_KEYS )
+
+    def __len__(self):
+        return len( CHANGE_SET_KEYS )
+
+    # mutable, like the dict it replaces
+    __hash__ = None
+
+    def __repr__(self):
+        return repr( dict( self.items() ) )
+
+# end ChangeSetEntry
+
 class ChangeSetGenerator:
-    """ compute the change set for 2 pkg_lists """
-    def __init__(self, pkg_list_new, pkg_list_current ):
+    """ compute the change set for 2 pkg_lists.
+        keep_versions is the number of versions of each package to keep (None keeps them all) """
+    def __init__(self, pkg_list_new, pkg_list_current, keep_versions=None ):
+        check_keep_versions( keep_versions )
         self.pkg_list_new = pkg_list_new      # remote
         self.pkg_list_old = pkg_list_current  # local
+        self.keep_versions = keep_versions
         self.change_set = []
         self.pkg_index_new = {}
         self.pkg_index_old = {}
+        self.version_keys = {}                # { pkgVer : sort key } of the versions ordered so far
 
     """ (INTERNAL) Generate a index hash to
-        speed up searches.  The pkg_lists should be 
-        in Alphabetical order.  Generate a index
-        for the start of each new alaphbet in the list.
-        This information is stored in a dict of { "alpha" : "list index" } """
-    def gen_dataset_index( self, pkg_list ):
-        pkg_index = { 'a':0 }
-        char_last = "a"
-        index = 0
-        for entry in pkg_list:
-            pkg_name = entry['pkgName']
-            if ( pkg_name[0] != char_last ):
-                # found next char index in list, update last
-                char_last = pkg_name[0]
-                # add to index_db
-                pkg_index[char_last] = index
-
-            # next entry
-            index = index + 1
-        
+        speed up searches.  Packages are keyed on (pkgName, pkgArch),
+        the pkg_list does not need to be in any order.
+        keys holds the ( pkgName, pkgArch, pkgVer ) of each record ( see record_keys ), positions
+        the positions in the list to index.  A key can hold more than one version of a package,
+        so each key maps to the list of positions in list order.
+        This information is stored in a dict of { (name, arch) : [ positions ] } """
+    def gen_dataset_index( self, keys, positions ):
+        pkg_index = {}
+        for position in positions:
+            name, arch, ver = keys[position]
+            entries = pkg_index.get( ( name, arch ) )
+            if entries is None:
+                pkg_index[ ( name, arch ) ] = [ position ]
+            else:
+                entries.append( position )
+
         # done generating index for database
         return pkg_index
 
-    """ (INTERNAL) fine the package "pkg_name" in the pkg_list
-        using the pkg_list_index that was generated to speed up
-        searches. """
-    def find_package_in_list( self, pkg_name, pkg_list, pkg_list_index ):
-        # dumb case if pkg_list is an empty set. (initial repo setup might do this..)
-        if ( len(pkg_list) < 1 ):
-            return -1 
-
-        # find index to start linear search
-        index = pkg_list_index[pkg_name[0]]
-        search_active = 1
-        while (search_active):
-            # does the current index give us a pkg_name match
-            if ( pkg_list[index]['pkgName'] == pkg_name ):
-                # found it
-                search_active = 0;
-                return index
-
-            # check to see have not run pass the search section
-            # verify that first char of current search index
-            # does match the first char of the package we are searching for
-            if ( pkg_list[index]['pkgName'][0] != pkg_name[0] ):
-                # first chars from search index pkgName does not match
-                # the frist char of the package we are looking for..
-                # entry must not be here.. (we assume alphabetical ordering in list)
-                return -1
-            
-            # Idiot check to make sure we don't overrun the end of the list
-            if (index > len(pkg_list) ):
-                # got here, item dose not exist in the list
-                return -1
-            
-            # search next index
-            index = index + 1
-
-    """ (INTERNAL) compute change set between to pkg_lists """
+    """ (INTERNAL) True if one of the positions (all the same name/arch) has version pkg_ver """
+    def find_version( self, pkg_ver, positions, keys ):
+        for position in positions:
+            if keys[position][2] == pkg_ver:
+                return True
+        return False
+
+    """ (INTERNAL) add the sort keys of the entries' versions to self.version_keys, in one batch """
+    def add_version_keys( self, entries ):
+        versions = list( { entry['pkgVer'] for entry in entries if entry['pkgVer'] is not None } - self.version_keys.keys() )
+        self.version_keys.update( zip( versions, version_keys( versions ) ) )
+
+    """ (INTERNAL) sort key of an entry's version, entries without a version sort first """
+    def entry_key( self, entry ):
+        return self.version_keys.get( entry['pkgVer'], () )
+
+    """ (INTERNAL) build a change set entry """
+    def new_change_set_entry( self, change, pkg_info_new, pkg_info_old ):
+        return ChangeSetEntry( change, pkg_info_new, pkg_info_old )
+
+    """ (INTERNAL) compute change set between to pkg_lists
+
+        Runs in linear time over both lists.  For each (pkgName, pkgArch) key:
+            versions present in both lists are left alone.
+            new versions are paired up with old versions that went away, in list order,
+                each pair is an "upgrade", or a "downgrade" when the new version is the lower one.
+            left over new versions are "new", left over old versions are "remove".
+        With keep_versions only the highest versions of the new list are taken into account. """
     def compute_change_set(self):
-        # entry for each change found
-        change_set_entry = {}
+        # records are tracked by their position in the lists, only their ( name, arch, version ) is
+        # read to diff.  A memory-mapped PkgIndexView hands those out without building PkgRecords,
+        # records are only fetched for the entries that go into the change set.
+        # one shot iterables (generators) can't be indexed, those are turned into lists first
+        if not isinstance( self.pkg_list_new, Sequence ):
+            self.pkg_list_new = list( self.pkg_list_new )
+        if not isinstance( self.pkg_list_old, Sequence ):
+            self.pkg_list_old = list( self.pkg_list_old )
+        new_keys = list( record_keys( self.pkg_list_new ) )
+        old_keys = list( record_keys( self.pkg_list_old ) )
+
+        new_positions = range( len( new_keys ) )
+        if self.keep_versions is not None:
+            pruned = pruned_versions( new_keys, self.keep_versions )
+            if pruned:
+                new_positions = [ position for position in new_positions if new_keys[position] not in pruned ]
 
         # compute search index for each package list.
-        self.pkg_index_old = self.gen_dataset_index( self.pkg_list_old )
-        self.pkg_index_new = self.gen_dataset_index( self.pkg_list_new )
+        self.pkg_index_old = self.gen_dataset_index( old_keys, range( len( old_keys ) ) )
+        self.pkg_index_new = self.gen_dataset_index( new_keys, new_positions )
+
+        # positions of old versions that are no longer in the new list, built per key on first use.
+        # these are handed out to upgrades in order, what is left over gets removed.
+        old_unmatched = {}
+        # version changes, classified once the loop is done
+        changed = []
 
         # look for new packages or updated packages in new vs old lists
-        for new_pkg_entry in self.pkg_list_new:
-            # see if we can find a matching package name in the old list
-            # print("evaluating package: " + str(new_pkg_entry['pkgName']) + " for changes..")
-            i = self.find_package_in_list( new_pkg_entry['pkgName'], self.pkg_list_old, self.pkg_index_old )
-
-            # if search does not return a hit, this package 
-            # is in the new list and not the old one, thus it is a new package
-            if ( i < 0 ):
-                # debug print
-                # print("     new package " + str(new_pkg_entry['pkgName']) + " found.." )
-                change_set_entry['change'] = "new"
-                change_set_entry['pkgInfoNew'] = new_pkg_entry
-                change_set_entry['pkgInfoOld'] = None
-                change_set_entry['state'] = "queued"
-                self.change_set.append( change_set_entry )
+        for position in new_positions:
+            name, arch, ver = new_keys[position]
+            key = ( name, arch )
+            old_positions = self.pkg_index_old.get( key )
+
+            if old_positions is None:
+                # package is in the new list and not the old one, thus it is a new package
+                self.change_set.append( self.new_change_set_entry( "new", self.pkg_list_new[position], None ) )
+                continue
+
+            if self.find_version( ver, old_positions, old_keys ):
+                # this version is already on the local mirror
+                continue
+
+            replaced = old_unmatched.get( key )
+            if replaced is None:
+                new_positions_of_key = self.pkg_index_new[key]
+                replaced = [ old_position for old_position in old_positions
+                             if not self.find_version( old_keys[old_position][2], new_positions_of_key, new_keys ) ]
+                old_unmatched[key] = replaced
+
+            if replaced:
+                # version change detected, mark as an updated package
+                # need to know details about the new and old package (filename, sha256 hash etc.. )
+                changed.append( self.new_change_set_entry( "upgrade", self.pkg_list_new[position], self.pkg_list_old[ replaced.pop(0) ] ) )
+                self.change_set.append( changed[-1] )
             else:
-                # package exists in old database as well as new database
-                # is the versions any different
-                if ( new_pkg_entry['pkgVer'] != self.pkg_list_old[i]['pkgVer'] ):
-                    # print("     update package " + str(new_pkg_entry['pkgName']) + " discovered..")
-                    # version change detected, mark as an updated package
-                    change_set_entry['change'] = "upgrade"
-                    # need to know details about the new package (filename, sha256 hash etc.. )
-                    change_set_entry['pkgInfoNew'] = new_pkg_entry 
-                    # need to know details about the old package (filename, sha256 hash etc.. )
-                    change_set_entry['pkgInfoOld'] = self.pkg_list_old[i]
-                    # define this change as queued
-                    self.change_set.append( change_set_entry )
-
-            change_set_entry = {}
+                # extra version of a package we already carry
+                self.change_set.append( self.new_change_set_entry( "new", self.pkg_list_new[position], None ) )
 
         # end new/update search
 
+        # the remote can go back a version too (a pulled update), compare the pairs
+        self.add_version_keys( [ entry['pkgInfoNew'] for entry in changed ] + [ entry['pkgInfoOld'] for entry in changed ] )
+        for entry in changed:
+            if self.entry_key( entry['pkgInfoNew'] ) < self.entry_key( entry['pkgInfoOld'] ):
+                entry['change'] = "downgrade"
+
         # Now to look for packages that have been deprecated. (removed from repository)
-        for old_pkg_entry in self.pkg_list_old:
-            # search for each package from old list in new list to see if it exists.
-            i = self.find_package_in_list( old_pkg_entry['pkgName'], self.pkg_list_new, self.pkg_index_new )
-            # only care if there is a matching package name or not..
-            if ( i < 0 ):
-                # means package name we are looking for does not exists in the new list. (was removed)
-                # print("     remove package " + str(old_pkg_entry['pkgName']) )
-                change_set_entry['change'] = "remove"
-                change_set_entry['pkgInfoNew'] = None
-                change_set_entry['pkgInfoOld'] = old_pkg_entry
-                self.change_set.append( change_set_entry )
-
-            change_set_entry = {}
+        # old versions not handed out to an upgrade are gone from the new list.
+        removed = { old_position for positions in old_unmatched.values() for old_position in positions }
+        # walk the old list so removes come out in the same order as before
+        for position, ( name, arch, ver ) in enumerate( old_keys ):
+            key = ( name, arch )
+            if key in old_unmatched:
+                if position not in removed:
+                    continue
+            else:
+                new_positions_of_key = self.pkg_index_new.get( key )
+                if new_positions_of_key is not None and self.find_version( ver, new_positions_of_key, new_keys ):
+                    continue
+            # means package we are looking for does not exists in the new list. (was removed)
+            self.change_set.append( self.new_change_set_entry( "remove", None, self.pkg_list_old[position] ) )
 
         #end old search
     # end compute_change_set
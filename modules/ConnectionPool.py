@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+################################################################################################
+# Mirror_Magic HTTP Connection Pool
+################################################################################################
+# ConnectionPool.py
+#
+# Keeps persistent (keep-alive) HTTP/HTTPS connections per host, so the Downloader only pays the
+# TCP (and TLS) handshake once per connection instead of once per .deb.
+#
+# The pool is shared by every thread.  A request checks an idle connection to its host out of the
+# pool (or opens a new one), the connection belongs to that thread until the response is done with
+# and is then handed back for the next request, from any thread.  Idle connections stay open between
+# threaded_downloader calls that share the pool, up to POOL_MAX_IDLE per host, until close_all().
+#
+# usage:
+#   pool = ConnectionPool()
+#   with pool.open( "http://archive.ubuntu.com/ubuntu/pool/main/s/stuff.deb" ) as response:
+#       data = response.read()
+#   print( pool.get_stats() )
+#
+# Connection reuse statistics ( get_stats() ):
+#   "requests"     -- requests sent through the pool
+#   "opened"       -- new connections opened (handshakes paid)
+#   "reused"       -- requests sent on an already open connection
+#   "dropped"      -- connections closed because the server or a partial read ended keep-alive
+#   "stale_retry"  -- requests resent because a kept-alive connection had been closed by the server
+#
+################################################################################################
+
+import threading
+import contextlib
+import http.client
+import urllib.error
+from urllib.parse import urlsplit, urljoin
+
+# socket timeout for pooled connections, in seconds
+POOL_TIMEOUT = 60
+
+# number of redirects followed before giving up on a request
+POOL_MAX_REDIRECTS = 5
+
+# idle connections kept per host, more than this are closed when they are handed back
+POOL_MAX_IDLE = 32
+
+# errors that mean a kept-alive connection was closed by the server between requests
+STALE_CONNECTION_ERRORS = ( http.client.RemoteDisconnected, http.client.BadStatusLine,
+                            ConnectionResetError, BrokenPipeError, ConnectionAbortedError )
+
+class ConnectionPool:
+    """ pool of persistent connections per (scheme, host), shared by all threads """
+    def __init__(self, timeout=POOL_TIMEOUT, max_idle=POOL_MAX_IDLE):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.lock = threading.Lock()     # guards idle, stats and all_connections
+        self.idle = {}                   # { (scheme, netloc) : [ idle connections ] }
+        self.all_connections = []
+        self.stats = { "requests" : 0, "opened" : 0, "reused" : 0, "dropped" : 0, "stale_retry" : 0 }
+
+    """ (Internal) bump a statistics counter """
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    """ (Internal) check a connection to scheme://netloc out of the pool, opening one if there is no
+        idle one (or fresh is set).  The caller has it to itself until release() or drop_connection().
+        returns ( connection, reused ) """
+    def get_connection(self, scheme, netloc, fresh=False):
+        with self.lock:
+            idle = self.idle.get( (scheme, netloc) )
+            if idle and not fresh:
+                # most recently used first, the least likely to have timed out on the server
+                return idle.pop(), True
+
+        if scheme == "https":
+            conn = http.client.HTTPSConnection( netloc, timeout=self.timeout )
+        else:
+            conn = http.client.HTTPConnection( netloc, timeout=self.timeout )
+        with self.lock:
+            self.all_connections.append( conn )
+            self.stats["opened"] += 1
+        return conn, False
+
+    """ (Internal) close a checked out connection and forget it """
+    def drop_connection(self, conn):
+        conn.close()
+        with self.lock:
+            if conn in self.all_connections:
+                self.all_connections.remove( conn )
+            self.stats["dropped"] += 1
+
+    """ (Internal) hand a checked out connection back to the pool for the next request """
+    def put_back(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault( key, [] )
+            if len( idle ) < self.max_idle and conn in self.all_connections:
+                idle.append( conn )
+                return
+            if conn in self.all_connections:
+                self.all_connections.remove( conn )
+        conn.close()
+
+    """ (Internal) send a GET for url on a pooled connection, follow redirects.
+        returns ( (scheme, netloc), connection, response ), raises urllib.error.HTTPError for error codes
+        and urllib.error.URLError when the host can not be reached """
+    def request(self, url, headers=None):
+        for redirect in range( POOL_MAX_REDIRECTS + 1 ):
+            parts = urlsplit( url )
+            if parts.scheme not in ( "http", "https" ):
+                raise urllib.error.URLError( "unsupported scheme for connection pool: "+str(parts.scheme) )
+            key = ( parts.scheme, parts.netloc )
+            path = parts.path or "/"
+            if parts.query:
+                path = path + "?" + parts.query
+
+            conn, reused = self.get_connection( *key )
+            self.count( "requests" )
+            try:
+                conn.request( "GET", path, headers=headers or {} )
+                response = conn.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                self.drop_connection( conn )
+                if not reused:
+                    raise urllib.error.URLError( "connection closed by "+parts.netloc )
+                # server closed an idle keep-alive connection, resend once on a fresh one
+                self.count( "stale_retry" )
+                conn, reused = self.get_connection( *key, fresh=True )
+                try:
+                    conn.request( "GET", path, headers=headers or {} )
+                    response = conn.getresponse()
+                except ( OSError, http.client.HTTPException ) as e:
+                    self.drop_connection( conn )
+                    raise urllib.error.URLError( e )
+            except ( OSError, http.client.HTTPException ) as e:
+                self.drop_connection( conn )
+                raise urllib.error.URLError( e )
+
+            if reused:
+                self.count( "reused" )
+
+            if response.status in ( 301, 302, 303, 307, 308 ) and response.getheader( "Location" ):
+                # drain the redirect body so the connection can be reused, then follow it
+                location = response.getheader( "Location" )
+                self.release( key, conn, response )
+                url = urljoin( url, location )
+                continue
+
+            if response.status >= 400:
+                self.release( key, conn, response )
+                raise urllib.error.HTTPError( url, response.status, response.reason, response.headers, None )
+
+            return key, conn, response
+
+        raise urllib.error.URLError( "too many redirects for "+str(url) )
+
+    """ (Internal) hand a connection back after its response is done with.
+        A response that was not read to the end leaves unread data on the socket,
+        that connection (and any the server asked to close) can not be reused. """
+    def release(self, key, conn, response):
+        if response.fp is not None and not response.will_close:
+            # try to drain small leftovers (error pages, redirect bodies)
+            try:
+                if response.length is not None and response.length <= 64 * 1024:
+                    response.read()
+            except ( OSError, http.client.HTTPException ):
+                pass
+
+        if response.fp is not None or response.will_close:
+            response.close()
+            self.drop_connection( conn )
+        else:
+            self.put_back( key, conn )
+
+    """ open url on a pooled connection.  context manager, yields the http.client.HTTPResponse
+        and returns the connection to the pool when the block is done """
+    @contextlib.contextmanager
+    def open(self, url, headers=None):
+        key, conn, response = self.request( url, headers )
+        try:
+            yield response
+        finally:
+            self.release( key, conn, response )
+
+    """ connection reuse statistics, a copy of the stats dict """
+    def get_stats(self):
+        with self.lock:
+            return dict( self.stats )
+
+    """ close every connection the pool opened, idle or checked out """
+    def close_all(self):
+        with self.lock:
+            connections = self.all_connections
+            self.all_connections = []
+            self.idle = {}
+        for conn in connections:
+            conn.close()
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
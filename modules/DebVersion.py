@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic DebVersion
+#############################################################################################################
+# DebVersion
+# Debian package version ordering ( [epoch:]upstream_version[-debian_revision] ), the same order dpkg
+# and apt use, done with precomputed sort keys so comparing versions is plain tuple comparison.
+#
+#   epoch       number before the first ':', 0 when there is none
+#   upstream    everything between the epoch and the last '-'
+#   revision    everything after the last '-', "" when there is none (same as "0")
+#
+# upstream and revision are compared dpkg style: alternating runs of non digits and digits, non digit
+# runs character by character ( '~' before anything, even the end of the run, then the end of the run,
+# then letters, then everything else ), digit runs as numbers.
+#
+# A sort key is ( epoch, upstream key, revision key ), a part key is the tuple
+#       ( non digit run weights, number, non digit run weights, number, .., ( 0, ) )
+# with the weights of a run being one int per character ( '~' = -1, letter = ord, other = ord + 256 )
+# followed by 0 for the end of the run, the trailing ( 0, ) stands in for the end of the part.
+# Keys are built once per distinct version string (cached), after that every compare, sort, min or
+# max runs in C.
+#
+# usage:
+#   compare_versions( "1:1.2-1", "1.3-1" )                  # 1, -1 or 0 like dpkg --compare-versions
+#   sorted( versions, key=version_key )
+#   keys = version_keys( [ record['pkgVer'] for record in pkg_list ] )
+#
+#############################################################################################################
+
+import functools
+
+# distinct version strings whose sort keys are kept around
+VERSION_KEY_CACHE = 1 << 18
+
+# weight of each character in a non digit run, characters not in here weigh ord + 256
+CHAR_WEIGHTS = { chr(c) : c for c in range( ord("A"), ord("Z")+1 ) }
+CHAR_WEIGHTS.update( { chr(c) : c for c in range( ord("a"), ord("z")+1 ) } )
+CHAR_WEIGHTS["~"] = -1
+
+# weight closing every non digit run, and the key closing every part
+END_OF_RUN = 0
+END_OF_PART = ( END_OF_RUN, )
+
+DIGITS = "0123456789"
+
+""" (Internal) key of an upstream version or revision string """
+def part_key(part):
+    key = []
+    i = 0
+    length = len( part )
+    while True:
+        # non digit run
+        start = i
+        while i < length and part[i] not in DIGITS:
+            i += 1
+        weights = [ CHAR_WEIGHTS.get( c ) or ord( c ) + 256 for c in part[start:i] ]
+        weights.append( END_OF_RUN )
+        # digit run, empty counts as 0
+        start = i
+        while i < length and part[i] in DIGITS:
+            i += 1
+        key.append( tuple( weights ) )
+        key.append( int( part[start:i] ) if i > start else 0 )
+        if i >= length:
+            break
+    key.append( END_OF_PART )
+    return tuple( key )
+
+
+""" sort key of a Debian version string, versions compare like dpkg when their keys are compared.
+    An epoch that is not a number is taken as 0 with the whole string as upstream version. """
+@functools.lru_cache( maxsize=VERSION_KEY_CACHE )
+def version_key(version):
+    version = version.strip()
+    epoch = 0
+    epoch_str, colon, rest = version.partition( ":" )
+    if colon and epoch_str.isdigit():
+        epoch = int( epoch_str )
+        version = rest
+    upstream, dash, revision = version.rpartition( "-" )
+    if not dash:
+        upstream, revision = revision, ""
+    return ( epoch, part_key( upstream ), part_key( revision ) )
+
+
+""" sort keys of a batch of version strings, in the same order.
+    Each distinct string is parsed once however often it turns up. """
+def version_keys(versions):
+    keys = {}
+    for version in versions:
+        if version not in keys:
+            keys[version] = version_key( version )
+    return [ keys[version] for version in versions ]
+
+
+""" compare two version strings, returns -1, 0 or 1 ( a < b, a == b, a > b ) """
+def compare_versions(a, b):
+    key_a = version_key( a )
+    key_b = version_key( b )
+    return ( key_a > key_b ) - ( key_a < key_b )
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
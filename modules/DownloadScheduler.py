@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+################################################################################################
+# Mirror_Magic Download Scheduler
+################################################################################################
+# DownloadScheduler.py
+#
+# Runs a Downloader job list like threaded_downloader does, but decides itself what runs when:
+#
+#   largest first   jobs are started in order of their "size" (biggest first), so a big .deb is
+#                   not the last thing left running at the end of a sync.  Jobs without a size
+#                   go after the ones with one.
+#   per host        each host gets its own concurrency limit.  It starts at initial_per_host and
+#   concurrency     is tuned from what the host delivers: after every window of finished jobs the
+#                   throughput is compared to the window before, one more connection is allowed
+#                   while that keeps paying off and one less when throughput drops.  A failed job
+#                   halves the limit (additive increase, multiplicative decrease).
+#   retries         a failed job goes back into the same worker pool after an exponential backoff
+#                   (with jitter), until max_trys.  The Downloader resumes its partial file.
+#   bandwidth cap   optional, bytes per second across all workers (token bucket).  Can be changed
+#                   while a run is going with set_bandwidth_cap(), None lifts it.
+#
+# usage:
+#   scheduler = DownloadScheduler( 16, bandwidth_cap=20*1024*1024 )
+#   failed_jobs_list = scheduler.run( job_list )
+#   print( scheduler.stats )
+#
+################################################################################################
+
+import os
+import time
+import heapq
+import random
+import threading
+import concurrent.futures
+from urllib.parse import urlsplit
+
+import Downloader
+from ConnectionPool import ConnectionPool
+
+# number of tries before a job is given up on
+SCHED_MAX_TRYS = 5
+
+# retry backoff: base * 2^(trys-1) seconds, at most BACKOFF_MAX
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# window throughput has to beat the last one by this much for the host to get another connection,
+# and drop below it by this much to lose one
+GROW_THRESHOLD = 1.05
+SHRINK_THRESHOLD = 0.80
+
+
+class TokenBucket:
+    """ thread safe token bucket, rate in bytes per second.
+        burst is how many bytes may go through at once after an idle spell (default: one second worth) """
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.set_rate( rate, burst )
+
+    """ change the rate (and burst) of the bucket """
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = float( rate )
+            self.burst = float( burst or rate )
+            self.tokens = self.burst
+            self.stamp = time.monotonic()
+
+    """ take n bytes worth of tokens, sleeps the calling thread until the bucket allows it.
+        Tokens may go into debt, so chunks bigger than the burst still get through at the rate. """
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min( self.burst, self.tokens + ( now - self.stamp ) * self.rate )
+            self.stamp = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep( wait )
+
+# end TokenBucket
+
+
+class HostState:
+    """ concurrency limit and throughput window for one host """
+    def __init__(self, limit):
+        self.limit = float( limit )
+        self.active = 0
+        self.ready = []             # heap of ( -size, seq, job ) waiting to run against this host
+        self.window_bytes = 0
+        self.window_done = 0
+        self.window_start = time.monotonic()
+        self.last_rate = None       # bytes per second of the last complete window
+        self.errors = 0
+
+    """ (Internal) start a new throughput window """
+    def reset_window(self):
+        self.window_bytes = 0
+        self.window_done = 0
+        self.window_start = time.monotonic()
+
+# end HostState
+
+
+class DownloadScheduler:
+    """ max_threads is the total number of downloads running at once (the worker pool size),
+        per host limits stay between min_per_host and max_per_host (default: max_threads).
+        bandwidth_cap is in bytes per second, None for no cap.
+        pool is an optional ConnectionPool, one is made (and closed) per run() if not given.
+        mirrors is an optional MirrorSelector to fetch the jobs through (hosts are still those of "src"),
+        it is not closed by run(), whoever made it closes it ( MirrorSelector.close ).
+        on_job_done is an optional callable, called in the run() thread with a job after each of its tries """
+    def __init__(self, max_threads, initial_per_host=4, min_per_host=1, max_per_host=None, bandwidth_cap=None,
+                 max_trys=SCHED_MAX_TRYS, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, pool=None, mirrors=None,
+                 on_job_done=None):
+        self.max_threads = max_threads
+        self.min_per_host = min_per_host
+        self.max_per_host = max_per_host or max_threads
+        self.initial_per_host = min( max( initial_per_host, min_per_host ), self.max_per_host )
+        self.max_trys = max_trys
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool = pool
+        self.mirrors = mirrors
+        self.on_job_done = on_job_done
+        self.bucket = None
+        self.set_bandwidth_cap( bandwidth_cap )
+        self.hosts = {}     # { netloc : HostState }
+        self.stats = {}
+
+    """ set (or with None, lift) the global bandwidth cap in bytes per second, takes effect right away """
+    def set_bandwidth_cap(self, bandwidth_cap):
+        if not bandwidth_cap:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket( bandwidth_cap )
+        else:
+            self.bucket.set_rate( bandwidth_cap )
+
+    """ (Internal) per chunk hook handed to the Downloader, looks the bucket up every time
+        so a cap set during a run applies to downloads already going """
+    def throttle(self, n):
+        bucket = self.bucket
+        if bucket is not None:
+            bucket.consume( n )
+
+    """ (Internal) host state for a job's source """
+    def host_of(self, job):
+        netloc = urlsplit( job['src'] ).netloc
+        host = self.hosts.get( netloc )
+        if host is None:
+            host = self.hosts[netloc] = HostState( self.initial_per_host )
+        return host
+
+    """ (Internal) worker pool job: run the Downloader on one job.
+        returns ( job, bytes fetched, seconds ) """
+    def run_job(self, job):
+        start = time.monotonic()
+        if self.mirrors is not None:
+            self.mirrors.fetch( job, self.pool, self.throttle )
+        else:
+            Downloader.fetcher( job, self.pool, self.throttle )
+        size = 0
+        if job['complete']:
+            try:
+                size = os.path.getsize( job['dst'] )
+            except OSError:
+                pass
+        return job, size, time.monotonic() - start
+
+    """ (Internal) queue a job to run against its host, biggest first """
+    def enqueue(self, job):
+        self.seq += 1
+        size = job.get('size') or 0
+        heapq.heappush( self.host_of( job ).ready, ( -size, self.seq, job ) )
+
+    """ (Internal) the host with room for another download whose next job is the biggest, None if none """
+    def pick_host(self):
+        best = None
+        for host in self.hosts.values():
+            if host.ready and host.active < int( host.limit ):
+                if best is None or host.ready[0] < best.ready[0]:
+                    best = host
+        return best
+
+    """ (Internal) tune a host's concurrency limit from a finished job """
+    def tune(self, host, ok, size):
+        if not ok:
+            host.errors += 1
+            host.limit = max( self.min_per_host, host.limit / 2 )
+            host.reset_window()
+            return
+        host.window_bytes += size
+        host.window_done += 1
+        if host.window_done < int( host.limit ):
+            return
+        # a window is as many jobs as the host may run at once
+        elapsed = max( time.monotonic() - host.window_start, 1e-6 )
+        rate = host.window_bytes / elapsed
+        if host.last_rate is None or rate >= host.last_rate * GROW_THRESHOLD:
+            host.limit = min( self.max_per_host, host.limit + 1 )
+        elif rate < host.last_rate * SHRINK_THRESHOLD:
+            host.limit = max( self.min_per_host, host.limit - 1 )
+        host.last_rate = rate
+        host.reset_window()
+
+    """ (Internal) seconds to wait before try number trys+1 of a job """
+    def backoff(self, trys):
+        delay = min( self.backoff_max, self.backoff_base * ( 2 ** max( trys - 1, 0 ) ) )
+        return delay * random.uniform( 0.5, 1.0 )
+
+    """ download every job in job_list.  returns the list of jobs that still failed after max_trys """
+    def run(self, job_list):
+        failed_jobs_list = []
+        own_pool = self.pool is None
+        if own_pool:
+            self.pool = ConnectionPool()
+        self.hosts = {}
+        self.seq = 0
+        self.stats = { "jobs" : len(job_list), "complete" : 0, "failed" : 0, "retries" : 0, "bytes" : 0 }
+        retry_heap = []     # ( due time, seq, job )
+        in_flight = {}      # { future : ( host, job ) }
+
+        for job in job_list:
+            self.enqueue( job )
+
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor( self.max_threads ) as tpe:
+            while in_flight or retry_heap or any( host.ready for host in self.hosts.values() ):
+                # retries whose backoff is over go back in line
+                now = time.monotonic()
+                while retry_heap and retry_heap[0][0] <= now:
+                    self.enqueue( heapq.heappop( retry_heap )[2] )
+
+                # fill the free workers, largest job of any host with room first
+                while len( in_flight ) < self.max_threads:
+                    host = self.pick_host()
+                    if host is None:
+                        break
+                    job = heapq.heappop( host.ready )[2]
+                    host.active += 1
+                    in_flight[ tpe.submit( self.run_job, job ) ] = ( host, job )
+
+                timeout = max( retry_heap[0][0] - time.monotonic(), 0 ) if retry_heap else None
+                if not in_flight:
+                    # only backed off retries left
+                    time.sleep( timeout or 0 )
+                    continue
+
+                done, not_done = concurrent.futures.wait( in_flight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED )
+                for future in done:
+                    host, job = in_flight.pop( future )
+                    host.active -= 1
+                    try:
+                        job, size, seconds = future.result()
+                    except Exception as e:
+                        # fetcher handles its own errors, this is a bug (a malformed src..), don't retry
+                        # but make sure the caller sees the job as failed
+                        print("(Warn) download worker failed for "+str(job.get('src'))+" : "+repr(e) )
+                        job['complete'] = False
+                        if self.on_job_done is not None:
+                            self.on_job_done( job )
+                        self.stats["failed"] += 1
+                        failed_jobs_list.append( job )
+                        continue
+
+                    self.tune( host, job['complete'], size )
+                    if self.on_job_done is not None:
+                        self.on_job_done( job )
+                    if job['complete']:
+                        self.stats["complete"] += 1
+                        self.stats["bytes"] += size
+                    elif job['trys'] < self.max_trys:
+                        self.stats["retries"] += 1
+                        self.seq += 1
+                        heapq.heappush( retry_heap, ( time.monotonic() + self.backoff( job['trys'] ), self.seq, job ) )
+                    else:
+                        self.stats["failed"] += 1
+                        failed_jobs_list.append( job )
+
+        self.stats["seconds"] = round( time.monotonic() - start, 3 )
+        self.stats["host_limits"] = { netloc : int( host.limit ) for netloc, host in self.hosts.items() }
+        print("Download scheduler stats: "+str( self.stats ) )
+        if own_pool:
+            print("Connection pool stats: "+str( self.pool.get_stats() ) )
+            self.pool.close_all()
+            self.pool = None
+
+        return failed_jobs_list
+
+# end DownloadScheduler
+
+
+""" drop in for threaded_downloader using a DownloadScheduler, extra keyword arguments go to DownloadScheduler """
+def scheduled_downloader( job_list, thread_count, pool=None, **options ):
+    return DownloadScheduler( thread_count, pool=pool, **options ).run( job_list )
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
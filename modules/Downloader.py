@@ -17,20 +17,178 @@
 #   "hash" -- SHA256 hash string in hex to validate downloaded file with.
 #   "complete" -- True or False
 #   "trys" -- a number of time we have tried to fetch this job 0 -- not tried yet..
+#   "size" -- (optional) expected size in bytes, used by the DownloadScheduler to order jobs
+#   "path" -- (optional) file path below the mirror root, used by the MirrorSelector
+#   "mirror" -- set by the MirrorSelector to the mirror the file came from
+#
+# http/https jobs are fetched over a ConnectionPool, the worker threads share its persistent
+# connections per host and reuse them for every job they run against that host.
+#
+# Downloads are streamed to "dst.part" in DOWNLOAD_CHUNK_SIZE chunks while the SHA256 is computed,
+# the .part file is renamed over "dst" only after the hash checks out.  A half written file
+# never shows up at the destination path.
+#
+# When a download dies part way the .part file and the hash state of its contents are kept.
+# The next try of that job (trys > 1) asks the server for the rest with a "Range: bytes=N-"
+# request, if the server answers with the whole file instead the download starts over.
+#
+# Backends, picked per call with download( job_list, concurrency, backend ):
+#   "threaded"  -- threaded_downloader, a thread per download in flight (default)
+#   "scheduled" -- DownloadScheduler, threads with per host concurrency tuning, retries and a bandwidth cap
+#   "async"     -- AsyncDownloader, one asyncio event loop for hundreds of transfers in flight
+#
+# threaded and scheduled can spread the jobs over several mirrors of the archive ( mirrors=
+# a MirrorSelector ), with failover and hedged requests for slow downloads, and share a
+# ConnectionPool between calls ( pool= ).  async keeps its own connections and does not take either.
+#
+# Every try of a download is reported to the metrics registry ( see Metrics.py ) per host:
+# downloads_total{result}, download_bytes_total, download_retries_total, download_seconds,
+# download_ttfb_seconds (request sent to response headers in) and download_throughput_bytes.
 #
 #################################################################################################
 
+import os
 import concurrent.futures
 from random import randint
-import urllib
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from urllib.request import urlopen
+import http.client
 import hashlib
 import time
 
+from ConnectionPool import ConnectionPool
+from Metrics import metrics, RATE_BUCKETS
+
+# bytes read from the network and written to disk per step, bounds the memory used per worker
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+
+# partial downloads kept around for resuming: { part_path : ( bytes hashed, sha256 object ) }
+partial_state = {}
+partial_state_lock = threading.Lock()
+
+
+""" (Internal) stream a response into the file at path, DOWNLOAD_CHUNK_SIZE bytes at a time.
+    The SHA256 is updated chunk by chunk, so memory use is bounded by the chunk size
+    no matter how big the file is.  Returns the hashlib sha256 object.
+    With an offset the data is appended to the partial file and sha_gen must hold the hash
+    state of its first offset bytes.  If the transfer dies part way, the hash state of what
+    made it to disk is saved so a later try can resume from there.
+    throttle is an optional callable, called with the size of every chunk read (bandwidth caps). """
+def stream_to_file(response, path, sha_gen=None, offset=0, throttle=None):
+    if sha_gen is None:
+        sha_gen = hashlib.sha256()
+    length = offset
+    with open( path, "ab" if offset else "wb" ) as fh:
+        try:
+            while True:
+                chunk = response.read( DOWNLOAD_CHUNK_SIZE )
+                if not chunk:
+                    break
+                fh.write( chunk )
+                sha_gen.update( chunk )
+                length += len( chunk )
+                if throttle is not None:
+                    throttle( len( chunk ) )
+            if getattr( response, "length", None ):
+                # connection closed before Content-Length bytes arrived
+                raise http.client.IncompleteRead( b"", response.length )
+        except BaseException:
+            fh.flush()
+            save_partial( path, sha_gen, length )
+            raise
+        # make sure the data is on disk before it can be renamed into place
+        fh.flush()
+        os.fsync( fh.fileno() )
+    return sha_gen
+
+
+""" (Internal) remember the hash state of a partial download """
+def save_partial(path, sha_gen, length):
+    with partial_state_lock:
+        partial_state[path] = ( length, sha_gen.copy() )
+
+
+""" (Internal) pick up a partial download at path.
+    returns ( offset, sha256 object ) to carry on from, ( 0, None ) when there is nothing to resume.
+    When the saved hash state does not line up with the file on disk (or there is none) the
+    hash is rebuilt by reading the partial file back, local disk is cheaper than the network. """
+def resume_partial(path):
+    with partial_state_lock:
+        state = partial_state.pop( path, None )
+    try:
+        size = os.path.getsize( path )
+    except OSError:
+        return 0, None
+    if size == 0:
+        return 0, None
+    if state is not None and state[0] == size:
+        return size, state[1]
+
+    sha_gen = hashlib.sha256()
+    with open( path, "rb" ) as fh:
+        while True:
+            chunk = fh.read( DOWNLOAD_CHUNK_SIZE )
+            if not chunk:
+                break
+            sha_gen.update( chunk )
+    return size, sha_gen
+
+
+""" (Internal) throw away a partial download and its hash state, if there is one """
+def remove_part(path):
+    with partial_state_lock:
+        partial_state.pop( path, None )
+    try:
+        os.remove( path )
+    except FileNotFoundError:
+        pass
+
+
+""" (Internal) open src for reading, through the pool for http/https when there is one.
+    returns a context manager yielding the response """
+def open_source(src, headers, pool):
+    if pool is not None and src.startswith( ("http://", "https://") ):
+        # reuse this worker thread's persistent connection to the host
+        return pool.open( src, headers )
+    return urlopen( urllib.request.Request( src, headers=headers ) )
+
+
+""" (Internal) True if the response is the 206 partial content answer to a "Range: bytes=offset-" request """
+def range_honored(response, offset):
+    if getattr( response, "status", None ) != 206:
+        return False
+    content_range = response.headers.get( "Content-Range", "" )
+    return content_range.startswith( "bytes "+str(offset)+"-" )
+
+
+""" (Internal) report one try of a download to the metrics registry.
+    result is "ok", "hash_mismatch", "http_<code>", "url_error", "protocol_error" or "io_error",
+    ttfb is None when no response came back, nbytes the bytes received by this try """
+def record_download(src, result, seconds, ttfb, nbytes, trys):
+    host = urllib.parse.urlsplit( src ).netloc or "local"
+    metrics.inc( "downloads_total", host=host, result=result )
+    metrics.inc( "download_bytes_total", nbytes, host=host )
+    if trys > 1:
+        metrics.inc( "download_retries_total", host=host )
+    metrics.observe( "download_seconds", seconds, host=host )
+    if ttfb is not None:
+        metrics.observe( "download_ttfb_seconds", ttfb, host=host )
+    if result == "ok" and seconds > 0:
+        metrics.observe( "download_throughput_bytes", nbytes / seconds, RATE_BUCKETS, host=host )
+
 
 """ fetches on file per call 
     job_data should a dict with "src", "dst", and "hash" keys defined 
-    called as part of a ThreadPoolExecutor """
-def fetcher(job):
+    called as part of a ThreadPoolExecutor
+    pool is an optional ConnectionPool used for http/https sources
+    throttle is an optional callable passed on to stream_to_file (see DownloadScheduler)
+    A retry of a job (trys > 1, complete False) resumes the partial file left by the last try
+    with an HTTP Range request, and falls back to a full fetch if the server ignores the range. """
+def fetcher(job, pool=None, throttle=None):
     # update try counter for this job
     job['trys'] += 1
  
@@ -47,33 +205,75 @@ def fetcher(job):
     else:
         # this is real
         print("Fetching: "+str(job['src']))
-        # use urllib to download file and save to local filesystem
+        # use urllib to download file, streaming it to a .part file next to dst.
+        # the .part file only gets renamed to dst once its SHA256 checks out.
+        part_path = job['dst'] + ".part"
+        start = time.perf_counter()
+        ttfb = None
+        received = [ 0 ]
+        def counted(n):
+            received[0] += n
+            if throttle is not None:
+                throttle( n )
         try:
-            sha_gen = hashlib.sha256()
-            response = urlopen( job['src'] )
-            file_data = response.read()
-            sha_gen.update(file_data)
-            
+            dst_dir = os.path.dirname( job['dst'] )
+            if dst_dir:
+                os.makedirs( dst_dir, exist_ok=True )
+
+            offset, sha_gen = 0, None
+            if job['trys'] > 1 and not job['complete']:
+                # retry, carry on from where the last try got to
+                offset, sha_gen = resume_partial( part_path )
+
+            headers = {}
+            if offset:
+                print("Resuming: "+str(job['src'])+" from byte "+str(offset) )
+                headers['Range'] = "bytes="+str(offset)+"-"
+
+            with open_source( job['src'], headers, pool ) as response:
+                ttfb = time.perf_counter() - start
+                if offset and not range_honored( response, offset ):
+                    # server sent the whole file, start again from byte zero
+                    offset, sha_gen = 0, None
+                sha_gen = stream_to_file( response, part_path, sha_gen, offset, counted )
+
             if ( sha_gen.hexdigest() == job['hash'] ):
-                # we have good data, save to dst
-                fh = open( job['dst'], "wb" )
-                fh.write( file_data )
+                # we have good data, move it into place
+                os.replace( part_path, job['dst'] )
                 job['complete'] = True
+                result = "ok"
             else:
-                # bad SHA Hash
+                # bad SHA Hash, the partial data can't be trusted either
+                print("Download hash mismatch: "+str(job['src']) )
+                remove_part( part_path )
                 job['complete'] = False
+                result = "hash_mismatch"
 
+        except urllib.error.HTTPError as e:
+            print("Download http error #"+str(e.code) )
+            if e.code == 416:
+                # range not satisfiable, the partial file does not match the remote one
+                remove_part( part_path )
+            job['complete'] = False
+            result = "http_"+str(e.code)
+ 
         except urllib.error.URLError as e:
             print("Download error: "+str(e.reason) )
             job['complete'] = False
- 
-        except urllib.error.HTTPError as e:
-            print("Download http error #"+str(e.code) )
+            result = "url_error"
+
+        except http.client.HTTPException as e:
+            # connection dropped mid response (IncompleteRead etc..), the partial file is kept
+            print("Download http protocol error: "+repr(e) )
             job['complete'] = False
+            result = "protocol_error"
  
         except IOError as e:
             print("Download IO Error: "+str(e) )
             job['complete'] = False
+            result = "io_error"
+
+        record_download( job['src'], result, time.perf_counter() - start, ttfb, received[0], job['trys'] )
 
     # return job status to query
     return job
@@ -87,20 +287,59 @@ def fetcher(job):
         "dst"  -- dst filepath/name to save downloaded file too. (ex: /opt/mirror_magic/stuff.deb )
         "hash" -- SHA256 hash string in hex to validate downloaded file with.
         "complete" -- True (file download successfull), False ( Need a refetch )
+    pool is an optional ConnectionPool shared by the worker threads, pass the same pool
+    to every call (retries) to keep connections open between calls.  When no pool is given
+    one is made for this call, its reuse statistics are printed and it is closed at the end.
+    mirrors is an optional MirrorSelector, jobs are then fetched from the best of its mirrors.
+    It stays open for the next call, whoever made it closes it ( MirrorSelector.close ).
+    on_job_done is an optional callable, called in the calling thread with each job as it finishes
+    (complete or not), ex: SyncJournal.job_done
     """  
-def threaded_downloader( job_list, thread_count ):
+def threaded_downloader( job_list, thread_count, pool=None, mirrors=None, on_job_done=None ):
     failed_jobs_list = []
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool()
     tpe = concurrent.futures.ThreadPoolExecutor(thread_count)
-    future_to_job = ( tpe.submit(fetcher, job) for job in job_list )
+    fetch = mirrors.fetch if mirrors is not None else fetcher
+    future_to_job = ( tpe.submit(fetch, job, pool) for job in job_list )
     for future in concurrent.futures.as_completed(future_to_job):
+        if on_job_done is not None:
+            on_job_done( future.result() )
         if future.result()['complete'] == False :
             failed_jobs_list.append( future.result() )         
 
     # wait for jobs to finish
     tpe.shutdown(wait=True)
 
+    if own_pool:
+        print("Connection pool stats: "+str(pool.get_stats()) )
+        pool.close_all()
+    if mirrors is not None:
+        print("Mirror stats: "+str(mirrors.get_stats()) )
+
     # return list of failed jobs
     return failed_jobs_list
+
+
+# download backends download() can hand a job list to
+DOWNLOAD_BACKENDS = ( "threaded", "scheduled", "async" )
+
+""" run a job list on the download backend picked by name (see DOWNLOAD_BACKENDS).
+    concurrency is the thread count (threaded, scheduled) or the number of transfers in flight (async),
+    extra keyword arguments go to the backend, pool and mirrors only to threaded and scheduled
+    (async raises ValueError for them).  returns the list of failed jobs """
+def download( job_list, concurrency, backend="threaded", **options ):
+    # the other backends build on this module, so they are imported when picked
+    if backend == "threaded":
+        return threaded_downloader( job_list, concurrency, **options )
+    if backend == "scheduled":
+        from DownloadScheduler import scheduled_downloader
+        return scheduled_downloader( job_list, concurrency, **options )
+    if backend == "async":
+        from AsyncDownloader import async_downloader
+        return async_downloader( job_list, concurrency, **options )
+    raise ValueError( "unknown download backend: "+str(backend) )
     
 
 job_selftest = 0     
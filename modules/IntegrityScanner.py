@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic IntegrityScanner
+#############################################################################################################
+# IntegrityScanner
+# Checks that the pool files of the local mirror still match the pkgHash of the Packages indexes we
+# publish, without downloading anything.
+#
+#   indexes     every (dist, section, arch) of a mirror spec (same dict as MirrorPipeline takes) is read
+#               from the parse cache when it has it, streamed through PkgDBPuller otherwise.  Records
+#               go by one at a time, a pool file listed by several indexes is checked once.
+#   hashing     files are hashed by a pool of worker threads, hashlib and file reads let go of the GIL
+#               so the workers really run on every core.  At most workers x SCAN_WINDOW files are in
+#               flight, memory stays flat however big the mirror is.
+#   scan cache  what a file hashed to is remembered in SQLite ( ${lmr_path}/.scancache.db ) against
+#               its size/mtime/inode.  A later scan only hashes files whose stamp changed (rehash=True
+#               hashes everything, for bit rot that leaves the stamp alone).
+#   results     missing and corrupt files are kept as records ( self.bad ), job_list() turns them into
+#               a Downloader job list through the JobPlanner.
+#
+# usage:
+#   scanner = IntegrityScanner( remote_mirror_root_url, local_mirror_root_path )
+#   scanner.scan( spec )
+#   failed_jobs_list = threaded_downloader( scanner.job_list(), 16 )
+#
+#############################################################################################################
+
+import os
+import time
+import sqlite3
+import concurrent.futures
+
+from PkgDBPuller import PkgDBPuller
+from JobPlanner import JobPlanner
+from BlobStore import hash_file
+
+# files in flight per worker thread
+SCAN_WINDOW = 4
+
+# cache rows written per transaction
+SCAN_COMMIT_EVERY = 1000
+
+""" (Internal) worker thread: stat a pool file and hash it unless the cached row still matches.
+    cached is ( size, mtime_ns, inode, sha256 ) or None.
+    returns ( stamp, sha256, hashed ), stamp is None when the file is missing """
+def check_file(path, cached, rehash):
+    try:
+        st = os.stat( path )
+    except FileNotFoundError:
+        return None, None, False
+    stamp = ( st.st_size, st.st_mtime_ns, st.st_ino )
+    if cached is not None and not rehash and tuple( cached[:3] ) == stamp:
+        return stamp, cached[3], False
+    return stamp, hash_file( path ), True
+
+
+class IntegrityScanner:
+    """ when this class is initialized, it needs to know
+        the url to the remote mirror root (for the job list) and
+        the path to the local mirror root.
+        workers is the number of hashing threads (default: one per core),
+        blob_store an optional BlobStore, blobs sharing the inode of a corrupt file are dropped from it """
+    def __init__(self, remote_mirror_root_url, local_mirror_root_path, workers=None, blob_store=None):
+        self.rmr_url = remote_mirror_root_url
+        self.lmr_path = local_mirror_root_path
+        self.workers = workers or os.cpu_count() or 1
+        self.blob_store = blob_store
+        self.puller = PkgDBPuller( remote_mirror_root_url, local_mirror_root_path )
+        self.cache_path = local_mirror_root_path.rstrip("/")+"/.scancache.db"
+        self.bad = []       # [ ( "missing" or "corrupt", PkgRecord ) ] from the last scan
+        self.stats = {}
+
+    """ (Internal) open the scan cache, creating it when needed """
+    def open_cache(self):
+        db = sqlite3.connect( self.cache_path )
+        db.execute( "CREATE TABLE IF NOT EXISTS verified ( path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,"
+                    " inode INTEGER, sha256 TEXT, checked_at REAL )" )
+        return db
+
+    """ (Internal) records of the local index for dist/section/arch, from the parse cache if it has them """
+    def index_records(self, vendor, dist, arch, section):
+        db_path = self.lmr_path+self.puller.pkg_db_subpath( dist, arch, section )+self.puller.pkg_db_filename( vendor )
+        if not os.path.exists( db_path ):
+            print("(Skip) no local index for "+dist+"/"+section+"/"+arch )
+            return
+        view = self.puller.index_cache.load( self.puller.index_cache.file_hash( db_path ) )
+        if view is None:
+            yield from self.puller.stream_parse_local( vendor, dist, arch, section )
+            return
+        try:
+            yield from view
+        finally:
+            view.close()
+
+    """ (Internal) every record of every index in a mirror spec """
+    def spec_records(self, spec):
+        vendor = spec.get('vendor', "ubuntu")
+        for dist in spec['dists']:
+            for section in spec['sections']:
+                for arch in spec['arches']:
+                    yield from self.index_records( vendor, dist, arch, section )
+
+    """ (Internal) a file is bad, remember it and make sure the blob store does not hand it out again """
+    def mark_bad(self, kind, record, path):
+        self.stats[kind] += 1
+        self.bad.append( ( kind, record ) )
+        print("(Warn) "+kind+" pool file: "+str(path) )
+        if kind == "corrupt" and self.blob_store is not None:
+            blob = self.blob_store.blob_path( record['pkgHash'] )
+            try:
+                if os.path.samefile( blob, path ):
+                    os.remove( blob )
+            except OSError:
+                pass
+
+    """ Verify every pool file listed by the local indexes of a mirror spec.
+        rehash hashes every file even when the scan cache says it has not changed.
+        returns the stats dict, the bad files are in self.bad """
+    def scan(self, spec, rehash=False):
+        self.bad = []
+        self.stats = { "files" : 0, "ok" : 0, "missing" : 0, "corrupt" : 0, "hashed" : 0, "cached" : 0, "bytes_hashed" : 0 }
+        start = time.perf_counter()
+        seen = set()
+        pending = {}    # { future : ( record, path ) }
+        db = self.open_cache()
+        updates = []
+
+        """ (Internal) fold a finished check into the stats and the cache """
+        def finish(future):
+            record, path = pending.pop( future )
+            stamp, sha, hashed = future.result()
+            if stamp is None:
+                self.mark_bad( "missing", record, path )
+                return
+            if hashed:
+                self.stats["hashed"] += 1
+                self.stats["bytes_hashed"] += stamp[0]
+                if sha is not None:
+                    updates.append( ( path, stamp[0], stamp[1], stamp[2], sha, time.time() ) )
+            else:
+                self.stats["cached"] += 1
+            if sha == record['pkgHash']:
+                self.stats["ok"] += 1
+            else:
+                self.mark_bad( "corrupt", record, path )
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor( self.workers ) as tpe:
+                for record in self.spec_records( spec ):
+                    pkg_file = record.get('pkgFile')
+                    if pkg_file is None or record.get('pkgHash') is None or pkg_file in seen:
+                        continue
+                    seen.add( pkg_file )
+                    self.stats["files"] += 1
+
+                    path = self.lmr_path.rstrip("/")+"/"+pkg_file
+                    cached = db.execute( "SELECT size, mtime_ns, inode, sha256 FROM verified WHERE path = ?", ( path, ) ).fetchone()
+                    pending[ tpe.submit( check_file, path, cached, rehash ) ] = ( record, path )
+
+                    if len( pending ) >= self.workers * SCAN_WINDOW:
+                        done, not_done = concurrent.futures.wait( pending, return_when=concurrent.futures.FIRST_COMPLETED )
+                        for future in done:
+                            finish( future )
+                    if len( updates ) >= SCAN_COMMIT_EVERY:
+                        db.executemany( "INSERT OR REPLACE INTO verified VALUES ( ?, ?, ?, ?, ?, ? )", updates )
+                        db.commit()
+                        updates = []
+
+                for future in concurrent.futures.as_completed( list( pending ) ):
+                    finish( future )
+
+            db.executemany( "INSERT OR REPLACE INTO verified VALUES ( ?, ?, ?, ?, ?, ? )", updates )
+            db.commit()
+        finally:
+            db.close()
+
+        self.stats["seconds"] = round( time.perf_counter() - start, 3 )
+        print("Integrity scan: "+str( self.stats ) )
+        return self.stats
+
+    """ Downloader job list for the missing and corrupt files of the last scan.
+        planner is an optional JobPlanner to add them to (its blob store is used, files with a
+        good copy elsewhere on disk are linked instead of downloaded) """
+    def job_list(self, planner=None):
+        if planner is None:
+            planner = JobPlanner( self.rmr_url, self.lmr_path, blob_store=self.blob_store )
+        planner.add_change_set( [ { 'change' : "new", 'pkgInfoNew' : record, 'pkgInfoOld' : None }
+                                  for kind, record in self.bad ] )
+        return planner.plan()
+
+# end IntegrityScanner
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic JobPlanner
+#############################################################################################################
+# JobPlanner
+# Merges the change sets of every index of a mirror into one download job list for the Downloader.
+#
+# The same pool/ file turns up in many Packages indexes ("Architecture: all" packages are listed for
+# every arch, -updates and -security often carry the same version).  Queuing each index's change set
+# on its own would download those files several times.  The planner makes sure each byte is fetched
+# once per sync:
+#       jobs are deduplicated by pkgFile, a file listed by several indexes gets one job.
+#       files with the same pkgHash under different pkgFile paths are downloaded once, the other
+#           paths are hardlinked to it afterwards ( link_aliases ).
+#       files already on disk with a matching SHA256 get no job at all.
+#       with a BlobStore, files whose SHA256 the store has (under any path) are linked from it
+#           instead of downloaded.  Files found on disk and finished downloads are filed in it.
+#
+# usage:
+#   planner = JobPlanner( remote_mirror_root_url, local_mirror_root_path, blob_store=BlobStore( local_mirror_root_path+"/.blobs" ) )
+#   for result in pipeline.run( spec ):
+#       planner.add_change_set( result['change_set'] )
+#   job_list = planner.plan()
+#   failed_jobs_list = DownloadScheduler( 16 ).run( job_list )
+#   failed_jobs_list += planner.link_aliases()
+#
+# Jobs are Downloader job dicts ( "src", "dst", "hash", "size", "path", "complete", "trys" ),
+# "path" is the pool file below the mirror root, for fetching it from other mirrors (MirrorSelector).
+#
+#############################################################################################################
+
+import os
+import shutil
+import concurrent.futures
+
+from BlobStore import hash_file
+
+# change set entries whose new package has to be on the local mirror
+FETCH_CHANGES = ( "new", "upgrade", "downgrade" )
+
+
+class JobPlanner:
+    """ when this class is initialized, it needs to know
+        the url to the remote mirror root and
+        the path to the local mirror root.
+        hash_threads is the number of files hashed at once when checking what is already on disk,
+        blob_store an optional BlobStore to take files from before downloading them """
+    def __init__(self, remote_mirror_root_url, local_mirror_root_path, hash_threads=4, blob_store=None):
+        self.rmr_url = remote_mirror_root_url
+        self.lmr_path = local_mirror_root_path
+        self.hash_threads = hash_threads
+        self.blob_store = blob_store
+        self.files = {}     # { pkgFile : pkgHash } every file wanted, first index to list it wins
+        self.sizes = {}     # { pkgFile : pkgSize } when the index gave one
+        self.by_hash = {}   # { pkgHash : pkgFile } first file seen with each hash
+        self.aliases = []   # [ ( pkgFile, pkgFile it shares its content with ) ]
+        self.planned = {}   # { pkgFile : job } from the last plan()
+        self.stats = { "entries" : 0, "duplicate_file" : 0, "duplicate_hash" : 0, "conflicts" : 0, "present" : 0, "from_blobs" : 0, "jobs" : 0 }
+
+    """ (Internal) Downloader job dict for a pool file """
+    def make_job(self, pkg_file, pkg_hash):
+        return { 'src'      : self.rmr_url.rstrip("/")+"/"+pkg_file,
+                 'dst'      : self.lmr_path.rstrip("/")+"/"+pkg_file,
+                 'hash'     : pkg_hash,
+                 'size'     : self.sizes.get( pkg_file ),
+                 'path'     : pkg_file,
+                 'complete' : False,
+                 'trys'     : 0 }
+
+    """ merge a ChangeSetGenerator change set into the plan """
+    def add_change_set(self, change_set):
+        for entry in change_set:
+            if entry['change'] not in FETCH_CHANGES:
+                continue
+            self.stats["entries"] += 1
+            pkg_info = entry['pkgInfoNew']
+            pkg_file = pkg_info['pkgFile']
+            pkg_hash = pkg_info['pkgHash']
+
+            known_hash = self.files.get( pkg_file )
+            if known_hash is not None:
+                if known_hash != pkg_hash:
+                    # two indexes disagree about a pool file, keep the first one we saw
+                    print("(Warn) conflicting SHA256 for "+str(pkg_file)+" keeping "+str(known_hash) )
+                    self.stats["conflicts"] += 1
+                else:
+                    self.stats["duplicate_file"] += 1
+                continue
+
+            self.files[pkg_file] = pkg_hash
+            if pkg_info.get('pkgSize') is not None:
+                self.sizes[pkg_file] = pkg_info['pkgSize']
+            first_file = self.by_hash.get( pkg_hash )
+            if first_file is None:
+                self.by_hash[pkg_hash] = pkg_file
+            else:
+                # same content under another path, fetch once and link
+                self.aliases.append( ( pkg_file, first_file ) )
+                self.stats["duplicate_hash"] += 1
+
+    """ (Internal) True if the file for pkg_file is on disk and its SHA256 matches """
+    def present(self, pkg_file):
+        path = self.lmr_path.rstrip("/")+"/"+pkg_file
+        return os.path.exists( path ) and hash_file( path ) == self.files[pkg_file]
+
+    """ build the deduplicated job list.
+        Files already on the local mirror with a matching hash are left out, those checks are
+        hashed hash_threads at a time (hashlib lets go of the GIL while it works).
+        With a blob store, present files are filed in it and files it has are linked from it. """
+    def plan(self):
+        alias_files = { pkg_file for pkg_file, first_file in self.aliases }
+        candidates = [ pkg_file for pkg_file in self.files if pkg_file not in alias_files ]
+
+        with concurrent.futures.ThreadPoolExecutor( self.hash_threads ) as tpe:
+            on_disk = dict( zip( candidates, tpe.map( self.present, candidates ) ) )
+
+        self.planned = {}
+        for pkg_file in candidates:
+            path = self.lmr_path.rstrip("/")+"/"+pkg_file
+            if on_disk[pkg_file]:
+                self.stats["present"] += 1
+                if self.blob_store is not None:
+                    self.blob_store.add( path, self.files[pkg_file] )
+                continue
+            if self.blob_store is not None and self.blob_store.materialize( self.files[pkg_file], path ):
+                # same content is already on this machine, no download needed
+                self.stats["from_blobs"] += 1
+                continue
+            self.planned[pkg_file] = self.make_job( pkg_file, self.files[pkg_file] )
+
+        self.stats["jobs"] = len( self.planned )
+        print("Job planner: "+str( self.stats ) )
+        return list( self.planned.values() )
+
+    """ after the download, give every aliased path the content of the file it shares its hash with.
+        Hardlinks where the filesystem allows, copies otherwise.  Finished downloads are filed in
+        the blob store first (the Downloader checked their hash).
+        returns job dicts for aliases that could not be satisfied (their source failed to download),
+        to be fetched on their own """
+    def link_aliases(self):
+        if self.blob_store is not None:
+            for job in self.planned.values():
+                if job['complete']:
+                    self.blob_store.add( job['dst'], job['hash'] )
+
+        failed_jobs_list = []
+        for pkg_file, first_file in self.aliases:
+            dst = self.lmr_path.rstrip("/")+"/"+pkg_file
+            src = self.lmr_path.rstrip("/")+"/"+first_file
+            job = self.planned.get( first_file )
+            if job is not None and not job['complete']:
+                failed_jobs_list.append( self.make_job( pkg_file, self.files[pkg_file] ) )
+                continue
+            if os.path.exists( dst ) and hash_file( dst ) == self.files[pkg_file]:
+                continue
+            try:
+                os.makedirs( os.path.dirname( dst ), exist_ok=True )
+                if os.path.exists( dst ):
+                    os.remove( dst )
+                try:
+                    os.link( src, dst )
+                except OSError:
+                    # cross device or no hardlink support
+                    shutil.copy2( src, dst )
+            except IOError as e:
+                print("(Warn) could not link "+str(dst)+" to "+str(src)+" : "+str(e) )
+                failed_jobs_list.append( self.make_job( pkg_file, self.files[pkg_file] ) )
+        return failed_jobs_list
+
+# end JobPlanner
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
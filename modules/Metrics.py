@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic Metrics
+#############################################################################################################
+# Metrics
+# Process wide, thread safe registry of the numbers a sync produces, so we can see where the time goes.
+#
+#   counters    only go up ( downloads_total, download_bytes_total, hash_bytes_total, .. )
+#   histograms  durations and rates, kept as count/sum/min/max plus cumulative buckets
+#               ( index_fetch_seconds, decompress_seconds, parse_seconds, diff_seconds,
+#                 download_seconds, download_ttfb_seconds, download_throughput_bytes, hash_seconds, .. )
+#   gauges      last value set ( inflight downloads, .. )
+# Every metric can carry labels ( host="archive.ubuntu.com", status="fetched" ), one series per label set.
+#
+# The modules report into the shared registry ( from Metrics import metrics ).  Parse workers run in
+# other processes, they hand back metrics.drain() with their result and the parent merge()s it.
+#
+# Output
+#   metrics.report()                dict of everything, for a machine readable per run report
+#   metrics.write_report( path )    that report as JSON, with the profiles if profiling was on
+#   metrics.prometheus_text()       Prometheus text exposition format (names prefixed mirror_magic_)
+#   metrics.serve( port )           /metrics endpoint on localhost for Prometheus to scrape
+#   with metrics.profiling( cpu=True, memory=True ):
+#                                   cProfile and/or tracemalloc around a block, the top entries end
+#                                   up in the report
+#
+#############################################################################################################
+
+import io
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+import http.server
+
+# prefix of every exported metric name
+METRIC_PREFIX = "mirror_magic_"
+
+# histogram buckets (upper bounds) for durations in seconds
+SECONDS_BUCKETS = ( 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0 )
+
+# histogram buckets for rates in bytes per second, 64KiB/s .. 1GiB/s
+RATE_BUCKETS = tuple( 64 * 1024 * 4 ** n for n in range( 8 ) )
+
+# entries kept from the cProfile and tracemalloc results
+PROFILE_TOP = 30
+
+class Histogram:
+    """ count/sum/min/max and cumulative bucket counts of observed values """
+    __slots__ = ( "buckets", "counts", "count", "sum", "min", "max" )
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [ 0 ] * len( buckets )
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min( self.min, value )
+        self.max = value if self.max is None else max( self.max, value )
+        for i, bound in enumerate( self.buckets ):
+            if value <= bound:
+                self.counts[i] += 1
+
+    """ fold in another histogram (same buckets) as a dict from as_dict() """
+    def merge(self, data):
+        self.count += data['count']
+        self.sum += data['sum']
+        for value in ( data['min'], data['max'] ):
+            if value is not None:
+                self.min = value if self.min is None else min( self.min, value )
+                self.max = value if self.max is None else max( self.max, value )
+        for i, n in enumerate( data['counts'] ):
+            self.counts[i] += n
+
+    def as_dict(self):
+        return { 'count' : self.count, 'sum' : self.sum, 'min' : self.min, 'max' : self.max,
+                 'avg' : self.sum / self.count if self.count else None,
+                 'buckets' : list( self.buckets ), 'counts' : list( self.counts ) }
+
+# end Histogram
+
+
+class Metrics:
+    """ registry of counters, histograms and gauges, keyed by ( name, sorted labels ) """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.profiles = {}
+
+    """ (Internal) series key for a name and its labels """
+    def key(self, name, labels):
+        return ( name, tuple( sorted( ( k, str(v) ) for k, v in labels.items() ) ) )
+
+    """ add value to a counter """
+    def inc(self, name, value=1, **labels):
+        key = self.key( name, labels )
+        with self.lock:
+            self.counters[key] = self.counters.get( key, 0 ) + value
+
+    """ record a value in a histogram, buckets are fixed by the first observation of the series """
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        key = self.key( name, labels )
+        with self.lock:
+            histogram = self.histograms.get( key )
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram( buckets )
+            histogram.observe( value )
+
+    """ set a gauge """
+    def set_gauge(self, name, value, **labels):
+        key = self.key( name, labels )
+        with self.lock:
+            self.gauges[key] = value
+
+    """ time a block into a seconds histogram:  with metrics.timer( "diff_seconds" ): ... """
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe( name, time.perf_counter() - start, **labels )
+
+    """ (Internal) the registry as plain data ( lists of [ name, labels, value ] ) """
+    def snapshot(self):
+        with self.lock:
+            return { 'counters'   : [ [ name, dict(labels), value ] for ( name, labels ), value in self.counters.items() ],
+                     'histograms' : [ [ name, dict(labels), h.as_dict() ] for ( name, labels ), h in self.histograms.items() ],
+                     'gauges'     : [ [ name, dict(labels), value ] for ( name, labels ), value in self.gauges.items() ] }
+
+    """ snapshot and reset, for worker processes to hand their metrics back to the parent """
+    def drain(self):
+        data = self.snapshot()
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.gauges = {}
+        return data
+
+    """ fold in a drain() from another process """
+    def merge(self, data):
+        if not data:
+            return
+        for name, labels, value in data['counters']:
+            self.inc( name, value, **labels )
+        for name, labels, value in data['gauges']:
+            self.set_gauge( name, value, **labels )
+        for name, labels, h in data['histograms']:
+            key = self.key( name, labels )
+            with self.lock:
+                histogram = self.histograms.get( key )
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram( tuple( h['buckets'] ) )
+                histogram.merge( h )
+
+    """ cProfile (cpu) and/or tracemalloc (memory) around a block, the results go in the report """
+    @contextlib.contextmanager
+    def profiling(self, cpu=True, memory=False):
+        profiler = cProfile.Profile() if cpu else None
+        if memory:
+            tracemalloc.start()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                out = io.StringIO()
+                pstats.Stats( profiler, stream=out ).sort_stats( "cumulative" ).print_stats( PROFILE_TOP )
+                self.profiles['cpu'] = out.getvalue()
+            if memory:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.profiles['memory'] = { 'current_bytes' : current, 'peak_bytes' : peak,
+                                            'top' : [ str(stat) for stat in snapshot.statistics( "lineno" )[:PROFILE_TOP] ] }
+
+    """ everything recorded so far, as a JSON-able dict """
+    def report(self):
+        data = self.snapshot()
+        data['started'] = self.started
+        data['seconds'] = round( time.time() - self.started, 3 )
+        if self.profiles:
+            data['profiles'] = dict( self.profiles )
+        return data
+
+    """ write report() to path as JSON, extra is merged into the top level (run info, spec, ..) """
+    def write_report(self, path, extra=None):
+        data = self.report()
+        if extra:
+            data.update( extra )
+        with open( path+".part", "w" ) as fh:
+            json.dump( data, fh, indent=2, default=str )
+        os.replace( path+".part", path )
+
+    """ (Internal) labels in Prometheus syntax """
+    def format_labels(self, labels, extra=()):
+        pairs = list( labels ) + list( extra )
+        if not pairs:
+            return ""
+        return "{" + ",".join( k+'="'+str(v).replace( "\\", "\\\\" ).replace( '"', '\\"' )+'"' for k, v in pairs ) + "}"
+
+    """ the registry in the Prometheus text exposition format """
+    def prometheus_text(self):
+        lines = []
+        typed = set()
+        with self.lock:
+            for ( name, labels ), value in sorted( self.counters.items() ):
+                if name not in typed:
+                    lines.append( "# TYPE "+METRIC_PREFIX+name+" counter" )
+                    typed.add( name )
+                lines.append( METRIC_PREFIX+name+self.format_labels( labels )+" "+repr( value ) )
+            for ( name, labels ), value in sorted( self.gauges.items() ):
+                if name not in typed:
+                    lines.append( "# TYPE "+METRIC_PREFIX+name+" gauge" )
+                    typed.add( name )
+                lines.append( METRIC_PREFIX+name+self.format_labels( labels )+" "+repr( value ) )
+            for ( name, labels ), h in sorted( self.histograms.items() ):
+                if name not in typed:
+                    lines.append( "# TYPE "+METRIC_PREFIX+name+" histogram" )
+                    typed.add( name )
+                for bound, n in zip( h.buckets, h.counts ):
+                    lines.append( METRIC_PREFIX+name+"_bucket"+self.format_labels( labels, [ ( "le", repr( float(bound) ) ) ] )+" "+str(n) )
+                lines.append( METRIC_PREFIX+name+"_bucket"+self.format_labels( labels, [ ( "le", "+Inf" ) ] )+" "+str(h.count) )
+                lines.append( METRIC_PREFIX+name+"_sum"+self.format_labels( labels )+" "+repr( h.sum ) )
+                lines.append( METRIC_PREFIX+name+"_count"+self.format_labels( labels )+" "+str(h.count) )
+        return "\n".join( lines )+"\n"
+
+    """ serve prometheus_text() on http://host:port/metrics from a daemon thread.
+        returns the server, .shutdown() stops it """
+    def serve(self, port=9109, host="127.0.0.1"):
+        registry = self
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error( 404 )
+                    return
+                body = registry.prometheus_text().encode( "UTF-8" )
+                self.send_response( 200 )
+                self.send_header( "Content-Type", "text/plain; version=0.0.4" )
+                self.send_header( "Content-Length", str( len(body) ) )
+                self.end_headers()
+                self.wfile.write( body )
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer( ( host, port ), MetricsHandler )
+        server.daemon_threads = True
+        threading.Thread( target=server.serve_forever, daemon=True ).start()
+        return server
+
+# end Metrics
+
+
+# the registry every module reports into
+metrics = Metrics()
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
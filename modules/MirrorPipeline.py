@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic MirrorPipeline
+#############################################################################################################
+# MirrorPipeline
+# Runs the fetch -> decompress/parse -> diff steps for every (dist, section, arch) index of a whole
+# mirror at once, instead of one PkgDBPuller call after another.
+#
+#   fetch           thread pool, network bound.  PkgDBPuller.fetch_remote_db saves each remote
+#                   Packages file into the incomming directory (skipping unchanged ones).
+#   decompress/     process pool, CPU bound, one worker per core by default.  Each worker parses a
+#   parse           Packages file straight into the on disk parse cache (see PkgIndexCache.py) and
+#                   only hands back the cache key, the records never get pickled between processes.
+#   diff            as soon as both the remote and the local side of an index are parsed, the two
+#                   memory-mapped caches are handed to ChangeSetGenerator and the result is yielded.
+#
+# A mirror spec is a dict:
+#   { 'vendor'   : "ubuntu",
+#     'dists'    : [ "trusty", "trusty-updates", "trusty-security", "trusty-backports" ],
+#     'sections' : [ "main", "restricted", "universe", "multiverse" ],
+#     'arches'   : [ "amd64", "i386" ] }
+#
+# run() yields one result dict per index, in the order they finish:
+#   'dist', 'section', 'arch'
+#   'status'        -- "fetched" (diffed), "unchanged" (remote and local match, no diff needed),
+#                      "error" (no change set, the index must not be acted on)
+#   'change_set'    -- ChangeSetGenerator change set ( [] unless status is "fetched" )
+#   'timings'       -- seconds spent in 'fetch', 'parse_remote', 'parse_local', 'diff' and 'total'
+#
+# The same timings go to the metrics registry ( index_fetch_seconds, parse_seconds, diff_seconds,
+# changes_total, .. see Metrics.py ), parse workers hand theirs back with the cache key.
+#
+#############################################################################################################
+
+import os
+import time
+import hashlib
+import concurrent.futures
+
+from PkgDBPuller import PkgDBPuller
+from PkgIndexCache import PkgIndexView
+from ChangeSetGenerator import ChangeSetGenerator, check_keep_versions
+from Metrics import metrics
+
+""" (Internal) process pool worker: make sure the parse cache for the packages file at db_path exists.
+    The parse streams straight into the cache file, so the worker's memory stays flat.
+    returns ( cache key sha256, seconds spent, the worker's metrics ) """
+def build_index_cache(db_path, vendor, local_mirror_root_path):
+    start = time.perf_counter()
+    # a forked worker starts with a copy of the parent's registry, only hand back our own numbers
+    metrics.drain()
+    puller = PkgDBPuller( None, local_mirror_root_path )
+    cache = puller.index_cache
+    sha = cache.file_hash( db_path )
+
+    cached = cache.load( sha )
+    if cached is not None:
+        cached.close()
+        metrics.inc( "parse_cache_hits_total" )
+        return sha, time.perf_counter() - start, metrics.drain()
+
+    sha_uncompressed = hashlib.sha256()
+    if not cache.store( sha, puller.parse_db_file( db_path, vendor, sha_uncompressed ) ):
+        raise IOError( "could not build pkg index cache for "+str(db_path) )
+
+    # a freshly fetched remote file is still missing its uncompressed hash
+    validators = puller.load_validators( db_path )
+    if validators and validators.get('sha256') == sha and not validators.get('sha256_uncompressed'):
+        validators['sha256_uncompressed'] = sha_uncompressed.hexdigest()
+        puller.save_validators( db_path, validators )
+
+    return sha, time.perf_counter() - start, metrics.drain()
+
+
+class MirrorPipeline:
+    """ when this class is initialized, it needs to know
+        the url to the remote mirror root and
+        the path to the local mirror root.
+        fetch_threads is the number of indexes downloaded at once,
+        parse_workers the number of parse processes (default: one per core),
+        keep_versions the number of versions of each package to mirror (default: all, see ChangeSetGenerator) """
+    def __init__(self, remote_mirror_root_url, local_mirror_root_path, fetch_threads=8, parse_workers=None, keep_versions=None):
+        check_keep_versions( keep_versions )
+        self.rmr_url = remote_mirror_root_url
+        self.lmr_path = local_mirror_root_path
+        self.fetch_threads = fetch_threads
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.keep_versions = keep_versions
+        self.puller = PkgDBPuller( remote_mirror_root_url, local_mirror_root_path )
+        self.report = []   # result dicts (without change sets) of the last run, for timing reports
+
+    """ (Internal) every (dist, section, arch) in a mirror spec """
+    def spec_indexes(self, spec):
+        return [ ( dist, section, arch ) for dist in spec['dists'] for section in spec['sections'] for arch in spec['arches'] ]
+
+    """ (Internal) thread pool job: fetch one remote index.  returns ( status, seconds, None ) """
+    def fetch_index(self, vendor, index, conditional):
+        dist, section, arch = index
+        start = time.perf_counter()
+        status = self.puller.fetch_remote_db( vendor, dist, arch, section, conditional )
+        return status, time.perf_counter() - start, None
+
+    """ (Internal) diff an index once both sides are parsed, build its result dict """
+    def finish_index(self, vendor, index, state):
+        dist, section, arch = index
+        result = { 'dist' : dist, 'section' : section, 'arch' : arch, 'change_set' : [], 'timings' : state['timings'] }
+
+        if state['fetch'] == "error" or state['remote'] is None or state['local'] is None:
+            result['status'] = "error"
+        elif state['fetch'] == "unchanged" and state['remote'] == state['local']:
+            # remote has not moved and our published copy already matches it
+            result['status'] = "unchanged"
+        else:
+            cache = self.puller.index_cache
+            pkg_list_new = cache.load( state['remote'] )
+            pkg_list_old = cache.load( state['local'] ) if state['local'] else []
+            try:
+                if pkg_list_new is None or pkg_list_old is None:
+                    print("(Skip) parse cache went missing for "+dist+"/"+section+"/"+arch )
+                    result['status'] = "error"
+                else:
+                    start = time.perf_counter()
+                    csg = ChangeSetGenerator( pkg_list_new, pkg_list_old, self.keep_versions )
+                    csg.compute_change_set()
+                    state['timings']['diff'] = time.perf_counter() - start
+                    metrics.observe( "diff_seconds", state['timings']['diff'] )
+                    result['status'] = "fetched"
+                    result['change_set'] = csg.change_set
+                    for change in csg.change_set:
+                        metrics.inc( "changes_total", change=change['change'] )
+            finally:
+                # the change set entries are PkgRecords of their own, the mappings can go
+                for view in ( pkg_list_new, pkg_list_old ):
+                    if isinstance( view, PkgIndexView ):
+                        view.close()
+
+        state['timings']['total'] = time.perf_counter() - state['start']
+        metrics.inc( "indexes_total", status=result['status'] )
+        return result
+
+    """ Run the whole mirror spec through the pipeline.
+        Generator, yields a result dict per (dist, section, arch) as soon as it is ready.
+        skip is a set of (dist, section, arch) to leave out (already done by a resumed sync, see SyncJournal) """
+    def run(self, spec, conditional=True, skip=()):
+        vendor = spec.get('vendor', "ubuntu")
+        self.report = []
+        # the remote may have moved since the last run, fetch its Release files again
+        self.puller.begin_pass()
+        states = {}
+        pending = {}  # { future : ( index, stage ) }
+
+        with concurrent.futures.ThreadPoolExecutor( self.fetch_threads ) as tpe, \
+             concurrent.futures.ProcessPoolExecutor( self.parse_workers ) as ppe:
+
+            for index in self.spec_indexes( spec ):
+                if index in skip:
+                    continue
+                dist, section, arch = index
+                subpath = self.puller.pkg_db_subpath( dist, arch, section )+self.puller.pkg_db_filename( vendor )
+                states[index] = { 'fetch' : None, 'remote' : None, 'local' : None, 'timings' : {}, 'start' : time.perf_counter(),
+                                  'remote_path' : self.lmr_path+"/incomming"+subpath, 'local_path' : self.lmr_path+subpath }
+
+                pending[ tpe.submit( self.fetch_index, vendor, index, conditional ) ] = ( index, "fetch" )
+                if os.path.exists( states[index]['local_path'] ):
+                    # our own copy does not depend on the network, parse it right away
+                    pending[ ppe.submit( build_index_cache, states[index]['local_path'], vendor, self.lmr_path ) ] = ( index, "parse_local" )
+                else:
+                    # new mirror, nothing published yet
+                    states[index]['local'] = ""
+
+            while pending:
+                done, not_done = concurrent.futures.wait( pending, return_when=concurrent.futures.FIRST_COMPLETED )
+                for future in done:
+                    index, stage = pending.pop( future )
+                    state = states[index]
+                    try:
+                        value, seconds, worker_metrics = future.result()
+                    except Exception as e:
+                        print("(Skip) "+stage+" failed for "+"/".join(index)+" : "+str(e) )
+                        value, seconds, worker_metrics = None, 0.0, None
+                        if stage == "fetch":
+                            value = "error"
+
+                    state['timings'][stage] = seconds
+                    metrics.merge( worker_metrics )
+                    if stage == "fetch":
+                        metrics.observe( "index_fetch_seconds", seconds, status=value )
+                        state['fetch'] = value
+                        if value != "error":
+                            pending[ ppe.submit( build_index_cache, state['remote_path'], vendor, self.lmr_path ) ] = ( index, "parse_remote" )
+                            continue
+                    elif stage == "parse_remote":
+                        metrics.observe( "parse_seconds", seconds, side="remote" )
+                        state['remote'] = value
+                    else:
+                        metrics.observe( "parse_seconds", seconds, side="local" )
+                        # None when the parse failed, finish_index won't act on the index then
+                        state['local'] = value
+
+                    if self.index_ready( state, pending, index ):
+                        result = self.finish_index( vendor, index, state )
+                        del states[index]
+                        self.report.append( { k : v for k, v in result.items() if k != 'change_set' } )
+                        print( self.format_timing( result ) )
+                        yield result
+
+    """ (Internal) True when nothing is left in flight for an index """
+    def index_ready(self, state, pending, index):
+        if state['fetch'] is None:
+            return False
+        return not any( pending_index == index for pending_index, stage in pending.values() )
+
+    """ (Internal) one line timing summary for an index result """
+    def format_timing(self, result):
+        timings = "  ".join( name+"="+str( round( seconds, 3 ) )+"s" for name, seconds in sorted( result['timings'].items() ) )
+        return "index "+result['dist']+"/"+result['section']+"/"+result['arch']+" "+result['status']+ \
+               " changes="+str( len( result['change_set'] ) )+"  "+timings
+
+# end MirrorPipeline
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+################################################################################################
+# Mirror_Magic Mirror Selector
+################################################################################################
+# MirrorSelector.py
+#
+# Spreads package downloads over a ranked list of mirrors of the same archive, so one slow or
+# rate limiting mirror does not hold up the sync.
+#
+#   stats       per mirror latency (time to the first chunk) and throughput (size over the
+#               whole attempt) are kept as exponentially weighted moving averages of the
+#               attempts made against it.
+#   selection   every job goes to the healthy mirror with the lowest expected time for its size
+#               ( latency + size / throughput ), mirrors without stats yet are assumed as good as
+#               the defaults.  Rank breaks ties, a mirror further down the list has to be a bit
+#               better than the ones above it to be picked.
+#   health      a mirror failing FAIL_LIMIT attempts in a row is left alone for a cool down that
+#               doubles each time it fails again (up to COOLDOWN_MAX).
+#   hedging     when an attempt takes HEDGE_FACTOR times longer than expected, the same file is
+#               requested from the next best mirror as well.  Whichever finishes first with a good
+#               hash wins, the other is cancelled at its next chunk.  Each attempt streams to its
+#               own part file ( dst.<mirror number>.part ).
+#   failover    when an attempt fails and no other is running, the next best mirror is tried
+#               right away, every mirror at most once per try of the job.
+#
+# The SHA256 checked is always the job's "hash", taken from the primary (first) mirror's index,
+# a mirror serving anything else simply fails the attempt.
+#
+# usage:
+#   with MirrorSelector( [ "http://archive.ubuntu.com/ubuntu", "http://mirror.example.com/ubuntu" ] ) as mirrors:
+#       failed_jobs_list = threaded_downloader( job_list, 16, mirrors=mirrors )
+#       print( mirrors.get_stats() )
+#
+# The selector runs the attempts on a thread pool of its own, close() it (or use a with block as
+# above) once the downloads are done, the same selector can serve several downloader calls until then.
+#
+# Jobs are Downloader job dicts, the path of the file below the mirror root is taken from "path"
+# when the job has one (JobPlanner sets it), otherwise from "src" relative to the first mirror.
+#
+################################################################################################
+
+import os
+import time
+import threading
+import concurrent.futures
+
+import Downloader
+
+# weight of the newest sample in the moving averages
+EWMA_ALPHA = 0.3
+
+# assumed for a mirror with no samples yet: seconds to first byte, bytes per second
+DEFAULT_LATENCY = 0.5
+DEFAULT_THROUGHPUT = 2 * 1024 * 1024
+
+# each rank down the list adds this much to a mirror's expected time (as a fraction)
+RANK_PENALTY = 0.10
+
+# failures in a row before a mirror is put on cool down, first cool down and the longest one in seconds
+FAIL_LIMIT = 3
+COOLDOWN_BASE = 10.0
+COOLDOWN_MAX = 300.0
+
+# an attempt is hedged after HEDGE_FACTOR x its expected time, but never sooner than HEDGE_MIN_DELAY seconds
+HEDGE_FACTOR = 2.0
+HEDGE_MIN_DELAY = 1.0
+
+
+class HedgeCancelled(IOError):
+    """ raised from the chunk hook of an attempt that lost the race to another mirror """
+    pass
+
+
+class MirrorStats:
+    """ moving averages and health of one mirror """
+    def __init__(self, url, rank):
+        self.url = url.rstrip("/")
+        self.rank = rank
+        self.latency = None         # ewma seconds to first chunk
+        self.throughput = None      # ewma bytes per second, over whole attempts
+        self.fail_streak = 0
+        self.down_until = 0.0
+        self.counts = { "attempts" : 0, "ok" : 0, "failed" : 0, "cancelled" : 0, "hedges" : 0, "hedges_won" : 0 }
+
+    """ (Internal) fold a sample into a moving average """
+    def ewma(self, average, sample):
+        return sample if average is None else average + EWMA_ALPHA * ( sample - average )
+
+    """ seconds a download of size bytes is expected to take from this mirror """
+    def expected_time(self, size):
+        latency = self.latency if self.latency is not None else DEFAULT_LATENCY
+        throughput = self.throughput if self.throughput is not None else DEFAULT_THROUGHPUT
+        return latency + size / max( throughput, 1.0 )
+
+    """ True when the mirror is not on cool down """
+    def healthy(self, now):
+        return now >= self.down_until
+
+    """ (Internal) record a finished attempt """
+    def record(self, ok, latency, size, seconds):
+        self.counts["attempts"] += 1
+        if not ok:
+            self.counts["failed"] += 1
+            self.fail_streak += 1
+            if self.fail_streak >= FAIL_LIMIT:
+                cooldown = min( COOLDOWN_MAX, COOLDOWN_BASE * ( 2 ** ( self.fail_streak - FAIL_LIMIT ) ) )
+                self.down_until = time.monotonic() + cooldown
+                print("(Warn) mirror "+self.url+" failed "+str(self.fail_streak)+" times in a row, cooling down for "+str(cooldown)+"s" )
+            return
+        self.counts["ok"] += 1
+        self.fail_streak = 0
+        self.down_until = 0.0
+        if latency is not None:
+            self.latency = self.ewma( self.latency, latency )
+        if size and seconds > 0:
+            self.throughput = self.ewma( self.throughput, size / seconds )
+
+# end MirrorStats
+
+
+class MirrorSelector:
+    """ mirror_urls is the ranked list of mirror roots, the first one is the primary mirror
+        whose index the job hashes come from.
+        hedge turns hedged requests on or off, attempt_threads is the number of attempts that can
+        run at once (hedges included, they run on the selector's own threads) """
+    def __init__(self, mirror_urls, hedge=True, attempt_threads=32):
+        if not mirror_urls:
+            raise ValueError( "MirrorSelector needs at least one mirror" )
+        self.mirrors = [ MirrorStats( url, rank ) for rank, url in enumerate( mirror_urls ) ]
+        self.hedge = hedge and len( self.mirrors ) > 1
+        self.lock = threading.Lock()     # guards the mirror stats
+        self.tpe = concurrent.futures.ThreadPoolExecutor( attempt_threads )
+
+    """ (Internal) path of a job's file below the mirror root """
+    def job_path(self, job):
+        if job.get('path'):
+            return job['path'].lstrip("/")
+        primary = self.mirrors[0].url + "/"
+        if job['src'].startswith( primary ):
+            return job['src'][ len(primary): ]
+        raise ValueError( "job source is not below the primary mirror: "+str(job['src']) )
+
+    """ (Internal) the healthy mirror with the lowest expected time for size bytes, leaving out
+        the urls in exclude.  When every mirror is cooling down the one back first is used. """
+    def pick(self, size, exclude=()):
+        now = time.monotonic()
+        with self.lock:
+            candidates = [ m for m in self.mirrors if m.url not in exclude ]
+            if not candidates:
+                return None
+            healthy = [ m for m in candidates if m.healthy( now ) ]
+            if not healthy:
+                return min( candidates, key=lambda m: m.down_until )
+            return min( healthy, key=lambda m: m.expected_time( size ) * ( 1 + RANK_PENALTY * m.rank ) )
+
+    """ (Internal) True if some mirror outside exclude is healthy, a hedge is only worth it then """
+    def hedge_available(self, exclude):
+        now = time.monotonic()
+        with self.lock:
+            return any( m.healthy( now ) for m in self.mirrors if m.url not in exclude )
+
+    """ (Internal) seconds to give an attempt on mirror before hedging it """
+    def hedge_delay(self, mirror, size):
+        with self.lock:
+            return max( HEDGE_MIN_DELAY, HEDGE_FACTOR * mirror.expected_time( size ) )
+
+    """ (Internal) attempt thread: download a job from one mirror with the Downloader.
+        The chunk hook times the first chunk, honours cancel and passes chunks on to throttle. """
+    def attempt(self, mirror, sub_job, cancel, pool, throttle):
+        start = time.monotonic()
+        first_chunk = []
+        def hook(n):
+            if not first_chunk:
+                first_chunk.append( time.monotonic() - start )
+            if cancel.is_set():
+                raise HedgeCancelled( "hedged request lost the race" )
+            if throttle is not None:
+                throttle( n )
+
+        Downloader.fetcher( sub_job, pool, hook )
+        seconds = time.monotonic() - start
+        size = 0
+        if sub_job['complete']:
+            try:
+                size = os.path.getsize( sub_job['dst'] )
+            except OSError:
+                pass
+
+        with self.lock:
+            if cancel.is_set() and not sub_job['complete']:
+                mirror.counts["cancelled"] += 1
+            else:
+                mirror.record( sub_job['complete'], first_chunk[0] if first_chunk else None, size, seconds )
+        return sub_job
+
+    """ (Internal) start an attempt of job on mirror.  returns ( future, ( mirror, sub job, cancel event, hedged ) ) """
+    def launch(self, job, path, mirror, pool, throttle, hedged=False):
+        sub_job = { 'src'      : mirror.url+"/"+path,
+                    'dst'      : job['dst']+"."+str( mirror.rank ),
+                    'hash'     : job['hash'],
+                    'complete' : False,
+                    # fetcher counts this try, a retry of the job resumes the mirror's part file
+                    'trys'     : job['trys'] - 1 }
+        cancel = threading.Event()
+        return self.tpe.submit( self.attempt, mirror, sub_job, cancel, pool, throttle ), ( mirror, sub_job, cancel, hedged )
+
+    """ (Internal) done callback for attempts that are no longer wanted, drop what they left behind """
+    def discard(self, future):
+        try:
+            sub_job = future.result()
+        except Exception:
+            return
+        if sub_job['complete']:
+            try:
+                os.remove( sub_job['dst'] )
+            except OSError:
+                pass
+        else:
+            Downloader.remove_part( sub_job['dst']+".part" )
+
+    """ fetch one job from the best mirror(s), same contract as Downloader.fetcher.
+        Called from the downloader's worker threads. """
+    def fetch(self, job, pool=None, throttle=None):
+        job['trys'] += 1
+        size = job.get('size') or 0
+        try:
+            path = self.job_path( job )
+        except ValueError as e:
+            print("(Skip) "+str(e) )
+            job['complete'] = False
+            return job
+
+        tried = set()
+        attempts = {}   # { future : ( mirror, sub job, cancel event, hedged ) }
+        winner = None
+        hedge_at = None
+        while winner is None:
+            if not attempts:
+                mirror = self.pick( size, tried )
+                if mirror is None:
+                    # every mirror failed this try
+                    break
+                tried.add( mirror.url )
+                future, attempt = self.launch( job, path, mirror, pool, throttle )
+                attempts[future] = attempt
+                hedge_at = None
+                if self.hedge and self.hedge_available( tried ):
+                    hedge_at = time.monotonic() + self.hedge_delay( mirror, size )
+
+            timeout = None if hedge_at is None else max( hedge_at - time.monotonic(), 0 )
+            done, not_done = concurrent.futures.wait( attempts, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED )
+            if not done:
+                # slow tail, race the next best mirror
+                hedge_at = None
+                mirror = self.pick( size, tried )
+                if mirror is not None:
+                    tried.add( mirror.url )
+                    with self.lock:
+                        mirror.counts["hedges"] += 1
+                    future, attempt = self.launch( job, path, mirror, pool, throttle, hedged=True )
+                    attempts[future] = attempt
+                continue
+
+            for future in done:
+                mirror, sub_job, cancel, hedged = attempts.pop( future )
+                if sub_job['complete'] and winner is None:
+                    winner = ( mirror, sub_job )
+                    if hedged:
+                        with self.lock:
+                            mirror.counts["hedges_won"] += 1
+                elif sub_job['complete']:
+                    # both finished at once, keep the first
+                    self.discard( future )
+
+        # the race is over, stop the attempts still running
+        for future, ( mirror, sub_job, cancel, hedged ) in attempts.items():
+            cancel.set()
+            future.add_done_callback( self.discard )
+
+        if winner is None:
+            job['complete'] = False
+            return job
+
+        mirror, sub_job = winner
+        try:
+            os.replace( sub_job['dst'], job['dst'] )
+        except OSError as e:
+            print("Download IO Error: "+str(e) )
+            job['complete'] = False
+            return job
+        job['complete'] = True
+        job['mirror'] = mirror.url
+        return job
+
+    """ per mirror statistics, { mirror url : dict } """
+    def get_stats(self):
+        with self.lock:
+            stats = {}
+            for m in self.mirrors:
+                stats[m.url] = dict( m.counts, latency=m.latency and round( m.latency, 4 ),
+                                     throughput=m.throughput and int( m.throughput ), healthy=m.healthy( time.monotonic() ) )
+            return stats
+
+    """ stop the attempt threads, once cancelled attempts have wound down and cleaned up """
+    def close(self):
+        self.tpe.shutdown( wait=True )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# end MirrorSelector
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
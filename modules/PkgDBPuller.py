@@ -5,10 +5,11 @@
 # PkgDBPuller
 # Pulls the packages database for the dist/section/arch specified from the remote mirror specified.
 # Saves a copy of the donwloaded database file into a local incomming directory.
-# ( ${mirror_local_root}/incomming/${dists}/${section}/binary-${arch}/Packages.[ bz2 | xz ] )
+# ( ${mirror_local_root}/incomming/dists/${dist}/${section}/binary-${arch}/Packages.[ bz2 | xz ] )
 #
 # The PkgDBPuller will decompress the database file and parse out the package information
-# This information is stored into a list of dicts with the following keys
+# This information is stored into a list of PkgRecords, compact read only mappings
+# ( see: PkgRecord.py ) with the following keys
 #
 #   PkgDataBase List Entry available Keys
 #       pkgName = the name of the package
@@ -16,14 +17,77 @@
 #       pkgVer  = Version number for this package
 #       pkgFile = Mirror File Path / Name to the .deb file
 #       pkgHash = SHA256 hash finger print for the .deb file (consistency checking)
+#       pkgSize = size of the .deb file in bytes
+#
+# Streaming mode ( stream_parse_local / stream_parse_remote ) reads the compressed database in
+# chunks, feeds them through an incremental bz2/lzma decompressor and yields each package record
+# as soon as its record is complete.  Memory use stays flat no matter how big the index is.
+# fetch_and_parse_local / fetch_and_parse_remote are built on top of the streaming mode.
+#
+# Incremental mode ( fetch_and_parse_pdiff ) patches the Packages file cached in the incomming
+# directory with the Packages.diff/ pdiffs published by Debian style mirrors and only parses the
+# stanzas that changed, for ChangeSetGenerator to diff.  The cached file is patched as a stream,
+# the changed stanzas come out in file order.  Conditional mode below patches the cached file the
+# same way before it falls back to downloading the whole database.
+#
+# Conditional mode ( fetch_and_parse_remote, default ) keeps the ETag, Last-Modified and SHA256 of
+# each cached database in a .validators file next to it.  A database whose hash in the dist's
+# InRelease/Release file matches, or that the server answers 304 for, is not downloaded again.
+# A download only replaces the cached database once its size matches the Content-Length and its
+# hash the one in the Release file (when the dist has one), half an index would diff as removes.
+#
+# Parsed databases are kept in a binary on disk cache ( ${mirror_local_root}/.pkgcache, see
+# PkgIndexCache.py ) keyed by the hash of the compressed file, and memory-mapped on the next run.
+# The mappings handed out stay open until the puller is closed ( close() or a with block ).
+# Release hashes are fetched once per dist and kept until begin_pass(), call it before each sync
+# with a puller that is kept around ( MirrorPipeline.run does ).
+#
+# Decompression time and bytes, parsed records and downloaded index bytes are reported to the
+# metrics registry ( see Metrics.py ).
 #
 ###############################################################################################################
 
 import os
-import re
+import codecs
+import json
+import http.client
+import urllib.error
+import urllib.request
 from urllib.request import urlopen
+import re
 import bz2
 import lzma
+import gzip
+import time
+import hashlib
+import itertools
+import collections
+
+from PkgRecord import PkgRecord
+from PkgIndexCache import PkgIndexCache
+from ChangeSetGenerator import pruned_versions, record_keys
+from Metrics import metrics
+
+# number of compressed bytes read from the mirror per chunk when streaming a packages database
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# packages database fields we care about, mapped to their position in the PkgRecord fields
+# ( pkgName, pkgArch, pkgVer, pkgFile, pkgHash, pkgSize )
+PKG_FIELDS = { 'Package'      : 0,
+               'Architecture' : 1,
+               'Version'      : 2,
+               'Filename'     : 3,
+               'SHA256'       : 4,
+               'Size'         : 5 }
+
+# open_remote() answer for a 304 to a conditional request
+NOT_MODIFIED = "not modified"
+
+# open_remote_conditional() answer when the cached database was brought up to date with pdiffs
+PATCHED = "patched"
+
+# ed commands used by pdiff patches: "12a", "12c", "12,14c", "12d", "12,14d"
+ED_COMMAND_RE = re.compile( rb"^(\d+)(?:,(\d+))?([acd])$" )
 
 class PkgDBPuller:
     """ when this class is initialized, it needs to know
@@ -32,191 +96,911 @@ class PkgDBPuller:
     def __init__(self, remote_mirror_root_url, local_mirror_root_path):
         self.rmr_url = remote_mirror_root_url # url to remote mirror root: ex: http://archives.ubuntu.com/ubuntu/
         self.lmr_path = local_mirror_root_path # local filesystem path for mirror root: ex: /opt/mirror_magic/ubuntu/
-        
-    """ Fetch and Parse Pkg Database for the vendor/dist/arch/section we want from the local mirror """
-    def fetch_and_parse_local(self, vendor="ubuntu", dist="trusty", arch="amd64", section="main"):
-        # Connect to mirror and pull packages.bz2 (ubuntu/default) or packages.xz (debian)
+        self.release_cache = {}  # { dist : { Release file path : sha256 } }
+        self.parsed_cache = {}   # { sha256 of a cached compressed database : pkg_list }
+        self.open_views = []     # PkgIndexViews handed out, closed by close()
+        self.index_status = {}   # { (dist, section, arch) : "unchanged" / "fetched" / "error" }
+        self.index_cache = PkgIndexCache( self.lmr_path+"/.pkgcache" )  # parsed databases on disk
+
+    """ close the memory-mapped parse cache views handed out by fetch_and_parse_local and
+        fetch_and_parse_remote, the pkg_lists they returned can't be read after this """
+    def close(self):
+        for view in self.open_views:
+            view.close()
+        self.open_views = []
+        self.begin_pass()
+
+    """ start a new pass over the remote mirror ( a sync ), forget the Release hashes and parse
+        results of the last one so a reused puller sees what the remote publishes now """
+    def begin_pass(self):
+        self.release_cache = {}
+        self.parsed_cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    """ (Internal) memory-map the parse cache for sha, the view is closed with this puller ( see close ).
+        returns None when there is no cache for it """
+    def load_view(self, sha):
+        view = self.index_cache.load( sha )
+        if view is not None:
+            self.open_views.append( view )
+        return view
+
+    """ (Internal) name of the packages database file for a vendor.
+        debian uses Packages.xz, ubuntu (default) and others use Packages.bz2 """
+    def pkg_db_filename(self, vendor):
         if (vendor == "debian"):
-            url = "file://"+self.lmr_path+"/dists/"+dist+"/"+section+"/binary-"+arch+"/Packages.xz"
-        else:
-            # pull bz2 file (ubuntu and others)
-            url = "file://"+self.lmr_path+"/dists/"+dist+"/"+section+"/binary-"+arch+"/Packages.bz2"
+            return "Packages.xz"
+        return "Packages.bz2"
 
-        # indicate what file we are downloading
+    """ (Internal) path of the packages database inside a mirror root for the dist/section/arch """
+    def pkg_db_subpath(self, dist, arch, section):
+        return "/dists/"+dist+"/"+section+"/binary-"+arch+"/"
+
+    """ (Internal) get a fresh incremental decompressor for the vendor's packages database format """
+    def new_decompressor(self, vendor):
+        if (vendor == "debian"):
+            return lzma.LZMADecompressor()
+        return bz2.BZ2Decompressor()
+
+    """ (Internal) get a fresh incremental compressor for the vendor's packages database format """
+    def new_compressor(self, vendor):
+        if (vendor == "debian"):
+            return lzma.LZMACompressor()
+        return bz2.BZ2Compressor()
+
+    """ (Internal) read a file like object (urlopen response, open file) in chunks """
+    def read_chunks(self, fh):
+        while True:
+            chunk = fh.read( STREAM_CHUNK_SIZE )
+            if not chunk:
+                break
+            yield chunk
+
+    """ (Internal) decompress a stream of compressed chunks, yielding decompressed chunks.
+        Each chunk is handed to an incremental decompressor object, so only one chunk of
+        compressed and decompressed data is held in memory at a time.
+        Raises EOFError when the data stops before the end of a compressed stream
+        (a truncated download), like bz2.decompress / lzma.decompress do. """
+    def decompress_stream(self, chunks, vendor):
+        decompressor = self.new_decompressor( vendor )
+        fed = False     # the current decompressor has been given data
+        seconds = 0.0
+        bytes_in = bytes_out = 0
+        try:
+            for chunk in chunks:
+                bytes_in += len( chunk )
+                while chunk:
+                    fed = True
+                    start = time.perf_counter()
+                    data = decompressor.decompress( chunk )
+                    seconds += time.perf_counter() - start
+                    if data:
+                        bytes_out += len( data )
+                        yield data
+                    if decompressor.eof:
+                        # multi-stream files (pbzip2, pixz) carry on with a new stream
+                        # after the end of the current one, start a new decompressor for it
+                        chunk = decompressor.unused_data
+                        decompressor = self.new_decompressor( vendor )
+                        fed = False
+                    else:
+                        chunk = b""
+            if fed and not decompressor.eof:
+                raise EOFError( "compressed packages database ended before the end-of-stream marker" )
+        finally:
+            # only the time spent inside the decompressor, not in whoever consumes the data
+            metrics.observe( "decompress_seconds", seconds, vendor=vendor )
+            metrics.inc( "decompress_bytes_in_total", bytes_in, vendor=vendor )
+            metrics.inc( "decompress_bytes_out_total", bytes_out, vendor=vendor )
+
+    """ (Internal) split a stream of UTF-8 byte chunks into lines of text.
+        A chunk boundary can fall in the middle of a line or a multi-byte character,
+        the incomplete tail is carried over to the next chunk. """
+    def split_lines(self, chunks):
+        decoder = codecs.getincrementaldecoder('UTF-8')()
+        tail = ""
+        for chunk in chunks:
+            lines = ( tail + decoder.decode( chunk ) ).split("\n")
+            tail = lines.pop()
+            yield from lines
+
+        tail = tail + decoder.decode( b"", final=True )
+        if tail:
+            yield tail
+
+    """ Stream parse the Pkg Database for the vendor/dist/arch/section we want from the local mirror.
+        Generator, yields one package record per package found. """
+    def stream_parse_local(self, vendor="ubuntu", dist="trusty", arch="amd64", section="main"):
+        # Connect to mirror and pull packages.bz2 (ubuntu/default) or packages.xz (debian)
+        url = "file://"+self.lmr_path+self.pkg_db_subpath( dist, arch, section )+self.pkg_db_filename( vendor )
+
+        # indicate what file we are reading
         print("fetching: "+str(url))
 
-        # download packages files
         try:
             response = urlopen( url )
-            # read response from filesystem (should be file data)
-            pkgData_Compressed = response.read()
-
         except urllib.error.URLError as e:
             print("(Skip) Error for URL \""+str(url)+"\" : "+str(e.reason) )
             # abort fetch
-            return []
-
-        except urllib.error.HTTPError as e:
-            print("(Skip) HTTP Error for URL \""+str(url)+"\" : error "+str(e.code) )
-            # abort fetch
-            return []
-
+            return
         except IOError as e:
-            print("(Skip) File IO Error for URL \n"+str(url)+"\" : error "+str(e) )
+            print("(Skip) File IO Error for URL \""+str(url)+"\" : error "+str(e) )
+            return
 
-        # Decompress the data
-        if (vendor == "debian"):
-            pkgData_bytes = lzma.decompress( pkgData_Compressed )
-        else:
-            pkgData_bytes = bz2.decompress( pkgData_Compressed )
-
-        # Decompression leaves us with a array of bytes
-        # file data is UTF-8, and we want lines of text to parse
-        line = ""
-        pkgData = [ "" ] # list of lines
-        for c in pkgData_bytes.decode('UTF-8'):
-            line = line + c
-            if c == "\n":
-                # add line to list of lines
-                pkgData.append(line)
-                # start new line
-                line = ""
-
-        return self.parsePkgData( pkgData )
-
-    """ Fetch and parse Pkg Database for the vendor/dist/arch/section we want from a remote mirror """
-    def fetch_and_parse_remote(self, vendor="ubuntu", dist="trusty", arch="amd64", section="main"):
-        # Connect to mirror and pull packages.bz2 (ubuntu/default) or packages.xz (debian)
-        if (vendor == "debian"):
-            url = self.rmr_url+"/dists/"+dist+"/"+section+"/binary-"+arch+"/Packages.xz"
-            lfp = self.lmr_path+"/dists/"+dist+"/"+section+"/binary-"+arch+"/"
-            lfn = "Packages.xz"
-        else:
-            # pull bz2 file (ubuntu and others)
-            url = self.rmr_url+"/dists/"+dist+"/"+section+"/binary-"+arch+"/Packages.bz2"
-            lfp = self.lmr_path+"/dists/"+dist+"/"+section+"/binary-"+arch+"/"
-            lfn = "Packages.bz2"
+        with response:
+            chunks = self.decompress_stream( self.read_chunks( response ), vendor )
+            yield from self.iterPkgData( self.split_lines( chunks ) )
 
-        # indicate what file we are downloading
-        print("fetching: "+str(url))
-
-        # download packages files
+    """ (Internal) open the url of a remote packages database.
+        headers are extra request headers (If-None-Match, If-Modified-Since).
+        returns the response, NOT_MODIFIED when the server answers 304, None on error """
+    def open_remote(self, url, headers=None):
         try:
-            reponse = urlopen( url )
-            # read response from webserver (should be file data)
-            pkgData_Compressed = response.read()
+            return urlopen( urllib.request.Request( url, headers=headers or {} ) )
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return NOT_MODIFIED
+            print("(Skip) HTTP Error for URL \""+str(url)+"\" : error "+str(e.code) )
         except urllib.error.URLError as e:
             print("(Skip) Error for URL \""+str(url)+"\" : "+str(e.reason) )
-            # abort fetch
-            return []
-        except urllib.error.HTTPError as e:
-            print("(Skip) HTTP Error for URL \""+str(url)+"\n : error "+str(e.code) )
-            # abort fetch
-            return []
+        # abort fetch
+        return None
+
+    """ Stream parse the Pkg Database for the vendor/dist/arch/section we want from a remote mirror.
+        Generator, yields one package record per package found.
+        The compressed data is saved into the incomming directory as it streams past, the saved file
+        only replaces the previous one once the whole database has been read, and its validators
+        (ETag, Last-Modified, SHA256) are saved next to it.
+        response can be an already opened response for the database url (see open_remote)
+        Raises IOError when the database can't be opened or saved, so a failed fetch never looks
+        like an empty database. """
+    def stream_parse_remote(self, vendor="ubuntu", dist="trusty", arch="amd64", section="main", response=None):
+        # Connect to mirror and pull packages.bz2 (ubuntu/default) or packages.xz (debian)
+        url = self.rmr_url+self.pkg_db_subpath( dist, arch, section )+self.pkg_db_filename( vendor )
+        # store to ${mirror_local_root}/incomming/dists/${dist}/${section}/binary-${arch}/Packages.(bz2/xz)
+        lfp = self.lmr_path+"/incomming"+self.pkg_db_subpath( dist, arch, section )
+        lfn = self.pkg_db_filename( vendor )
+
+        if response is None:
+            # indicate what file we are downloading
+            print("fetching: "+str(url))
+            response = self.open_remote( url )
+            if response is NOT_MODIFIED:
+                return
+            if response is None:
+                raise IOError( "could not open "+str(url) )
 
         # Save this data to a file on the local mirror tmp location
         # This will become out new packages file for the local mirror when we are done
         # pulling all the new and updated packages.
-        # store to ${mirror_local_root}/incomming/${dists}/${section}/binary-${arch}/Packages.(bz2/xz)
-        # step one, make the directory path
-        os.mkdirs( lfp, mode=0o777, exist_ok=True)
         try:
-            fh = open( lfp+lfn, "wb" )
-            fh.write( pkgData_Compressed )
+            os.makedirs( lfp, mode=0o777, exist_ok=True)
+            fh = open( lfp+lfn+".part", "wb" )
         except IOError as e:
+            response.close()
             print("(Skip) File IO Error when saving pkgfile: "+str(lfp+lfn)+" => "+str(e) )
-            return []
+            raise
 
-        # Decompress the data
-        if ( vendor == "debian" ):
-            pkgData_bytes = lzma.decompress( pkgData_Compressed )
-        else:
-            pkgData_bytes = bz2.decompress( pkgData_Compressed )
-
-        # Decompression leaves us with a array of bytes
-        # file data is UTF-8, and we want lines of text to parse
-        line = ""
-        pkgData = [ "" ] # list of lines
-        for c in pkgData_bytes.decode('UTF-8'):
-            line = line + c
-            if c == "\n":
-                # add line to list of lines
-                pkgData.append(line)
-                # start new line
-                line = ""
-
-        # parse packages database return list of package dicts
-        return self.parsePkgData( pkgData )
-
-    """ (Internal) Read package data, build a dict for each package.
-        Place each dict into a list.
-        Debian and Ubuntu both use the same package database format """
-    def parsePkgData(self, PkgData ):
-        pkg_db_entry = {}
-        pkg_list = []
-
-        # build compiled regular expressions for use in parser
-        pkgName_re = re.compile("Package: (.+)")
-        pkgArch_re = re.compile("Architecture: (.+)")
-        pkgVer_re  = re.compile("Version: (.+)")
-        pkgFile_re = re.compile("Filename: (.+)")
-        pkgHash_re = re.compile("SHA256: (.+)")
-
-                
-        # read file database, line by line
-        for line in PkgData:
-            line = line.rstrip()  # remove trailing whitespace and new lines from line.
-
-            # look for data matches against regular expressions
-            m = pkgName_re.match( line )
-            if m:
-                pkg_db_entry['pkgName'] = m.group(1)
-
-            m = pkgArch_re.match( line )
-            if m:
-                pkg_db_entry['pkgArch'] = m.group(1)
-
-            m = pkgVer_re.match(line)
-            if m:
-                pkg_db_entry['pkgVer'] = m.group(1)
-
-            m = pkgFile_re.match(line)
-            if m:
-                pkg_db_entry['pkgFile'] = m.group(1)
-
-            m = pkgHash_re.match(line)
-            if m:
-                pkg_db_entry['pkgHash'] = m.group(1)
-
-            if ( line == "" ):
-                # end of record found, push back db_entry to database
-                # for debugging purposes
-                # print("adding pkg: ", db_entry )
-                if not pkg_db_entry:  # entry is empty..
-                    # nothing to add.. false end of record detected..
-                    pass
+        sha_compressed = hashlib.sha256()
+        sha_uncompressed = hashlib.sha256()
+        try:
+            with response, fh:
+                chunks = self.save_chunks( self.read_chunks( response ), fh, sha_compressed )
+                chunks = self.hash_chunks( self.decompress_stream( chunks, vendor ), sha_uncompressed )
+                yield from self.iterPkgData( self.split_lines( chunks ) )
+                problem = self.check_download( response, fh.tell(), sha_compressed.hexdigest(), vendor, dist, arch, section )
+                if problem:
+                    raise IOError( problem )
+        except BaseException:
+            # truncated or unreadable download (or the caller stopped reading), never promote it
+            try:
+                os.remove( lfp+lfn+".part" )
+            except OSError:
+                pass
+            raise
+
+        # whole database read, swap it in
+        os.replace( lfp+lfn+".part", lfp+lfn )
+        self.save_validators( lfp+lfn, { 'etag'                : response.headers.get("ETag"),
+                                         'last_modified'       : response.headers.get("Last-Modified"),
+                                         'sha256'              : sha_compressed.hexdigest(),
+                                         'sha256_uncompressed' : sha_uncompressed.hexdigest() } )
+
+    """ (Internal) check a downloaded packages database before it is used.
+        received is the number of bytes saved, sha the SHA256 of them.  The size has to match the
+        response's Content-Length and the hash the one the dist's InRelease/Release file lists.
+        returns what is wrong, None when the download checks out """
+    def check_download(self, response, received, sha, vendor, dist, arch, section):
+        length = response.headers.get("Content-Length")
+        if length is not None and length.isdigit() and int( length ) != received:
+            return "short download, got "+str(received)+" of "+length+" bytes"
+        expected = self.release_hashes( dist ).get( section+"/binary-"+arch+"/"+self.pkg_db_filename( vendor ) )
+        if expected and expected != sha:
+            return "SHA256 does not match the Release file"
+        return None
+
+    """ (Internal) pass chunks through, writing a copy of each one to the file handle fh
+        and adding it to the hash sha_gen """
+    def save_chunks(self, chunks, fh, sha_gen):
+        for chunk in chunks:
+            fh.write( chunk )
+            sha_gen.update( chunk )
+            yield chunk
+
+    """ (Internal) pass chunks through, adding each one to the hash sha_gen """
+    def hash_chunks(self, chunks, sha_gen):
+        for chunk in chunks:
+            sha_gen.update( chunk )
+            yield chunk
+
+    """ (Internal) validators of a cached packages database, {} if there are none """
+    def load_validators(self, db_path):
+        try:
+            with open( db_path+".validators", "r" ) as fh:
+                return json.load( fh )
+        except (IOError, ValueError):
+            return {}
+
+    """ (Internal) save the validators of a cached packages database next to it """
+    def save_validators(self, db_path, validators):
+        try:
+            with open( db_path+".validators.part", "w" ) as fh:
+                json.dump( validators, fh )
+            os.replace( db_path+".validators.part", db_path+".validators" )
+        except IOError as e:
+            print("(Warn) could not save validators for "+str(db_path)+" : "+str(e) )
+
+    """ (Internal) SHA256 hashes listed in the remote dist's InRelease (or Release) file.
+        returns { "main/binary-amd64/Packages.bz2" : hash, ... }, {} when neither can be fetched.
+        Fetched once per dist per sync pass, begin_pass() forgets them. """
+    def release_hashes(self, dist):
+        if dist in self.release_cache:
+            return self.release_cache[dist]
+
+        hashes = {}
+        for name in ( "InRelease", "Release" ):
+            release_data = self.fetch_url( self.rmr_url+"/dists/"+dist+"/"+name )
+            if release_data is None:
+                continue
+            in_sha256 = False
+            for line in release_data.decode('UTF-8', 'replace').split("\n"):
+                if line.startswith(" ") and in_sha256:
+                    row = line.split()
+                    if len(row) == 3:
+                        hashes[row[2]] = row[0]
                 else:
-                    # add entry to dict
-                    pkg_list.append( pkg_db_entry );
+                    # InRelease is clear signed, the signature block ends the SHA256 list too
+                    in_sha256 = line.rstrip() == "SHA256:"
+            break
+
+        self.release_cache[dist] = hashes
+        return hashes
+
+    """ (Internal) True if the dist's Release file says the cached database with these validators is current """
+    def release_says_unchanged(self, vendor, dist, arch, section, validators):
+        hashes = self.release_hashes( dist )
+        rel_path = section+"/binary-"+arch+"/"
+        compressed = hashes.get( rel_path+self.pkg_db_filename( vendor ) )
+        uncompressed = hashes.get( rel_path+"Packages" )
+        if compressed and compressed == validators.get('sha256'):
+            return True
+        # after a pdiff update our copy is recompressed, only the uncompressed hash can match
+        if uncompressed and uncompressed == validators.get('sha256_uncompressed'):
+            return True
+        return False
+
+    """ (Internal) package records of the cached (unchanged) remote database.
+        Reuses the parse result from earlier in this run when there is one, then the on disk
+        parse cache, otherwise parses the cached copy in the incomming directory (no network). """
+    def parse_cached_remote(self, vendor, dist, arch, section, validators):
+        sha = validators.get('sha256')
+        if sha and sha in self.parsed_cache:
+            return self.parsed_cache[sha]
+
+        db_path = self.lmr_path+"/incomming"+self.pkg_db_subpath( dist, arch, section )+self.pkg_db_filename( vendor )
+        sha = self.index_cache.file_hash( db_path )
+        pkg_list = self.load_view( sha )
+        if pkg_list is None:
+            pkg_list = list( self.parse_db_file( db_path, vendor ) )
+            self.index_cache.store( sha, pkg_list )
+        if sha:
+            self.parsed_cache[sha] = pkg_list
+        return pkg_list
 
-                pkg_db_entry = {} # reset dict, ready for next new entry
+    """ Fetch and Parse Pkg Database for the vendor/dist/arch/section we want from the local mirror
+        Our own Packages file only changes when we publish, its parse result is kept in the on disk
+        parse cache (see PkgIndexCache.py).  On a cache hit a memory-mapped PkgIndexView is returned
+        (a read only sequence of PkgRecords) instead of a list, and nothing gets decompressed.
+        The view stays mapped until this puller is closed ( close() or a with block ). """
+    def fetch_and_parse_local(self, vendor="ubuntu", dist="trusty", arch="amd64", section="main"):
+        db_path = self.lmr_path+self.pkg_db_subpath( dist, arch, section )+self.pkg_db_filename( vendor )
+        sha = None
+        try:
+            if os.path.exists( db_path ):
+                sha = self.index_cache.file_hash( db_path )
+                pkg_list = self.load_view( sha )
+                if pkg_list is not None:
+                    print("cached: "+str(db_path))
+                    return pkg_list
+
+            pkg_list = list( self.stream_parse_local( vendor, dist, arch, section ) )
+        except (IOError, EOFError, lzma.LZMAError) as e:
+            # read or decompression failed part way through the database
+            print("(Skip) Error reading local pkgfile for "+dist+"/"+section+"/"+arch+" : "+str(e) )
+            return []
 
-            # end if
-        
+        if sha is not None and pkg_list:
+            self.index_cache.store( sha, pkg_list )
         return pkg_list
-    # end parsePkgData
 
-        
-if __name__ == "__main__":
-    print("Not designed to be run standalone.. This is a module class definition")
+    """ Fetch and parse Pkg Database for the vendor/dist/arch/section we want from a remote mirror
+
+        With conditional (default) the database cached in the incomming directory by the last sync
+        is checked before downloading anything:
+            the hash in the dist's InRelease/Release file matches the cached copy -> skip the download
+            the Release file lists pdiffs for the database -> patch the cached copy ( see update_from_pdiff )
+            no Release hash available -> conditional GET (If-None-Match / If-Modified-Since), 304 -> skip
+        A skipped database returns the cached parse result, a patched one the parse result of the patched copy.
+        index_status[ (dist, section, arch) ] records what happened: "unchanged", "fetched" or "error",
+        an "unchanged" index needs no new change set. """
+    def fetch_and_parse_remote(self, vendor="ubuntu", dist="trusty", arch="amd64", section="main", conditional=True):
+        db_path = self.lmr_path+"/incomming"+self.pkg_db_subpath( dist, arch, section )+self.pkg_db_filename( vendor )
+        status_key = ( dist, section, arch )
+
+        try:
+            response, validators = self.open_remote_conditional( vendor, dist, arch, section, conditional )
+            if response is NOT_MODIFIED:
+                self.index_status[status_key] = "unchanged"
+                return self.parse_cached_remote( vendor, dist, arch, section, validators )
+            if response is PATCHED:
+                self.index_status[status_key] = "fetched"
+                return self.parse_cached_remote( vendor, dist, arch, section, self.load_validators( db_path ) )
+            if response is None:
+                self.index_status[status_key] = "error"
+                return []
+
+            # parse packages database return list of package records
+            pkg_list = list( self.stream_parse_remote( vendor, dist, arch, section, response ) )
+
+        except (IOError, EOFError, lzma.LZMAError, http.client.HTTPException) as e:
+            # download or decompression failed part way through the database
+            print("(Skip) Error reading remote pkgfile for "+dist+"/"+section+"/"+arch+" : "+str(e) )
+            self.index_status[status_key] = "error"
+            return []
 
-        
+        self.index_status[status_key] = "fetched"
+        sha = self.load_validators( db_path ).get('sha256')
+        if sha:
+            if pkg_list:
+                # hashed while it streamed in, keep the parse result for the next run
+                self.index_cache.remember_hash( db_path, sha )
+                self.index_cache.store( sha, pkg_list )
+            self.parsed_cache[sha] = pkg_list
+        return pkg_list
 
-        
+    """ (Internal) open the remote packages database, unless the cached copy is known to be current.
+        returns ( response, validators of the cached copy ), response is NOT_MODIFIED when the
+        Release hash matches or the server answers 304, PATCHED when pdiffs brought the cached copy
+        up to date, None on error """
+    def open_remote_conditional(self, vendor, dist, arch, section, conditional=True):
+        url = self.rmr_url+self.pkg_db_subpath( dist, arch, section )+self.pkg_db_filename( vendor )
+        db_path = self.lmr_path+"/incomming"+self.pkg_db_subpath( dist, arch, section )+self.pkg_db_filename( vendor )
+
+        validators = {}
+        headers = {}
+        if conditional and os.path.exists( db_path ):
+            validators = self.load_validators( db_path )
+
+        if validators:
+            if self.release_says_unchanged( vendor, dist, arch, section, validators ):
+                print("unchanged (Release hash): "+str(url))
+                return NOT_MODIFIED, validators
+
+            # patching the cached copy moves a lot less data than downloading it again
+            if self.release_hashes( dist ).get( section+"/binary-"+arch+"/Packages.diff/Index" ):
+                changes = self.update_from_pdiff( vendor, dist, arch, section )
+                if changes is not None:
+                    print("patched (pdiff): "+str(db_path))
+                    return ( PATCHED if any( changes ) else NOT_MODIFIED ), validators
+
+            # ask the server, only when the Release file does not list this database.  When it does the
+            # cached copy is known to be stale, and a weak ETag or a coarse Last-Modified could still get a 304
+            rel_path = section+"/binary-"+arch+"/"
+            hashes = self.release_hashes( dist )
+            if not hashes.get( rel_path+self.pkg_db_filename( vendor ) ) and not hashes.get( rel_path+"Packages" ):
+                if validators.get('etag'):
+                    headers['If-None-Match'] = validators['etag']
+                if validators.get('last_modified'):
+                    headers['If-Modified-Since'] = validators['last_modified']
 
-         
-        
-        
+        # indicate what file we are downloading
+        print("fetching: "+str(url))
+        response = self.open_remote( url, headers )
+        if response is NOT_MODIFIED:
+            print("unchanged (304): "+str(url))
+        return response, validators
+
+    """ Download the Pkg Database for the vendor/dist/arch/section into the incomming directory
+        without parsing it, so the parse can run somewhere else (see MirrorPipeline.py).
+        Uses the same validators / Release short-circuit as fetch_and_parse_remote.
+        returns "unchanged", "fetched" or "error", also recorded in index_status """
+    def fetch_remote_db(self, vendor="ubuntu", dist="trusty", arch="amd64", section="main", conditional=True):
+        lfp = self.lmr_path+"/incomming"+self.pkg_db_subpath( dist, arch, section )
+        lfn = self.pkg_db_filename( vendor )
+        status_key = ( dist, section, arch )
+
+        response, validators = self.open_remote_conditional( vendor, dist, arch, section, conditional )
+        if response is NOT_MODIFIED:
+            self.index_status[status_key] = "unchanged"
+            return "unchanged"
+        if response is PATCHED:
+            self.index_status[status_key] = "fetched"
+            return "fetched"
+        if response is None:
+            self.index_status[status_key] = "error"
+            return "error"
+
+        sha_compressed = hashlib.sha256()
+        received = 0
+        try:
+            os.makedirs( lfp, mode=0o777, exist_ok=True)
+            with response, open( lfp+lfn+".part", "wb" ) as fh:
+                for chunk in self.save_chunks( self.read_chunks( response ), fh, sha_compressed ):
+                    received += len( chunk )
+                    metrics.inc( "index_fetch_bytes_total", len( chunk ), vendor=vendor )
+            # a dropped connection leaves half an index, which would diff as a lot of removes
+            problem = self.check_download( response, received, sha_compressed.hexdigest(), vendor, dist, arch, section )
+            if problem:
+                raise IOError( problem )
+            os.replace( lfp+lfn+".part", lfp+lfn )
+        except ( IOError, http.client.HTTPException ) as e:
+            print("(Skip) Error downloading pkgfile for "+dist+"/"+section+"/"+arch+" : "+str(e) )
+            try:
+                os.remove( lfp+lfn+".part" )
+            except OSError:
+                pass
+            self.index_status[status_key] = "error"
+            return "error"
+
+        # the uncompressed hash is filled in by whoever parses the file
+        self.save_validators( lfp+lfn, { 'etag'                : response.headers.get("ETag"),
+                                         'last_modified'       : response.headers.get("Last-Modified"),
+                                         'sha256'              : sha_compressed.hexdigest(),
+                                         'sha256_uncompressed' : None } )
+        self.index_cache.remember_hash( lfp+lfn, sha_compressed.hexdigest() )
+        self.index_status[status_key] = "fetched"
+        return "fetched"
+
+    """ Parse a compressed packages database file on the local filesystem.
+        Generator, yields one package record per package found.
+        sha_uncompressed, if given, is updated with the decompressed data. """
+    def parse_db_file(self, db_path, vendor="ubuntu", sha_uncompressed=None):
+        with open( db_path, "rb" ) as fh:
+            chunks = self.decompress_stream( self.read_chunks( fh ), vendor )
+            if sha_uncompressed is not None:
+                chunks = self.hash_chunks( chunks, sha_uncompressed )
+            yield from self.iterPkgData( self.split_lines( chunks ) )
+
+    """ (Internal) ( Package, Architecture, Version ) of a stanza given as a list of lines """
+    def stanza_key(self, stanza):
+        fields = [ None, None, None ]
+        for line in stanza:
+            field, sep, value = line.rstrip().partition(": ")
+            index = PKG_FIELDS.get( field )
+            if index is not None and index < 3 and value:
+                fields[index] = value
+        return tuple( fields )
+
+    """ Write a copy of the compressed packages database src to dst without the versions that
+        keep_versions pruning leaves out ( see ChangeSetGenerator.pruned_versions ), so the published
+        index only lists what the mirror carries.  Two streaming passes over src, the first finds the
+        versions to leave out, the second copies every other stanza as it is. """
+    def write_pruned_db(self, src, dst, vendor, keep_versions):
+        pruned = pruned_versions( record_keys( self.parse_db_file( src, vendor ) ), keep_versions )
+        compressor = self.new_compressor( vendor )
+        with open( src, "rb" ) as src_fh, open( dst, "wb" ) as dst_fh:
+            stanza = []
+            lines = self.split_lines( self.decompress_stream( self.read_chunks( src_fh ), vendor ) )
+            # the trailing "" ends a last stanza that has no blank line after it
+            for line in itertools.chain( lines, [ "" ] ):
+                if line.rstrip() != "":
+                    stanza.append( line )
+                    continue
+                if stanza and self.stanza_key( stanza ) not in pruned:
+                    dst_fh.write( compressor.compress( ( "\n".join( stanza )+"\n\n" ).encode('UTF-8') ) )
+                stanza = []
+            dst_fh.write( compressor.flush() )
+
+    """ (Internal) download a small file (pdiff index, patch) from the remote mirror into memory.
+        returns the bytes, or None when it can not be fetched """
+    def fetch_url(self, url):
+        try:
+            with urlopen( url ) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            print("(Skip) HTTP Error for URL \""+str(url)+"\" : error "+str(e.code) )
+        except urllib.error.URLError as e:
+            print("(Skip) Error for URL \""+str(url)+"\" : "+str(e.reason) )
+        except IOError as e:
+            print("(Skip) IO Error for URL \""+str(url)+"\" : "+str(e) )
+        return None
+
+    """ (Internal) parse a Packages.diff/Index file.
+        returns a dict with
+            'hash'      : hashlib constructor for the hashes used (sha256, or sha1 on old mirrors)
+            'current'   : hash of the current uncompressed Packages file
+            'history'   : list of ( hash, patch name ), hash of the Packages file each patch applies to
+            'patches'   : { patch name : hash of the uncompressed patch }
+            'merged'    : True if every patch goes straight to current (X-Patch-Precedence: merged)
+        or None if the index is not usable """
+    def parse_pdiff_index(self, index_data):
+        fields = {}
+        field = None
+        for line in index_data.decode('UTF-8').split("\n"):
+            if line.startswith(" ") and field:
+                fields[field].append( line.split() )
+            elif ":" in line:
+                field, sep, value = line.partition(":")
+                fields[field] = [ value.split() ] if value.strip() else []
+
+        for prefix, hash_func in ( ("SHA256", hashlib.sha256), ("SHA1", hashlib.sha1) ):
+            if prefix+"-Current" in fields and prefix+"-History" in fields and prefix+"-Patches" in fields:
+                return { 'hash'    : hash_func,
+                         'current' : fields[prefix+"-Current"][0][0],
+                         'history' : [ ( row[0], row[2] ) for row in fields[prefix+"-History"] if len(row) == 3 ],
+                         'patches' : { row[2] : row[0] for row in fields[prefix+"-Patches"] if len(row) == 3 },
+                         'merged'  : fields.get("X-Patch-Precedence", [[""]])[0][:1] == ["merged"] }
+        return None
+
+    """ (Internal) parse an ed style script (as produced by diff --ed, the pdiff format).
+        returns the commands as a list of ( first line, last line, command, text lines ) in script order,
+        or None if the script holds something we don't understand """
+    def parse_ed_patch(self, patch_data):
+        commands = []
+        script = patch_data.split(b"\n")
+        i = 0
+        while i < len(script):
+            m = ED_COMMAND_RE.match( script[i] )
+            i += 1
+            if not m:
+                if script[i-1] == b"":
+                    continue
+                return None
+            first = int( m.group(1) )
+            last = int( m.group(2) ) if m.group(2) else first
+            command = m.group(3)
+            if last < first:
+                return None
+
+            text = []
+            if command in ( b"a", b"c" ):
+                # text block runs up to a line holding a single "."
+                while i < len(script) and script[i] != b".":
+                    text.append( script[i] )
+                    i += 1
+                i += 1
+            commands.append( ( first, last, command, text ) )
+        return commands
+
+    """ (Internal) apply parsed ed commands to a stream of ( line, origin ) pairs, yielding the patched stream.
+        diff --ed lists its commands bottom to top, so they are applied top to bottom in a single pass
+        and only the patch is held in memory.  Lines the patch adds have origin None.
+        Raises ValueError when the commands overlap or run past the end of the file. """
+    def patch_lines(self, lines, commands):
+        lines = iter( lines )
+        line_no = 0     # lines of the input passed on or dropped so far
+        for first, last, command, text in reversed( commands ):
+            # lines before the command (and the line an "a" appends after) pass through unchanged
+            keep_to = first if command == b"a" else first - 1
+            if keep_to < line_no:
+                raise ValueError( "pdiff commands are not in bottom to top order" )
+            drop = 0 if command == b"a" else last - first + 1
+            while line_no < keep_to + drop:
+                line = next( lines, None )
+                if line is None:
+                    raise ValueError( "pdiff goes past the end of the packages file" )
+                if line_no < keep_to:
+                    yield line
+                line_no += 1
+            for added in text:
+                yield ( added, None )
+        yield from lines
+
+    """ (Internal) split a stream of byte chunks into lines, the way data.split( b"\n" ) splits
+        the whole data ( the piece after the last newline is a line too, even when empty ) """
+    def split_byte_lines(self, chunks):
+        tail = b""
+        for chunk in chunks:
+            lines = ( tail + chunk ).split(b"\n")
+            tail = lines.pop()
+            yield from lines
+        yield tail
+
+    """ (Internal) tag the lines of the old packages file with where they came from, for diff_stanzas.
+        Each line gets the number of the stanza it is in ( blank lines the number of the last stanza ).
+        Once a stanza is complete its lines go into old_stanzas { number : [ lines ] }, where they
+        stay until diff_stanzas has matched them up.  A line is passed on after the next one is read,
+        so a stanza is in old_stanzas by the time its last line comes out. """
+    def number_stanzas(self, lines, old_stanzas):
+        number = -1
+        stanza = []
+        ahead = None
+        for line in lines:
+            if line.rstrip() == b"":
+                if stanza:
+                    old_stanzas[number] = stanza
+                    stanza = []
+            else:
+                if not stanza:
+                    number += 1
+                stanza.append( line )
+            if ahead is not None:
+                yield ahead
+            ahead = ( line, number )
+        if stanza:
+            old_stanzas[number] = stanza
+        if ahead is not None:
+            yield ahead
+
+    """ (Internal) pass the lines of the patched ( line, origin ) stream through, sorting out which stanzas changed.
+        A stanza of the patched file is unchanged when all its lines came from one complete old stanza
+        and it has as many lines as that stanza had, the patch added nothing to it and dropped nothing.
+        Unchanged lines keep their order in a diff, so old stanzas skipped over on the way to an unchanged
+        one are gone.  Fills added with the new stanzas that changed ( in new file order ) and removed with
+        the old ones ( in old file order ), as lists of lines. """
+    def diff_stanzas(self, lines, old_stanzas, added, removed):
+        next_old = 0        # old stanzas before this one are sorted out
+        stanza = []
+        origins = set()
+        for line, origin in itertools.chain( lines, [ ( None, None ) ] ):
+            if line is not None:
+                yield line
+                if line.rstrip() != b"":
+                    stanza.append( line )
+                    origins.add( origin )
+                    continue
+            if not stanza:
+                continue
+            origin = origins.pop() if len( origins ) == 1 else None
+            if origin is not None and len( old_stanzas.get( origin, () ) ) == len( stanza ):
+                for number in range( next_old, origin ):
+                    if number in old_stanzas:
+                        removed.append( old_stanzas.pop( number ) )
+                del old_stanzas[origin]
+                next_old = origin + 1
+            else:
+                # a stanza whose old stanza is not complete yet counts as changed too,
+                # that only costs a bit of diffing
+                added.append( stanza )
+            stanza = []
+            origins = set()
+        removed.extend( old_stanzas.pop( number ) for number in sorted( old_stanzas ) )
+
+        # diff can line a patch up so that it drops a stanza and adds the same text back elsewhere
+        moved = collections.Counter( map( tuple, added ) ) & collections.Counter( map( tuple, removed ) )
+        if moved:
+            for stanzas in ( added, removed ):
+                left = moved.copy()
+                kept = []
+                for stanza in stanzas:
+                    if left[ tuple( stanza ) ] > 0:
+                        left[ tuple( stanza ) ] -= 1
+                    else:
+                        kept.append( stanza )
+                stanzas[:] = kept
+
+    """ (Internal) parse stanzas (lists of byte lines) from diff_stanzas into package records """
+    def parse_stanzas(self, stanzas):
+        return self.parsePkgData( line.decode('UTF-8') for stanza in stanzas for line in stanza + [ b"" ] )
+
+    """ (Internal) bring the packages database cached in the incomming directory up to date by applying
+        the ed style patches from ${remote}/dists/${dist}/${section}/binary-${arch}/Packages.diff/,
+        and save the patched file (and its validators) back into the incomming directory.
+        The cached file is decompressed, patched and recompressed as a stream, patches are small.
+
+        returns ( added, removed ), the stanzas (lists of byte lines) that are in the new file only and in
+        the old file only, in file order, both empty when the cached file is already current.
+        returns None when pdiffs can't be used (no cached file, no Packages.diff/Index on the mirror,
+        cached file too old for the patch history, hash mismatch), the full database has to be downloaded. """
+    def update_from_pdiff(self, vendor="ubuntu", dist="trusty", arch="amd64", section="main"):
+        lfp = self.lmr_path+"/incomming"+self.pkg_db_subpath( dist, arch, section )
+        lfn = self.pkg_db_filename( vendor )
+        diff_url = self.rmr_url+self.pkg_db_subpath( dist, arch, section )+"Packages.diff/"
+
+        if not os.path.exists( lfp+lfn ):
+            # nothing cached from an earlier sync to patch
+            return None
+
+        print("fetching: "+diff_url+"Index")
+        index_data = self.fetch_url( diff_url+"Index" )
+        if index_data is None:
+            return None
+        metrics.inc( "index_fetch_bytes_total", len( index_data ), vendor=vendor )
+        expected = self.release_hashes( dist ).get( section+"/binary-"+arch+"/Packages.diff/Index" )
+        if expected and expected != hashlib.sha256( index_data ).hexdigest():
+            print("(Skip) pdiff index does not match the Release file: "+diff_url+"Index")
+            return None
+        pdiff_index = self.parse_pdiff_index( index_data )
+        if pdiff_index is None:
+            print("(Skip) unusable pdiff index: "+diff_url+"Index")
+            return None
 
+        try:
+            # hash the cached packages file, to find where it sits in the patch history
+            old_sha = pdiff_index['hash']()
+            with open( lfp+lfn, "rb" ) as fh:
+                for chunk in self.hash_chunks( self.decompress_stream( self.read_chunks( fh ), vendor ), old_sha ):
+                    pass
+        except (IOError, EOFError, lzma.LZMAError) as e:
+            print("(Skip) Error reading cached pkgfile "+str(lfp+lfn)+" : "+str(e) )
+            return None
+
+        old_hash = old_sha.hexdigest()
+        if old_hash == pdiff_index['current']:
+            # cached file is already current, nothing changed
+            return [], []
+
+        history_names = [ name for hash_value, name in pdiff_index['history'] if hash_value == old_hash ]
+        if not history_names:
+            print("(Skip) cached pkgfile not in pdiff history: "+str(lfp+lfn) )
+            return None
+        if pdiff_index['merged']:
+            patch_names = history_names[:1]
+        else:
+            start = [ name for hash_value, name in pdiff_index['history'] ].index( history_names[0] )
+            patch_names = [ name for hash_value, name in pdiff_index['history'][start:] ]
+
+        patches = []
+        for name in patch_names:
+            print("fetching: "+diff_url+name+".gz")
+            patch_gz = self.fetch_url( diff_url+name+".gz" )
+            if patch_gz is None:
+                return None
+            metrics.inc( "index_fetch_bytes_total", len( patch_gz ), vendor=vendor )
+            try:
+                patch_data = gzip.decompress( patch_gz )
+            except (IOError, EOFError) as e:
+                print("(Skip) Error decompressing pdiff "+name+" : "+str(e) )
+                return None
+            if pdiff_index['hash']( patch_data ).hexdigest() != pdiff_index['patches'].get( name ):
+                print("(Skip) pdiff hash mismatch: "+diff_url+name+".gz")
+                return None
+            commands = self.parse_ed_patch( patch_data )
+            if commands is None:
+                print("(Skip) unsupported pdiff command in: "+diff_url+name+".gz")
+                return None
+            patches.append( commands )
+
+        # old file -> patches -> new file, one pass, sorting out the changed stanzas on the way
+        old_stanzas = {}
+        added = []
+        removed = []
+        new_sha = pdiff_index['hash']()
+        sha_uncompressed = hashlib.sha256()
+        sha_compressed = hashlib.sha256()
+        compressor = self.new_compressor( vendor )
+        try:
+            with open( lfp+lfn, "rb" ) as src_fh, open( lfp+lfn+".part", "wb" ) as dst_fh:
+                lines = self.number_stanzas( self.split_byte_lines( self.decompress_stream( self.read_chunks( src_fh ), vendor ) ), old_stanzas )
+                for commands in patches:
+                    lines = self.patch_lines( lines, commands )
+                buffer = bytearray()
+                separator = b""
+                for line in self.diff_stanzas( lines, old_stanzas, added, removed ):
+                    # lines are joined back up with the newlines split_byte_lines took out
+                    buffer += separator
+                    buffer += line
+                    separator = b"\n"
+                    if len( buffer ) >= STREAM_CHUNK_SIZE:
+                        self.write_patched( buffer, dst_fh, compressor, ( new_sha, sha_uncompressed ), sha_compressed )
+                        buffer = bytearray()
+                self.write_patched( buffer, dst_fh, compressor, ( new_sha, sha_uncompressed ), sha_compressed )
+                data = compressor.flush()
+                dst_fh.write( data )
+                sha_compressed.update( data )
+            if new_sha.hexdigest() != pdiff_index['current']:
+                raise ValueError( "patched pkgfile does not match current hash" )
+            os.replace( lfp+lfn+".part", lfp+lfn )
+        except (IOError, EOFError, lzma.LZMAError, ValueError) as e:
+            print("(Skip) Error patching pkgfile "+str(lfp+lfn)+" : "+str(e) )
+            try:
+                os.remove( lfp+lfn+".part" )
+            except OSError:
+                pass
+            return None
+
+        # our recompressed copy won't match the server's ETag or compressed hash, only the uncompressed hash
+        self.save_validators( lfp+lfn, { 'etag'                : None,
+                                         'last_modified'       : None,
+                                         'sha256'              : sha_compressed.hexdigest(),
+                                         'sha256_uncompressed' : sha_uncompressed.hexdigest() } )
+        self.index_cache.remember_hash( lfp+lfn, sha_compressed.hexdigest() )
+        return added, removed
+
+    """ (Internal) compress a block of the patched packages file into fh.
+        The block is added to each hash in sha_gens, the compressed data to sha_compressed """
+    def write_patched(self, data, fh, compressor, sha_gens, sha_compressed):
+        for sha_gen in sha_gens:
+            sha_gen.update( data )
+        data = compressor.compress( data )
+        fh.write( data )
+        sha_compressed.update( data )
+
+    """ Incremental sync of the Pkg Database for the vendor/dist/arch/section using Debian pdiffs.
+        Brings the Packages file cached in the incomming directory by the last sync up to date
+        ( see update_from_pdiff ), conditional fetch_and_parse_remote / fetch_remote_db do the same
+        before falling back to a full download.
+
+        Only stanzas that changed are parsed and returned, as ( pkg_list_new, pkg_list_old ):
+            pkg_list_new -- package records for stanzas that are in the new Packages file only
+            pkg_list_old -- package records for stanzas that were in the old Packages file only
+        both in file order.  Handing these two lists to ChangeSetGenerator gives the same change set
+        as the full lists.
+
+        returns None when pdiffs can't be used, fall back to fetch_and_parse_remote. """
+    def fetch_and_parse_pdiff(self, vendor="ubuntu", dist="trusty", arch="amd64", section="main"):
+        lfp = self.lmr_path+"/incomming"+self.pkg_db_subpath( dist, arch, section )
+        lfn = self.pkg_db_filename( vendor )
+
+        validators = self.load_validators( lfp+lfn )
+        if validators and self.release_says_unchanged( vendor, dist, arch, section, validators ):
+            # Release file says the cached copy is current, no need to look at the pdiffs
+            return [], []
+
+        changes = self.update_from_pdiff( vendor, dist, arch, section )
+        if changes is None:
+            return None
+        added, removed = changes
+        return self.parse_stanzas( added ), self.parse_stanzas( removed )
+
+    """ (Internal) Read package data line by line, yield a PkgRecord for each package.
+        PkgData can be any iterable of lines (list, open file, split_lines generator).
+        Debian and Ubuntu both use the same package database format """
+    def iterPkgData(self, PkgData ):
+        pkg_fields = None
+        records = 0
+
+        try:
+            # read file database, line by line
+            for line in PkgData:
+                line = line.rstrip()  # remove trailing whitespace and new lines from line.
+
+                if ( line == "" ):
+                    # end of record found, push back db_entry to database
+                    if pkg_fields:
+                        records += 1
+                        yield PkgRecord( *pkg_fields )
+                        pkg_fields = None # reset, ready for next new entry
+                    # else: nothing to add.. false end of record detected..
+                    continue
+
+                # "Field: value" lines, continuation lines start with a space and never match a field
+                field, sep, value = line.partition(": ")
+                index = PKG_FIELDS.get( field )
+                if index is not None and value:
+                    if pkg_fields is None:
+                        pkg_fields = [ None, None, None, None, None, None ]
+                    pkg_fields[index] = value
+
+            # database did not end with a blank line, last record is still pending
+            if pkg_fields:
+                records += 1
+                yield PkgRecord( *pkg_fields )
+        finally:
+            metrics.inc( "parse_records_total", records )
+    # end iterPkgData
+
+    """ (Internal) Read package data, build a PkgRecord for each package.
+        Place each record into a list. """
+    def parsePkgData(self, PkgData ):
+        return list( self.iterPkgData( PkgData ) )
+    # end parsePkgData
 
 
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic PkgIndexCache
+#############################################################################################################
+# PkgIndexCache
+# Binary on-disk cache of parsed package databases, so an index that has not changed since it was
+# last parsed does not need a bz2/xz decompress and parse pass again.
+#
+# Caches are keyed by the SHA256 of the compressed Packages file they were parsed from and live in
+#       ${cache_dir}/${sha256}.idx
+# The same database (our published dists/ copy and the incomming/ copy it was published from) shares
+# one cache file.  Hashing a big Packages file on every run would cost more than we want, so the
+# hash of each file is remembered against its size/mtime/inode in ${cache_dir}/by-path/.
+#
+# A cache file is memory-mapped and handed out as a PkgIndexView, a read only sequence of PkgRecords.
+# Opening it only checks the header, records are unpacked from the mapping when they are accessed.
+# record_keys() reads just ( pkgName, pkgArch, pkgVer ) of every record for diffing, without building
+# the PkgRecords.  A view holds the mapping and its file open until close() (or the end of a with block).
+#
+#   .idx file layout (little endian)
+#       header      magic "MMPKGIDX", format version (u32), record count (u32), string blob length (u64),
+#                   source sha256 (32 bytes)
+#       records     count x ( hash (32 bytes), size (u64), name/arch/ver/file offsets (4 x u32),
+#                             lengths (4 x u16), flags (u8, bit 0 = has hash, bit 1 = has size), 3 pad bytes )
+#       strings     UTF-8 string blob the offsets point into, each distinct string stored once
+#
+# Cache files (and hash memos) are written to a temp file of their own and renamed into place, two
+# processes storing the same database at once (the pipeline parses local and remote indexes in parallel,
+# unchanged ones are the same file) each rename a whole file.  load() only takes a file whose length
+# matches its header, a torn file is ignored.
+#
+#############################################################################################################
+
+import os
+import json
+import mmap
+import time
+import struct
+import hashlib
+import tempfile
+from collections.abc import Sequence
+
+from PkgRecord import PkgRecord
+from BlobStore import hash_file
+
+CACHE_MAGIC = b"MMPKGIDX"
+CACHE_VERSION = 3
+HEADER_STRUCT = struct.Struct( "<8sIIQ32s" )
+RECORD_STRUCT = struct.Struct( "<32sQ4I4HB3x" )
+
+# string length marking a field that is not set (None)
+NO_STRING = 0xFFFF
+
+# temp files older than this (seconds) are left over from a killed process, prune() removes them
+STALE_PART_AGE = 3600
+
+class PkgIndexView(Sequence):
+    """ read only sequence of PkgRecords backed by a memory-mapped cache file """
+    def __init__(self, fh, mm, count):
+        self.fh = fh
+        self.mm = mm
+        self.count = count
+        self.strings_offset = HEADER_STRUCT.size + count * RECORD_STRUCT.size
+
+    def __len__(self):
+        return self.count
+
+    """ (Internal) the string at offset/length in the string blob, None for a field that is not set """
+    def string_at(self, offset, length):
+        if length == NO_STRING:
+            return None
+        base = self.strings_offset + offset
+        return self.mm[ base : base+length ].decode('UTF-8')
+
+    """ (Internal) build the PkgRecord for one unpacked record """
+    def make_record(self, fields):
+        values = [ self.string_at( offset, length ) for offset, length in zip( fields[2:6], fields[6:10] ) ]
+        values.append( fields[0] if fields[10] & 1 else None )
+        values.append( fields[1] if fields[10] & 2 else None )
+        return PkgRecord( *values )
+
+    def __getitem__(self, index):
+        if isinstance( index, slice ):
+            return [ self[i] for i in range( *index.indices( self.count ) ) ]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError( "PkgIndexView index out of range" )
+        return self.make_record( RECORD_STRUCT.unpack_from( self.mm, HEADER_STRUCT.size + index * RECORD_STRUCT.size ) )
+
+    def __iter__(self):
+        table = memoryview( self.mm )[ HEADER_STRUCT.size : self.strings_offset ]
+        try:
+            for fields in RECORD_STRUCT.iter_unpack( table ):
+                yield self.make_record( fields )
+        finally:
+            table.release()
+
+    """ ( pkgName, pkgArch, pkgVer ) of every record in order, read straight from the mapping.
+        Each distinct string is stored once in the cache file and decoded once here. """
+    def record_keys(self):
+        strings = {}    # { ( offset, length ) : str }
+        table = memoryview( self.mm )[ HEADER_STRUCT.size : self.strings_offset ]
+        try:
+            for fields in RECORD_STRUCT.iter_unpack( table ):
+                key = []
+                # ( offset, length ) of the name, arch and version
+                for field in ( fields[2:7:4], fields[3:8:4], fields[4:9:4] ):
+                    value = strings.get( field )
+                    if value is None:
+                        value = strings[field] = self.string_at( *field )
+                    key.append( value )
+                yield tuple( key )
+        finally:
+            table.release()
+
+    """ unmap the cache file, records already handed out stay valid """
+    def close(self):
+        self.mm.close()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# end PkgIndexView
+
+
+class PkgIndexCache:
+    """ cache_dir is where the .idx files are kept, ex: /opt/mirror_magic/ubuntu/.pkgcache """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    """ (Internal) path of the cache file for a compressed database hash """
+    def cache_path(self, sha):
+        return os.path.join( self.cache_dir, sha+".idx" )
+
+    """ (Internal) path of the remembered hash for a packages file """
+    def memo_path(self, path):
+        return os.path.join( self.cache_dir, "by-path", hashlib.sha1( os.path.abspath(path).encode() ).hexdigest()+".json" )
+
+    """ SHA256 of the compressed packages file at path ( see BlobStore.hash_file ).
+        Remembered against the file's size/mtime/inode, the file is only read again when it changed.
+        Raises IOError when the file can't be read. """
+    def file_hash(self, path):
+        st = os.stat( path )
+        stamp = [ st.st_size, st.st_mtime_ns, st.st_ino ]
+        memo_path = self.memo_path( path )
+        try:
+            with open( memo_path, "r" ) as fh:
+                memo = json.load( fh )
+            if memo.get('stamp') == stamp:
+                return memo['sha256']
+        except (IOError, ValueError):
+            pass
+
+        sha = hash_file( path )
+        if sha is None:
+            raise IOError( "could not read "+str(path)+" to hash it" )
+        self.remember_hash( path, sha, stamp )
+        return sha
+
+    """ remember the SHA256 of the packages file at path, for when the caller already hashed it
+        while writing it (a fresh download).  stamp is [ size, mtime_ns, inode ], taken from path if not given """
+    def remember_hash(self, path, sha, stamp=None):
+        memo_path = self.memo_path( path )
+        try:
+            if stamp is None:
+                st = os.stat( path )
+                stamp = [ st.st_size, st.st_mtime_ns, st.st_ino ]
+            os.makedirs( os.path.dirname( memo_path ), exist_ok=True )
+            part_path = self.new_part( memo_path )
+            try:
+                with open( part_path, "w" ) as fh:
+                    json.dump( { 'path' : os.path.abspath(path), 'stamp' : stamp, 'sha256' : sha }, fh )
+                os.replace( part_path, memo_path )
+            except BaseException:
+                self.remove_part( part_path )
+                raise
+        except IOError as e:
+            print("(Warn) could not save hash memo for "+str(path)+" : "+str(e) )
+
+    """ memory-map the cache for a compressed database hash.
+        returns a PkgIndexView, or None when there is no (valid) cache for it """
+    def load(self, sha):
+        try:
+            fh = open( self.cache_path( sha ), "rb" )
+        except IOError:
+            return None
+        try:
+            mm = mmap.mmap( fh.fileno(), 0, access=mmap.ACCESS_READ )
+        except ( ValueError, OSError ):
+            # empty or unmappable file
+            fh.close()
+            return None
+
+        if len(mm) >= HEADER_STRUCT.size:
+            magic, version, count, strings_length, source_sha = HEADER_STRUCT.unpack_from( mm, 0 )
+            if magic == CACHE_MAGIC and version == CACHE_VERSION and source_sha == bytes.fromhex( sha ) \
+                    and len(mm) == HEADER_STRUCT.size + count * RECORD_STRUCT.size + strings_length:
+                return PkgIndexView( fh, mm, count )
+
+        print("(Warn) ignoring bad pkg index cache: "+self.cache_path( sha ) )
+        mm.close()
+        fh.close()
+        return None
+
+    """ (Internal) create a temp file of our own next to path, for writing path and renaming it into place.
+        returns the temp file path """
+    def new_part(self, path):
+        fd, part_path = tempfile.mkstemp( dir=os.path.dirname( path ), prefix=os.path.basename( path )+".", suffix=".part" )
+        os.close( fd )
+        return part_path
+
+    """ (Internal) drop a half written temp file """
+    def remove_part(self, part_path):
+        try:
+            os.remove( part_path )
+        except OSError:
+            pass
+
+    """ write the cache for a compressed database hash from an iterable of PkgRecords.
+        The record table is written as the records go by, only the string blob is held in memory.
+        returns True when the cache was written """
+    def store(self, sha, records):
+        path = self.cache_path( sha )
+        part_path = None
+        strings = {}            # { encoded string : offset in blob }
+        blob = bytearray()
+        count = 0
+        try:
+            os.makedirs( self.cache_dir, exist_ok=True )
+            part_path = self.new_part( path )
+            with open( part_path, "wb" ) as fh:
+                fh.write( HEADER_STRUCT.pack( CACHE_MAGIC, CACHE_VERSION, 0, 0, bytes.fromhex( sha ) ) )
+                for record in records:
+                    offsets = []
+                    lengths = []
+                    for value in ( record.name, record.arch, record.ver, record.file ):
+                        if value is None:
+                            offsets.append( 0 )
+                            lengths.append( NO_STRING )
+                            continue
+                        data = value.encode('UTF-8')
+                        offset = strings.get( data )
+                        if offset is None:
+                            offset = strings[data] = len(blob)
+                            blob += data
+                        offsets.append( offset )
+                        lengths.append( len(data) )
+                    if record.hash is not None and ( not isinstance( record.hash, bytes ) or len(record.hash) != 32 ):
+                        # not a sha256 digest, can't be stored in the fixed size hash field
+                        raise ValueError( "unexpected pkgHash for "+str(record.name) )
+                    if max( lengths ) > NO_STRING or len(blob) > 0xFFFFFFFF:
+                        raise ValueError( "field too long for pkg index cache: "+str(record.name) )
+                    flags = ( 1 if record.hash is not None else 0 ) | ( 2 if record.size is not None else 0 )
+                    fh.write( RECORD_STRUCT.pack( record.hash or bytes(32), record.size or 0, *offsets, *lengths, flags ) )
+                    count += 1
+                fh.write( blob )
+                # now the count is known, fix up the header
+                fh.seek( 0 )
+                fh.write( HEADER_STRUCT.pack( CACHE_MAGIC, CACHE_VERSION, count, len(blob), bytes.fromhex( sha ) ) )
+            os.replace( part_path, path )
+        except ( IOError, ValueError, struct.error ) as e:
+            print("(Warn) could not write pkg index cache "+str(path)+" : "+str(e) )
+            if part_path is not None:
+                self.remove_part( part_path )
+            return False
+        except BaseException:
+            # the records stopped part way (a truncated database), no half written cache file
+            if part_path is not None:
+                self.remove_part( part_path )
+            raise
+
+        self.prune( keep=sha )
+        return True
+
+    """ remove cache files no remembered packages file hash points at any more (except keep),
+        and temp files left behind by killed processes """
+    def prune(self, keep=None):
+        memo_dir = os.path.join( self.cache_dir, "by-path" )
+        wanted = { keep }
+        stale = time.time() - STALE_PART_AGE
+        try:
+            for name in os.listdir( memo_dir ):
+                try:
+                    if name.endswith(".part"):
+                        if os.stat( os.path.join( memo_dir, name ) ).st_mtime < stale:
+                            os.remove( os.path.join( memo_dir, name ) )
+                        continue
+                    with open( os.path.join( memo_dir, name ), "r" ) as fh:
+                        wanted.add( json.load( fh )['sha256'] )
+                except (IOError, ValueError, KeyError):
+                    pass
+            for name in os.listdir( self.cache_dir ):
+                path = os.path.join( self.cache_dir, name )
+                if name.endswith(".idx") and name[:-4] not in wanted:
+                    os.remove( path )
+                elif name.endswith(".part") and os.stat( path ).st_mtime < stale:
+                    os.remove( path )
+        except OSError:
+            pass
+
+# end PkgIndexCache
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
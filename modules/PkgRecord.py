@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic PkgRecord
+#############################################################################################################
+# PkgRecord
+# Compact record for one package database entry, as produced by PkgDBPuller.
+#
+# A full mirror holds millions of package entries, a python dict per entry costs hundreds of bytes
+# before counting its strings.  PkgRecord keeps the fields in __slots__ instead:
+#       name, arch, ver and file strings are interned, so the old and new package lists (and every
+#           index of the same arch) share one copy of each string they have in common.
+#       the SHA256 is stored as 32 raw bytes instead of a 64 character hex string.
+#
+# PkgRecord is a read only Mapping with the same keys the package dicts had, so existing code
+# like entry['pkgName'] or entry.get('pkgArch') keeps working
+#       pkgName = the name of the package
+#       pkgArch = Architecture the package support (amd64 multiarch arm etc..)
+#       pkgVer  = Version number for this package
+#       pkgFile = Mirror File Path / Name to the .deb file
+#       pkgHash = SHA256 hash finger print for the .deb file, as a hex string
+#       pkgSize = size of the .deb file in bytes, as an int
+#
+# A field that was not in the database entry is None and reads like a missing dict key (KeyError).
+#
+#############################################################################################################
+
+import sys
+from collections.abc import Mapping
+
+# Mapping key -> slot holding its value, in slot order
+PKG_KEYS = ( 'pkgName', 'pkgArch', 'pkgVer', 'pkgFile', 'pkgHash', 'pkgSize' )
+PKG_SLOTS = ( 'name', 'arch', 'ver', 'file', 'hash', 'size' )
+SLOT_OF_KEY = dict( zip( PKG_KEYS, PKG_SLOTS ) )
+
+class PkgRecord(Mapping):
+    """ fields are given in PKG_KEYS order, pkg_hash can be a hex string or 32 raw bytes,
+        pkg_size a string or int """
+    __slots__ = PKG_SLOTS
+    def __init__(self, pkg_name=None, pkg_arch=None, pkg_ver=None, pkg_file=None, pkg_hash=None, pkg_size=None):
+        self.name = sys.intern( pkg_name ) if pkg_name is not None else None
+        self.arch = sys.intern( pkg_arch ) if pkg_arch is not None else None
+        self.ver  = sys.intern( pkg_ver ) if pkg_ver is not None else None
+        self.file = sys.intern( pkg_file ) if pkg_file is not None else None
+        if isinstance( pkg_hash, str ):
+            try:
+                pkg_hash = bytes.fromhex( pkg_hash )
+            except ValueError:
+                # not a hex digest, keep it as it came
+                pass
+        self.hash = pkg_hash
+        if isinstance( pkg_size, str ):
+            try:
+                pkg_size = int( pkg_size )
+            except ValueError:
+                pkg_size = None
+        self.size = pkg_size
+
+    """ mapping access, entry['pkgName'] """
+    def __getitem__(self, key):
+        slot = SLOT_OF_KEY.get( key )
+        if slot is None:
+            raise KeyError( key )
+        value = getattr( self, slot )
+        if value is None:
+            raise KeyError( key )
+        if slot == 'hash' and isinstance( value, bytes ):
+            return value.hex()
+        return value
+
+    def __iter__(self):
+        for key, slot in zip( PKG_KEYS, PKG_SLOTS ):
+            if getattr( self, slot ) is not None:
+                yield key
+
+    def __len__(self):
+        return sum( 1 for slot in PKG_SLOTS if getattr( self, slot ) is not None )
+
+    def __contains__(self, key):
+        slot = SLOT_OF_KEY.get( key )
+        return slot is not None and getattr( self, slot ) is not None
+
+    def __eq__(self, other):
+        if isinstance( other, PkgRecord ):
+            return ( self.name, self.arch, self.ver, self.file, self.hash, self.size ) == \
+                   ( other.name, other.arch, other.ver, other.file, other.hash, other.size )
+        return Mapping.__eq__( self, other )
+
+    # records are compared by value like the dicts they replace, so they are not hashable
+    __hash__ = None
+
+    def __repr__(self):
+        return repr( dict( self.items() ) )
+
+    """ pickle as a plain tuple of the slots (process pools, caches) """
+    def __reduce__(self):
+        return ( PkgRecord, ( self.name, self.arch, self.ver, self.file, self.hash, self.size ) )
+
+# end PkgRecord
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic SyncJournal
+#############################################################################################################
+# SyncJournal
+# Crash safe record of a sync in progress, so a killed sync picks up where it stopped instead of
+# diffing and checking the whole mirror again.
+#
+# The journal is a SQLite database ( ${lmr_path}/.journal.db, WAL mode, every state change is its own
+# transaction ) holding for each sync
+#       syncs       the mirror spec and how far the sync got:  "diffing" -> "fetching" -> "published"
+#       indexes     every (dist, section, arch) diffed, its pipeline status and whether it is published
+#       entries     every change set entry and its state:
+#                       "queued"    recorded, not planned yet
+#                       "fetching"  in the download job list
+#                       "done"      file is on the mirror with the right hash (or nothing to do)
+#                       "failed"    download gave up, retried by the next run
+#
+# A restarted sync with the same spec resumes: indexes already diffed are not diffed again, entries
+# already done are not planned again, and the download try counts come back (so partial files are
+# resumed with Range requests).
+#
+# publish() moves the new Packages indexes from incomming/ to the published tree only once every
+# new/upgrade/downgrade entry of the sync is done, clients never see an index pointing at a missing file.
+# Removed packages are not deleted from the pool, the files can still be listed by indexes that did
+# not change in this sync.
+# A sync diffed with keep_versions ( see ChangeSetGenerator ) is published with the same keep_versions,
+# the published indexes then leave out the versions that were not mirrored.
+#
+# usage:
+#   journal = SyncJournal( local_mirror_root_path )
+#   journal.begin( spec )
+#   if not journal.diffed():
+#       for result in pipeline.run( spec, skip=journal.done_indexes() ):
+#           journal.record_index( result )
+#       journal.end_diff()
+#   planner = JobPlanner( remote_mirror_root_url, local_mirror_root_path )
+#   planner.add_change_set( journal.pending_change_set() )
+#   job_list = journal.mark_planned( planner, planner.plan() )
+#   failed_jobs_list = threaded_downloader( job_list, 16, on_job_done=journal.job_done )
+#   failed_jobs_list += planner.link_aliases()
+#   journal.settle( planner, failed_jobs_list )
+#   journal.publish( spec['vendor'] )       # keep_versions=N when the pipeline was run with it
+#
+#############################################################################################################
+
+import os
+import json
+import time
+import lzma
+import shutil
+import sqlite3
+
+from PkgRecord import PkgRecord
+from PkgDBPuller import PkgDBPuller
+from ChangeSetGenerator import ChangeSetEntry, check_keep_versions
+from JobPlanner import FETCH_CHANGES
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS syncs ( id INTEGER PRIMARY KEY, spec TEXT, state TEXT, started REAL, finished REAL );
+CREATE TABLE IF NOT EXISTS indexes ( sync_id INTEGER, dist TEXT, section TEXT, arch TEXT, status TEXT, published INTEGER,
+                                     PRIMARY KEY ( sync_id, dist, section, arch ) );
+CREATE TABLE IF NOT EXISTS entries ( id INTEGER PRIMARY KEY, sync_id INTEGER, dist TEXT, section TEXT, arch TEXT,
+                                     change TEXT, state TEXT, trys INTEGER, updated REAL,
+                                     new_name TEXT, new_arch TEXT, new_ver TEXT, new_file TEXT, new_hash TEXT, new_size INTEGER,
+                                     old_name TEXT, old_arch TEXT, old_ver TEXT, old_file TEXT, old_hash TEXT, old_size INTEGER );
+CREATE INDEX IF NOT EXISTS entries_by_file ON entries ( sync_id, new_file );
+"""
+
+# PkgRecord keys in the order they are stored in the entries table
+RECORD_COLUMNS = ( 'pkgName', 'pkgArch', 'pkgVer', 'pkgFile', 'pkgHash', 'pkgSize' )
+
+class SyncJournal:
+    """ local_mirror_root_path is where the journal database is kept and the indexes get published """
+    def __init__(self, local_mirror_root_path):
+        self.lmr_path = local_mirror_root_path
+        self.db_path = local_mirror_root_path.rstrip("/")+"/.journal.db"
+        os.makedirs( self.lmr_path, exist_ok=True )
+        self.db = sqlite3.connect( self.db_path )
+        self.db.execute( "PRAGMA journal_mode=WAL" )
+        self.db.execute( "PRAGMA synchronous=NORMAL" )
+        self.db.executescript( JOURNAL_SCHEMA )
+        self.sync_id = None
+
+    """ start a sync of spec, or resume the unfinished one with the same spec.
+        An unfinished sync of another spec is abandoned.  returns True when resuming """
+    def begin(self, spec):
+        spec_text = json.dumps( spec, sort_keys=True )
+        with self.db:
+            for sync_id, old_spec in self.db.execute( "SELECT id, spec FROM syncs WHERE state IN ( 'diffing', 'fetching' ) ORDER BY id DESC" ).fetchall():
+                if old_spec == spec_text and self.sync_id is None:
+                    self.sync_id = sync_id
+                else:
+                    self.db.execute( "UPDATE syncs SET state = 'abandoned', finished = ? WHERE id = ?", ( time.time(), sync_id ) )
+            if self.sync_id is not None:
+                print("Resuming sync #"+str(self.sync_id) )
+                return True
+            self.sync_id = self.db.execute( "INSERT INTO syncs ( spec, state, started ) VALUES ( ?, 'diffing', ? )", ( spec_text, time.time() ) ).lastrowid
+        return False
+
+    """ (Internal) state of the current sync """
+    def state(self):
+        return self.db.execute( "SELECT state FROM syncs WHERE id = ?", ( self.sync_id, ) ).fetchone()[0]
+
+    """ True once every index of the sync has been diffed ( end_diff() was called ) """
+    def diffed(self):
+        return self.state() != "diffing"
+
+    """ (dist, section, arch) of the indexes already diffed in this sync, for MirrorPipeline.run( skip= ).
+        Indexes that failed are left out, they are tried again """
+    def done_indexes(self):
+        rows = self.db.execute( "SELECT dist, section, arch FROM indexes WHERE sync_id = ? AND status != 'error'", ( self.sync_id, ) )
+        return { tuple( row ) for row in rows }
+
+    """ (Internal) the stored columns of a package record, all None for no record """
+    def record_values(self, record):
+        if record is None:
+            return ( None, ) * len( RECORD_COLUMNS )
+        return tuple( record.get( key ) for key in RECORD_COLUMNS )
+
+    """ record a MirrorPipeline result: the index and all the entries of its change set, in one transaction """
+    def record_index(self, result):
+        index = ( result['dist'], result['section'], result['arch'] )
+        with self.db:
+            self.db.execute( "DELETE FROM entries WHERE sync_id = ? AND dist = ? AND section = ? AND arch = ?", ( self.sync_id, ) + index )
+            self.db.execute( "INSERT OR REPLACE INTO indexes VALUES ( ?, ?, ?, ?, ?, 0 )", ( self.sync_id, ) + index + ( result['status'], ) )
+            now = time.time()
+            self.db.executemany( "INSERT INTO entries ( sync_id, dist, section, arch, change, state, trys, updated,"
+                                 " new_name, new_arch, new_ver, new_file, new_hash, new_size,"
+                                 " old_name, old_arch, old_ver, old_file, old_hash, old_size )"
+                                 " VALUES ( ?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )",
+                                 ( ( self.sync_id, ) + index + ( entry['change'], entry['state'], now ) +
+                                   self.record_values( entry['pkgInfoNew'] ) + self.record_values( entry['pkgInfoOld'] )
+                                   for entry in result['change_set'] ) )
+
+    """ every index is recorded, move the sync on to fetching """
+    def end_diff(self):
+        with self.db:
+            self.db.execute( "UPDATE syncs SET state = 'fetching' WHERE id = ?", ( self.sync_id, ) )
+
+    """ change set of the new/upgrade/downgrade entries not done yet, for JobPlanner.add_change_set """
+    def pending_change_set(self):
+        placeholders = ", ".join( "?" for change in FETCH_CHANGES )
+        rows = self.db.execute( "SELECT change, state, new_name, new_arch, new_ver, new_file, new_hash, new_size FROM entries"
+                                " WHERE sync_id = ? AND state != 'done' AND change IN ( "+placeholders+" )",
+                                ( self.sync_id, ) + tuple( FETCH_CHANGES ) )
+        return [ ChangeSetEntry( row[0], PkgRecord( *row[2:] ), None, row[1] ) for row in rows ]
+
+    """ (Internal) set the state of every entry for a pool file """
+    def set_file_state(self, pkg_file, state, trys=None):
+        if trys is None:
+            self.db.execute( "UPDATE entries SET state = ?, updated = ? WHERE sync_id = ? AND new_file = ?",
+                             ( state, time.time(), self.sync_id, pkg_file ) )
+        else:
+            self.db.execute( "UPDATE entries SET state = ?, trys = ?, updated = ? WHERE sync_id = ? AND new_file = ?",
+                             ( state, trys, time.time(), self.sync_id, pkg_file ) )
+
+    """ (Internal) pool file a job is for """
+    def job_file(self, job):
+        if job.get('path'):
+            return job['path']
+        return os.path.relpath( job['dst'], self.lmr_path )
+
+    """ record a JobPlanner plan: planned files are "fetching" and get back the try count of the
+        last run, files the planner found on disk (or in its blob store) are "done".
+        A file that was "fetching" or "failed" has been tried at least once, even when the run was
+        killed before the try was recorded, so its next try resumes the partial file.
+        returns job_list """
+    def mark_planned(self, planner, job_list):
+        alias_files = { pkg_file for pkg_file, first_file in planner.aliases }
+        with self.db:
+            for job in job_list:
+                pkg_file = self.job_file( job )
+                row = self.db.execute( "SELECT MAX( trys ), MAX( state IN ( 'fetching', 'failed' ) ) FROM entries"
+                                       " WHERE sync_id = ? AND new_file = ?", ( self.sync_id, pkg_file ) ).fetchone()
+                job['trys'] = max( job['trys'], row[0] or 0, 1 if row[1] else 0 )
+                self.set_file_state( pkg_file, "fetching" )
+            for pkg_file in planner.files:
+                if pkg_file not in planner.planned and pkg_file not in alias_files:
+                    self.set_file_state( pkg_file, "done" )
+        return job_list
+
+    """ downloader callback ( on_job_done ), records how a job's latest try went """
+    def job_done(self, job):
+        with self.db:
+            self.set_file_state( self.job_file( job ), "done" if job['complete'] else "failed", job['trys'] )
+
+    """ after the downloads and JobPlanner.link_aliases: aliased files are done unless they are in
+        failed_jobs_list, which are all failed """
+    def settle(self, planner, failed_jobs_list):
+        failed = { self.job_file( job ) for job in failed_jobs_list }
+        with self.db:
+            for pkg_file, first_file in planner.aliases:
+                if pkg_file not in failed:
+                    self.set_file_state( pkg_file, "done" )
+            for job in failed_jobs_list:
+                self.set_file_state( self.job_file( job ), "failed", job['trys'] )
+
+    """ number of new/upgrade/downgrade entries of the sync not done yet """
+    def pending_count(self):
+        placeholders = ", ".join( "?" for change in FETCH_CHANGES )
+        return self.db.execute( "SELECT COUNT(*) FROM entries WHERE sync_id = ? AND state != 'done' AND change IN ( "+placeholders+" )",
+                                ( self.sync_id, ) + tuple( FETCH_CHANGES ) ).fetchone()[0]
+
+    """ (Internal) put the staged database at src in place at dst, hardlinked so the incomming copy
+        stays for the next conditional fetch """
+    def install_file(self, src, dst):
+        tmp = dst+".publish"
+        os.makedirs( os.path.dirname( dst ), exist_ok=True )
+        try:
+            os.remove( tmp )
+        except FileNotFoundError:
+            pass
+        try:
+            os.link( src, tmp )
+        except OSError:
+            shutil.copy2( src, tmp )
+        os.replace( tmp, dst )
+
+    """ publish the new Packages indexes of the sync from incomming/, once every entry is done.
+        keep_versions has to be the one the change sets were made with, the indexes are then
+        published without the versions it leaves out.
+        returns True when the sync is published """
+    def publish(self, vendor="ubuntu", keep_versions=None):
+        check_keep_versions( keep_versions )
+        pending = self.pending_count()
+        if pending:
+            print("(Skip) not publishing, "+str(pending)+" change set entries are not done yet" )
+            return False
+
+        puller = PkgDBPuller( None, self.lmr_path )
+        rows = self.db.execute( "SELECT dist, section, arch FROM indexes WHERE sync_id = ? AND status = 'fetched' AND published = 0",
+                                ( self.sync_id, ) ).fetchall()
+        for dist, section, arch in rows:
+            subpath = puller.pkg_db_subpath( dist, arch, section )+puller.pkg_db_filename( vendor )
+            src = self.lmr_path+"/incomming"+subpath
+            dst = self.lmr_path+subpath
+            try:
+                if keep_versions is None:
+                    self.install_file( src, dst )
+                    # same inode and mtime as the incomming copy, its hash is known already
+                    puller.index_cache.remember_hash( dst, puller.index_cache.file_hash( src ) )
+                else:
+                    # a copy with only the versions that were mirrored
+                    os.makedirs( os.path.dirname( dst ), exist_ok=True )
+                    puller.write_pruned_db( src, dst+".publish", vendor, keep_versions )
+                    os.replace( dst+".publish", dst )
+            except ( IOError, EOFError, lzma.LZMAError ) as e:
+                print("(Warn) could not publish "+str(dst)+" : "+str(e) )
+                return False
+            with self.db:
+                self.db.execute( "UPDATE indexes SET published = 1 WHERE sync_id = ? AND dist = ? AND section = ? AND arch = ?",
+                                 ( self.sync_id, dist, section, arch ) )
+            print("published: "+str(dst))
+
+        with self.db:
+            self.db.execute( "UPDATE entries SET state = 'done', updated = ? WHERE sync_id = ? AND state != 'done'", ( time.time(), self.sync_id ) )
+            self.db.execute( "UPDATE syncs SET state = 'published', finished = ? WHERE id = ?", ( time.time(), self.sync_id ) )
+        return True
+
+    """ close the journal database """
+    def close(self):
+        self.db.close()
+
+# end SyncJournal
+
+
+if __name__ == "__main__":
+    print("Not designed to be run standalone.. This is a module class definition")
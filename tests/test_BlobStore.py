@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic BlobStore tests
+#############################################################################################################
+# Files filed in the store come back out at other paths, copied (not hardlinked) blobs are kept while
+# a path they were put at is there, and whole file hashing ( hash_file, also behind PkgIndexCache )
+# is counted in the hash metrics.
+#
+# usage:
+#   python3 -m unittest discover tests      ( or: python3 -m pytest tests )
+#
+#############################################################################################################
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", "modules" ) )
+
+from BlobStore import BlobStore, hash_file
+from PkgIndexCache import PkgIndexCache
+from Metrics import metrics
+
+PAYLOAD = b"blob store test payload\n" * 1000
+SHA = hashlib.sha256( PAYLOAD ).hexdigest()
+
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = BlobStore( os.path.join( self.root, ".blobs" ) )
+        self.pool_file = os.path.join( self.root, "pool", "a.deb" )
+        os.makedirs( os.path.dirname( self.pool_file ) )
+        with open( self.pool_file, "wb" ) as fh:
+            fh.write( PAYLOAD )
+
+    def tearDown(self):
+        shutil.rmtree( self.root )
+
+    """ (Internal) value of a counter without labels """
+    def counter(self, name):
+        return metrics.counters.get( metrics.key( name, {} ), 0 )
+
+    def test_hash_file(self):
+        hashed = self.counter( "hash_bytes_total" )
+        self.assertEqual( hash_file( self.pool_file ), SHA )
+        self.assertEqual( self.counter( "hash_bytes_total" ), hashed + len(PAYLOAD) )
+        errors = self.counter( "hash_errors_total" )
+        self.assertIsNone( hash_file( os.path.join( self.root, "missing" ) ) )
+        self.assertEqual( self.counter( "hash_errors_total" ), errors + 1 )
+
+    def test_index_cache_hashes_through_hash_file(self):
+        cache = PkgIndexCache( os.path.join( self.root, ".pkgcache" ) )
+        hashed = self.counter( "hash_bytes_total" )
+        self.assertEqual( cache.file_hash( self.pool_file ), SHA )
+        # remembered, the second call does not read the file
+        self.assertEqual( cache.file_hash( self.pool_file ), SHA )
+        self.assertEqual( self.counter( "hash_bytes_total" ), hashed + len(PAYLOAD) )
+
+    def test_add_and_materialize(self):
+        self.assertFalse( self.store.materialize( SHA, os.path.join( self.root, "other", "a.deb" ) ) )
+        self.assertTrue( self.store.add( self.pool_file, SHA ) )
+        self.assertTrue( self.store.has( SHA ) )
+        dst = os.path.join( self.root, "other", "a.deb" )
+        self.assertTrue( self.store.materialize( SHA, dst ) )
+        with open( dst, "rb" ) as fh:
+            self.assertEqual( fh.read(), PAYLOAD )
+        self.assertEqual( self.store.stats["hardlinks"], 1 )
+        self.assertEqual( self.store.import_tree( os.path.join( self.root, "pool" ) ), 0 )
+
+    def test_copied_blob_kept_while_referenced(self):
+        # no hardlinks (another filesystem), no reflinks: the blob is a copy with a reference list
+        with mock.patch( "os.link", side_effect=OSError( "no hardlinks" ) ), \
+             mock.patch( "BlobStore.reflink", return_value=False ):
+            self.assertTrue( self.store.add( self.pool_file, SHA ) )
+        blob = self.store.blob_path( SHA )
+        self.assertEqual( os.stat( blob ).st_nlink, 1 )
+        self.assertEqual( self.store.prune( max_age_days=0 ), 0 )
+
+        # the pool file goes, the blob is kept until nothing used it for max_age_days
+        os.remove( self.pool_file )
+        self.assertEqual( self.store.prune( max_age_days=1 ), 0 )
+        self.assertTrue( self.store.has( SHA ) )
+        old = time.time() - 2 * 86400
+        os.utime( self.store.refs_path( blob ), ( old, old ) )
+        self.assertEqual( self.store.prune( max_age_days=1 ), 1 )
+        self.assertFalse( self.store.has( SHA ) )
+
+
+if __name__ == "__main__":
+    unittest.main()
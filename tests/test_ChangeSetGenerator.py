@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic ChangeSetGenerator tests
+#############################################################################################################
+# Checks how the change set engine pairs up the versions of each (pkgName, pkgArch): upgrades and
+# downgrades in dpkg order, extra versions, removes, keep_versions pruning, and that a memory-mapped
+# PkgIndexView diffs the same as a list of records.
+#
+# usage:
+#   python3 -m unittest discover tests      ( or: python3 -m pytest tests )
+#
+#############################################################################################################
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", "modules" ) )
+
+from ChangeSetGenerator import ChangeSetGenerator, pruned_versions, record_keys
+from PkgIndexCache import PkgIndexCache
+from PkgRecord import PkgRecord
+
+
+""" a package record for name / version, arch amd64 unless given """
+def record(name, ver, arch="amd64"):
+    return PkgRecord( name, arch, ver, "pool/"+name+"_"+ver+"_"+arch+".deb", hashlib.sha256( ( name+ver+arch ).encode() ).hexdigest() )
+
+
+""" ( change, new version, old version ) of every entry of a computed change set, in change set order """
+def changes(pkg_list_new, pkg_list_old, keep_versions=None):
+    csg = ChangeSetGenerator( pkg_list_new, pkg_list_old, keep_versions )
+    csg.compute_change_set()
+    return [ ( entry['change'],
+               entry['pkgInfoNew']['pkgName']+" "+entry['pkgInfoNew']['pkgVer'] if entry['pkgInfoNew'] else None,
+               entry['pkgInfoOld']['pkgName']+" "+entry['pkgInfoOld']['pkgVer'] if entry['pkgInfoOld'] else None )
+             for entry in csg.change_set ]
+
+
+class ChangeSetVersionTest(unittest.TestCase):
+
+    def test_upgrade_downgrade(self):
+        old = [ record( "a", "1.0-1" ), record( "b", "2:1.0" ), record( "c", "1.0~rc1" ) ]
+        new = [ record( "a", "1.0-2" ), record( "b", "1:9.9" ), record( "c", "1.0" ) ]
+        self.assertEqual( changes( new, old ),
+                          [ ( "upgrade", "a 1.0-2", "a 1.0-1" ), ( "downgrade", "b 1:9.9", "b 2:1.0" ), ( "upgrade", "c 1.0", "c 1.0~rc1" ) ] )
+
+    def test_keep_versions(self):
+        pkg_list = [ record( "a", v ) for v in ( "1.0", "2.0", "1:0.5" ) ] + [ record( "b", "3" ) ]
+        self.assertEqual( pruned_versions( record_keys( pkg_list ), 1 ), { ( "a", "amd64", "1.0" ), ( "a", "amd64", "2.0" ) } )
+        # an unchanged index that was published pruned gives no change set
+        self.assertEqual( changes( pkg_list, [ pkg_list[2], pkg_list[3] ], keep_versions=1 ), [] )
+        self.assertRaises( ValueError, ChangeSetGenerator, pkg_list, [], 0 )
+
+
+class ChangeSetPairingTest(unittest.TestCase):
+
+    def test_new_and_remove(self):
+        old = [ record( "a", "1" ), record( "gone", "1" ), record( "b", "1" ) ]
+        new = [ record( "b", "1" ), record( "fresh", "2" ), record( "a", "1" ) ]
+        self.assertEqual( changes( new, old ), [ ( "new", "fresh 2", None ), ( "remove", None, "gone 1" ) ] )
+
+    def test_arches_are_separate_packages(self):
+        old = [ record( "a", "1", "amd64" ) ]
+        new = [ record( "a", "1", "amd64" ), record( "a", "2", "arm64" ) ]
+        self.assertEqual( changes( new, old ), [ ( "new", "a 2", None ) ] )
+        self.assertEqual( changes( old, new ), [ ( "remove", None, "a 2" ) ] )
+
+    def test_several_versions(self):
+        # versions in both lists are left alone, new ones take the old ones that went away in list order
+        old = [ record( "a", "1.0" ), record( "a", "1.1" ), record( "a", "1.2" ) ]
+        new = [ record( "a", "1.1" ), record( "a", "2.0" ), record( "a", "0.9" ) ]
+        self.assertEqual( changes( new, old ),
+                          [ ( "upgrade", "a 2.0", "a 1.0" ), ( "downgrade", "a 0.9", "a 1.2" ) ] )
+        # more new versions than went away: the rest are extra versions
+        self.assertEqual( changes( new, old[:2] ),
+                          [ ( "upgrade", "a 2.0", "a 1.0" ), ( "new", "a 0.9", None ) ] )
+        # fewer: what is left over is removed
+        self.assertEqual( changes( new[:2], old ),
+                          [ ( "upgrade", "a 2.0", "a 1.0" ), ( "remove", None, "a 1.2" ) ] )
+
+    def test_unchanged(self):
+        pkg_list = [ record( "a", "1" ), record( "a", "2" ), record( "b", "1", "all" ) ]
+        self.assertEqual( changes( pkg_list, list( reversed( pkg_list ) ) ), [] )
+
+    def test_keep_versions_pairing(self):
+        # only the two highest versions are mirrored, the old 1 goes to the first kept version
+        new = [ record( "a", v ) for v in ( "1", "2", "3" ) ]
+        self.assertEqual( changes( new, [ record( "a", "1" ) ], keep_versions=2 ),
+                          [ ( "upgrade", "a 2", "a 1" ), ( "new", "a 3", None ) ] )
+        # a version that drops out of the kept ones is removed
+        self.assertEqual( changes( new, new[1:], keep_versions=1 ), [ ( "remove", None, "a 2" ) ] )
+
+    def test_generators(self):
+        old = [ record( "a", "1" ), record( "b", "1" ) ]
+        new = [ record( "a", "2" ), record( "c", "1" ) ]
+        self.assertEqual( changes( iter( new ), iter( old ) ), changes( new, old ) )
+
+    def test_index_view(self):
+        root = tempfile.mkdtemp()
+        try:
+            cache = PkgIndexCache( root )
+            old = [ record( "a", "1.0" ), record( "b", "1" ), record( "c", "1" ), record( "d", "1:0" ) ]
+            new = [ record( "a", "1.1" ), record( "c", "1" ), record( "d", "1.0" ), record( "e", "1" ) ]
+            # a store prunes caches no packages file points at, map each one as soon as it is written
+            self.assertTrue( cache.store( "0"*64, old ) )
+            with cache.load( "0"*64 ) as old_view:
+                self.assertTrue( cache.store( "1"*64, new ) )
+                new_view = cache.load( "1"*64 )
+                with new_view:
+                    self.assertEqual( changes( new_view, old_view ), changes( new, old ) )
+                    self.assertEqual( changes( new_view, old_view ),
+                                      [ ( "upgrade", "a 1.1", "a 1.0" ), ( "downgrade", "d 1.0", "d 1:0" ),
+                                        ( "new", "e 1", None ), ( "remove", None, "b 1" ) ] )
+        finally:
+            shutil.rmtree( root )
+
+
+if __name__ == "__main__":
+    unittest.main()
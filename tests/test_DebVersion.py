@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic DebVersion tests
+#############################################################################################################
+# Checks the DebVersion sort keys against dpkg's ordering rules, and against dpkg --compare-versions
+# itself on random version pairs when dpkg is installed.
+#
+# usage:
+#   python3 -m unittest discover tests      ( or: python3 -m pytest tests )
+#
+#############################################################################################################
+
+import os
+import sys
+import random
+import shutil
+import unittest
+import subprocess
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", "modules" ) )
+
+from DebVersion import version_key, version_keys, compare_versions
+
+# ( a, b, expected compare_versions( a, b ) ), expected as dpkg --compare-versions answers it
+KNOWN_PAIRS = [ ( "1.0", "1.0", 0 ),
+                ( "1.0", "1.00", 0 ),           # digit runs compare as numbers
+                ( "1.", "1.0", 0 ),             # an empty digit run is 0
+                ( "1.0", "1.0-0", 0 ),          # no revision is the same as revision "0"
+                ( "0:1.0", "1.0", 0 ),
+                ( "1.0", "1.1", -1 ),
+                ( "1.9", "1.10", -1 ),
+                ( "1.0", "1.0.1", -1 ),
+                ( "1.0~rc1", "1.0", -1 ),       # '~' sorts before the end of the string
+                ( "1.0~~", "1.0~", -1 ),
+                ( "1.0~rc1", "1.0~rc2", -1 ),
+                ( "1.0", "1.0a", -1 ),
+                ( "1.0a", "1.0+", -1 ),         # letters sort before other characters
+                ( "1.0+", "1.0.", -1 ),         # other characters by ASCII value
+                ( "1.0-1", "1.0-1build1", -1 ),
+                ( "1.0-1~bpo1", "1.0-1", -1 ),
+                ( "1.0-1", "1.0-2", -1 ),
+                ( "1.0-1-1", "1.0-1-2", -1 ),   # the revision starts after the last '-'
+                ( "9.9", "1:0.1", -1 ),         # the epoch wins over everything else
+                ( "1:9.9", "2:0.1", -1 ),
+                ( "2.30-1ubuntu0.1", "2.30-1ubuntu1", -1 ) ]
+
+# building blocks for random versions
+RANDOM_ATOMS = [ "0", "1", "2", "10", "01", "a", "b", "Z", "~", "~~", "+", ".", "-", "~rc1", "build1", "ubuntu1", "dfsg", "+b1" ]
+
+
+class DebVersionTest(unittest.TestCase):
+
+    def test_known_pairs(self):
+        for a, b, expected in KNOWN_PAIRS:
+            self.assertEqual( compare_versions( a, b ), expected, a+" vs "+b )
+            self.assertEqual( compare_versions( b, a ), -expected, b+" vs "+a )
+
+    def test_batch_matches_single(self):
+        versions = [ a for a, b, expected in KNOWN_PAIRS ] * 2
+        self.assertEqual( version_keys( versions ), [ version_key( v ) for v in versions ] )
+
+    def test_sort(self):
+        versions = [ "1.0", "1:0.1", "1.0~rc1", "1.0-1", "0.9", "1.0+b1", "1.0a" ]
+        self.assertEqual( sorted( versions, key=version_key ),
+                          [ "0.9", "1.0~rc1", "1.0", "1.0-1", "1.0a", "1.0+b1", "1:0.1" ] )
+
+    @unittest.skipUnless( shutil.which( "dpkg" ), "dpkg is not installed" )
+    def test_against_dpkg(self):
+        rng = random.Random( 1 )
+        checked = 0
+        while checked < 300:
+            a, b = ( str( rng.randint( 0, 3 ) ) + "".join( rng.choice( RANDOM_ATOMS ) for i in range( rng.randint( 0, 4 ) ) )
+                     for j in range( 2 ) )
+            lt = subprocess.run( [ "dpkg", "--compare-versions", a, "lt", b ], capture_output=True )
+            if lt.stderr:
+                # dpkg rejects the version, nothing to compare against
+                continue
+            eq = subprocess.run( [ "dpkg", "--compare-versions", a, "eq", b ], capture_output=True ).returncode == 0
+            expected = -1 if lt.returncode == 0 else ( 0 if eq else 1 )
+            self.assertEqual( compare_versions( a, b ), expected, a+" vs "+b )
+            checked += 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic PkgDBPuller pdiff tests
+#############################################################################################################
+# Patches made with diff --ed are applied with parse_ed_patch / patch_lines and have to give the new
+# Packages file byte for byte.  A mirror published on the filesystem (file:// urls) is then synced
+# with fetch_and_parse_pdiff through a chained and through a merged patch history, both have to
+# leave the same file in the incomming directory and report the same changed stanzas.
+#
+# usage:
+#   python3 -m unittest discover tests      ( or: python3 -m pytest tests )
+#
+#############################################################################################################
+
+import os
+import sys
+import lzma
+import gzip
+import random
+import shutil
+import hashlib
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", "modules" ) )
+
+from PkgDBPuller import PkgDBPuller
+
+SUBPATH = "/dists/t/main/binary-amd64/"
+
+
+""" Packages file text for { name : version } """
+def packages_file(versions):
+    return "".join( "Package: %s\nArchitecture: amd64\nVersion: %s\nFilename: pool/%s_%s.deb\nSize: %d\nSHA256: %s\n\n"
+                    % ( name, ver, name, ver, len(name+ver), hashlib.sha256( ( name+ver ).encode() ).hexdigest() )
+                    for name, ver in sorted( versions.items() ) ).encode('UTF-8')
+
+
+""" the { name : version } of each Packages file in a history, every step upgrades, adds and removes a few packages """
+def history(steps, seed=1):
+    rng = random.Random( seed )
+    versions = { "pkg%03d" % n : "1.0-%d" % rng.randint( 1, 9 ) for n in range( 200 ) }
+    files = [ dict( versions ) ]
+    for step in range( steps ):
+        for name in rng.sample( sorted( versions ), 15 ):
+            versions[name] = versions[name]+"+u%d" % step
+        for name in rng.sample( sorted( versions ), 5 ):
+            del versions[name]
+        for n in range( 5 ):
+            versions[ "new%d-%03d" % ( step, n ) ] = "0.%d" % n
+        files.append( dict( versions ) )
+    return files
+
+
+""" diff --ed script turning old into new """
+def ed_patch(root, old, new):
+    with open( os.path.join( root, "old" ), "wb" ) as fh:
+        fh.write( old )
+    with open( os.path.join( root, "new" ), "wb" ) as fh:
+        fh.write( new )
+    return subprocess.run( [ "diff", "--ed", os.path.join( root, "old" ), os.path.join( root, "new" ) ], capture_output=True ).stdout
+
+
+@unittest.skipUnless( shutil.which( "diff" ), "diff is not installed" )
+class PdiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = [ packages_file( versions ) for versions in history( 4 ) ]
+
+    def tearDown(self):
+        shutil.rmtree( self.root )
+
+    def test_patch_chain(self):
+        puller = PkgDBPuller( None, self.root )
+        lines = ( ( line, 0 ) for line in puller.split_byte_lines( [ self.files[0] ] ) )
+        for old, new in zip( self.files, self.files[1:] ):
+            commands = puller.parse_ed_patch( ed_patch( self.root, old, new ) )
+            self.assertIsNotNone( commands )
+            lines = puller.patch_lines( lines, commands )
+        self.assertEqual( b"\n".join( line for line, origin in lines ), self.files[-1] )
+
+    def test_bad_patches(self):
+        puller = PkgDBPuller( None, self.root )
+        self.assertIsNone( puller.parse_ed_patch( b"1,2x\n" ) )
+        self.assertIsNone( puller.parse_ed_patch( b"3,1d\n" ) )
+        # commands have to go bottom to top and stay inside the file
+        for patch in ( b"1d\n3d\n", b"9d\n" ):
+            lines = ( ( line, 0 ) for line in b"a\nb\nc\n".split(b"\n") )
+            with self.assertRaises( ValueError ):
+                list( puller.patch_lines( lines, puller.parse_ed_patch( patch ) ) )
+
+    """ (Internal) publish the last file of the history on a mirror below root/remote, with a pdiff for each
+        older file ( chained: to the next file, merged: straight to the last ), and cache the first file
+        in the incomming directory of root/local.  returns a PkgDBPuller for the two """
+    def publish(self, merged):
+        sha = lambda data: hashlib.sha256( data ).hexdigest()
+        remote = os.path.join( self.root, "remote" )
+        local = os.path.join( self.root, "local" )
+        shutil.rmtree( remote, ignore_errors=True )
+        shutil.rmtree( local, ignore_errors=True )
+        os.makedirs( remote+SUBPATH+"Packages.diff" )
+        os.makedirs( local+"/incomming"+SUBPATH )
+
+        current = self.files[-1]
+        index = "SHA256-Current: %s %d\n" % ( sha( current ), len(current) )
+        index_history = "SHA256-History:\n"
+        index_patches = "SHA256-Patches:\n"
+        for n, old in enumerate( self.files[:-1] ):
+            patch = ed_patch( self.root, old, current if merged else self.files[n+1] )
+            name = "T-%d" % n
+            with open( remote+SUBPATH+"Packages.diff/"+name+".gz", "wb" ) as fh:
+                fh.write( gzip.compress( patch ) )
+            index_history += " %s %d %s\n" % ( sha( old ), len(old), name )
+            index_patches += " %s %d %s\n" % ( sha( patch ), len(patch), name )
+        index += index_history + index_patches + ( "X-Patch-Precedence: merged\n" if merged else "" )
+        with open( remote+SUBPATH+"Packages.diff/Index", "w" ) as fh:
+            fh.write( index )
+        with open( remote+SUBPATH+"Packages.xz", "wb" ) as fh:
+            fh.write( lzma.compress( current ) )
+        with open( local+"/incomming"+SUBPATH+"Packages.xz", "wb" ) as fh:
+            fh.write( lzma.compress( self.files[0] ) )
+        return PkgDBPuller( "file://"+remote, local )
+
+    """ (Internal) sync the cached file through the published pdiffs, returns the changed package versions """
+    def sync(self, puller):
+        with puller:
+            pkg_list_new, pkg_list_old = puller.fetch_and_parse_pdiff( "debian", "t", "amd64", "main" )
+            with open( puller.lmr_path+"/incomming"+SUBPATH+"Packages.xz", "rb" ) as fh:
+                self.assertEqual( lzma.decompress( fh.read() ), self.files[-1] )
+            return ( [ ( r['pkgName'], r['pkgVer'] ) for r in pkg_list_new ], [ ( r['pkgName'], r['pkgVer'] ) for r in pkg_list_old ] )
+
+    def test_chained_and_merged_history(self):
+        first, last = history( 4 )[0].items(), history( 4 )[-1].items()
+        expected = ( sorted( set( last ) - set( first ) ), sorted( set( first ) - set( last ) ) )
+        self.assertEqual( self.sync( self.publish( merged=False ) ), expected )
+        self.assertEqual( self.sync( self.publish( merged=True ) ), expected )
+
+    def test_current_file_needs_no_patch(self):
+        puller = self.publish( merged=False )
+        with open( puller.lmr_path+"/incomming"+SUBPATH+"Packages.xz", "wb" ) as fh:
+            fh.write( lzma.compress( self.files[-1] ) )
+        with puller:
+            self.assertEqual( puller.fetch_and_parse_pdiff( "debian", "t", "amd64", "main" ), ( [], [] ) )
+
+    def test_unknown_file_falls_back(self):
+        puller = self.publish( merged=True )
+        with open( puller.lmr_path+"/incomming"+SUBPATH+"Packages.xz", "wb" ) as fh:
+            fh.write( lzma.compress( packages_file( { "other" : "1" } ) ) )
+        with puller:
+            self.assertIsNone( puller.fetch_and_parse_pdiff( "debian", "t", "amd64", "main" ) )
+
+
+if __name__ == "__main__":
+    unittest.main()
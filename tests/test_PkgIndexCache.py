@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic PkgIndexCache tests
+#############################################################################################################
+# Records stored in the cache come back the same from a load(), a cache file cut short (a torn write,
+# a full disk) is ignored instead of read past its end.
+#
+# usage:
+#   python3 -m unittest discover tests      ( or: python3 -m pytest tests )
+#
+#############################################################################################################
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", "modules" ) )
+
+from PkgRecord import PkgRecord
+from PkgIndexCache import PkgIndexCache
+
+SHA = hashlib.sha256( b"Packages.xz" ).hexdigest()
+
+
+""" a few records, sharing strings and with fields left out """
+def make_records():
+    return [ PkgRecord( "pkg%d" % n, "amd64" if n % 2 else "all", "1.%d-1" % n, "pool/main/p/pkg%d_1.%d-1.deb" % ( n, n ),
+                        hashlib.sha256( b"%d" % n ).hexdigest(), 1000 + n ) for n in range( 50 ) ] \
+         + [ PkgRecord( "bare", "amd64", "0.1" ), PkgRecord( "nöt-ascii", "arm64", "2:1.0~rc1", "pool/x.deb", None, 0 ) ]
+
+
+class PkgIndexCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = PkgIndexCache( self.root )
+
+    def tearDown(self):
+        shutil.rmtree( self.root )
+
+    def test_round_trip(self):
+        records = make_records()
+        self.assertTrue( self.cache.store( SHA, iter( records ) ) )
+        self.assertEqual( [ name for name in os.listdir( self.root ) if name.endswith(".part") ], [] )
+        with self.cache.load( SHA ) as view:
+            self.assertEqual( len(view), len(records) )
+            self.assertEqual( [ dict( record ) for record in view ], [ dict( record ) for record in records ] )
+            self.assertEqual( dict( view[-1] ), dict( records[-1] ) )
+            self.assertEqual( list( view.record_keys() ), [ ( r.name, r.arch, r.ver ) for r in records ] )
+
+    def test_truncated_file_is_ignored(self):
+        self.assertTrue( self.cache.store( SHA, iter( make_records() ) ) )
+        path = self.cache.cache_path( SHA )
+        size = os.path.getsize( path )
+        for cut in ( size - 1, size // 2, 10 ):
+            with open( path, "r+b" ) as fh:
+                fh.truncate( cut )
+            self.assertIsNone( self.cache.load( SHA ) )
+
+    def test_other_hash_is_not_loaded(self):
+        self.assertTrue( self.cache.store( SHA, iter( make_records() ) ) )
+        os.rename( self.cache.cache_path( SHA ), self.cache.cache_path( "0" * 64 ) )
+        self.assertIsNone( self.cache.load( "0" * 64 ) )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#############################################################################################################
+# Mirror Magic SyncJournal tests
+#############################################################################################################
+# A sync killed in the middle of a download comes back with the partial file resumed by a Range request.
+#
+# usage:
+#   python3 -m unittest discover tests      ( or: python3 -m pytest tests )
+#
+#############################################################################################################
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+import http.server
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), "..", "modules" ) )
+
+from SyncJournal import SyncJournal
+from JobPlanner import JobPlanner
+from Downloader import fetcher
+
+POOL_FILE = "pool/main/p/pkg_1.0_amd64.deb"
+PAYLOAD = bytes( range( 256 ) ) * 400
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """ serves PAYLOAD for POOL_FILE, honours "Range: bytes=N-" and remembers the ranges asked for """
+    protocol_version = "HTTP/1.1"
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        offset = 0
+        if self.headers.get("Range"):
+            self.ranges.append( self.headers["Range"] )
+            offset = int( self.headers["Range"][len("bytes="):].rstrip("-") )
+            self.send_response( 206 )
+            self.send_header( "Content-Range", "bytes %d-%d/%d" % ( offset, len(PAYLOAD) - 1, len(PAYLOAD) ) )
+        else:
+            self.send_response( 200 )
+        self.send_header( "Content-Length", str( len(PAYLOAD) - offset ) )
+        self.end_headers()
+        self.wfile.write( PAYLOAD[offset:] )
+
+
+class SyncJournalResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        RangeHandler.ranges = []
+        self.server = http.server.ThreadingHTTPServer( ( "127.0.0.1", 0 ), RangeHandler )
+        threading.Thread( target=self.server.serve_forever, daemon=True ).start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.spec = { 'vendor' : "ubuntu", 'dists' : [ "t" ], 'sections' : [ "main" ], 'arches' : [ "amd64" ] }
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree( self.root )
+
+    """ (Internal) a journal resumed (or begun) for the spec, with the planner and job list of its pending files """
+    def plan(self):
+        journal = SyncJournal( self.root )
+        journal.begin( self.spec )
+        if not journal.diffed():
+            record = { 'pkgName' : "pkg", 'pkgArch' : "amd64", 'pkgVer' : "1.0", 'pkgFile' : POOL_FILE,
+                       'pkgHash' : hashlib.sha256( PAYLOAD ).hexdigest(), 'pkgSize' : len(PAYLOAD) }
+            journal.record_index( { 'dist' : "t", 'section' : "main", 'arch' : "amd64", 'status' : "fetched",
+                                    'change_set' : [ { 'change' : "new", 'state' : "queued", 'pkgInfoNew' : record, 'pkgInfoOld' : None } ] } )
+            journal.end_diff()
+        planner = JobPlanner( self.url, self.root )
+        planner.add_change_set( journal.pending_change_set() )
+        return journal, journal.mark_planned( planner, planner.plan() )
+
+    def test_killed_download_resumes(self):
+        journal, job_list = self.plan()
+        self.assertEqual( [ job['trys'] for job in job_list ], [ 0 ] )
+        # killed part way through the first try: half the file is on disk, the try never got recorded
+        dst = os.path.join( self.root, POOL_FILE )
+        os.makedirs( os.path.dirname( dst ) )
+        with open( dst+".part", "wb" ) as fh:
+            fh.write( PAYLOAD[ : len(PAYLOAD) // 2 ] )
+        journal.close()
+
+        journal, job_list = self.plan()
+        self.assertEqual( [ job['trys'] for job in job_list ], [ 1 ] )
+        fetcher( job_list[0] )
+        journal.job_done( job_list[0] )
+        self.assertTrue( job_list[0]['complete'] )
+        self.assertEqual( RangeHandler.ranges, [ "bytes=%d-" % ( len(PAYLOAD) // 2 ) ] )
+        with open( dst, "rb" ) as fh:
+            self.assertEqual( fh.read(), PAYLOAD )
+        self.assertEqual( journal.pending_count(), 0 )
+        journal.close()
+
+
+if __name__ == "__main__":
+    unittest.main()